@@ -24,7 +24,7 @@ from flask_cors import CORS
 from flask_session import Session
 
 from database import mongoclass
-from library import responses, tasks, utils
+from library import responses, tasks, tracing, utils
 from library.security import route_security
 from library.socketio import socketio
 
@@ -35,6 +35,9 @@ logger = logging.getLogger(__name__)
 class App:
     def __init__(self) -> None:
         self.app = Flask(__name__, static_folder="./frontend/build")
+
+        # Load tests (see `loadtest.py`) send every request from the same address.
+        self.app.config["RATELIMIT_ENABLED"] = not os.getenv("DISABLE_RATE_LIMITS")
         self.limiter = Limiter(
             get_remote_address,
             app=self.app,
@@ -90,9 +93,29 @@ class App:
         @self.app.before_request
         def before_request():
             g.start = time.perf_counter()
+            tracing.start_trace(request.endpoint or request.path)
+
+        @self.app.after_request
+        def after_request(response):
+            g.status_code = response.status_code
+
+            trace = tracing.current_trace()
+            if trace is not None:
+                response.headers["Server-Timing"] = trace.server_timing()
+                response.headers["X-Trace-Id"] = trace.id
+
+            return response
 
         @self.app.teardown_request
         def teardown_request(exception=None):
+            trace = tracing.end_trace()
+            if trace is not None and trace.keep:
+                tasks.log_request_trace.delay(
+                    **trace.to_json(),
+                    user_id=utils.get_user_id_from_request(anonymous=True),
+                    status_code=getattr(g, "status_code", None),
+                )
+
             try:
                 duration = time.perf_counter() - g.start
 
@@ -132,8 +155,10 @@ class App:
         self.register_blueprints()
 
         if os.getenv("PRODUCTION"):
-            logger.info("Starting with eventlet server.")
-            eventlet.wsgi.server(eventlet.listen(("0.0.0.0", 80)), self.app)
+            # `serve.py` runs a process per core, each on its own port.
+            port = int(os.getenv("PORT", 80))
+            logger.info(f"Starting with eventlet server on port {port}.")
+            eventlet.wsgi.server(eventlet.listen(("0.0.0.0", port)), self.app)
         else:
             logger.info("Starting with development server.")
             socketio.run(
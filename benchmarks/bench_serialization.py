@@ -0,0 +1,53 @@
+import random
+
+import pytest
+from library import responses
+from models.character import Character
+from models.message import Message
+
+from conftest import SESSION_SIZES, make_reply, make_text
+
+
+def make_session_messages(size: int) -> list[Message]:
+    rng = random.Random(3)
+    return [
+        Message(
+            role="user" if i % 2 == 0 else "assistant",
+            session_id="benchmark-session",
+            character_id="benchmark-character",
+            created_by="benchmark",
+            content=make_text(rng, 25) if i % 2 == 0 else make_reply(rng, 60),
+        )
+        for i in range(size)
+    ]
+
+
+def bench_character_to_json(benchmark, request_context):
+    rng = random.Random(4)
+    character = Character(
+        created_by="benchmark",
+        name="Marina",
+        description=make_text(rng, 300),
+        public_description=make_text(rng, 80),
+        personalities=["curious", "warm", "stubborn"],
+        tags=["Adventure", "Fantasy"],
+        definition_visibility=False,
+    )
+    benchmark(character.to_json)
+
+
+@pytest.mark.parametrize("size", SESSION_SIZES)
+def bench_message_to_json(benchmark, size):
+    messages = make_session_messages(size)
+    benchmark(lambda: [x.to_json() for x in messages])
+
+
+@pytest.mark.parametrize("size", SESSION_SIZES)
+def bench_create_response(benchmark, request_context, size):
+    payload = [x.to_json() for x in make_session_messages(size)]
+    benchmark(responses.create_response, payload=payload)
+
+
+def bench_create_response_4k_reply(benchmark, request_context, long_reply):
+    payload = {"role": "assistant", "content": long_reply}
+    benchmark(responses.create_response, payload=payload)
@@ -0,0 +1,111 @@
+import random
+
+import pytest
+from library import actions, utils
+from models.character import Character
+from models.session import ChatSession
+from models.tweaks import Tweaks
+from models.user import User
+
+from conftest import SESSION_SIZES, make_messages, make_reply, make_text
+
+
+@pytest.fixture(scope="module")
+def character() -> Character:
+    rng = random.Random(2)
+    return Character(
+        created_by="benchmark",
+        name="Marina",
+        description=make_text(rng, 300),
+        personalities=["curious", "warm", "stubborn"],
+        favorite_words=["tide", "lantern"],
+        response_styles=["descriptive", "playful"],
+        example_exchanges=[
+            {"role": "user", "content": make_text(rng, 20)},
+            {"role": "assistant", "content": make_text(rng, 60)},
+        ]
+        * 3,
+        id="benchmark-character",
+    )
+
+
+@pytest.fixture(scope="module")
+def session(character: Character) -> ChatSession:
+    return ChatSession(
+        created_by="benchmark",
+        name="Benchmark",
+        character_id=character.id,
+        tweaks=Tweaks(length="short"),
+        id="benchmark-session",
+    )
+
+
+@pytest.fixture(scope="module")
+def user() -> User:
+    return User(
+        email="benchmark@example.com",
+        display_name="Benchmark",
+        password=b"unused",
+        description="Likes long walks on the beach.",
+    )
+
+
+def bench_parse_character_response_short(benchmark):
+    reply = make_reply(random.Random(0), 60)
+    benchmark(utils.parse_character_response, reply, use_backups=False)
+
+
+def bench_parse_character_response_4k(benchmark, long_reply):
+    benchmark(utils.parse_character_response, long_reply, use_backups=False)
+
+
+@pytest.mark.parametrize("size", SESSION_SIZES)
+def bench_get_total_tokens_from_messages(benchmark, size):
+    messages = make_messages(size)
+    benchmark(utils.get_total_tokens_from_messages, messages)
+
+
+@pytest.mark.parametrize("size", SESSION_SIZES)
+def bench_get_total_tokens_from_messages_cold(benchmark, size):
+    messages = make_messages(size)
+    benchmark.pedantic(
+        utils.get_total_tokens_from_messages,
+        args=(messages,),
+        setup=utils.count_tokens.cache_clear,
+        rounds=20,
+    )
+
+
+@pytest.mark.parametrize("size", SESSION_SIZES)
+def bench_limit_chat_completion_tokens(benchmark, size):
+    messages = make_messages(size)
+    benchmark(
+        utils.limit_chat_completion_tokens,
+        messages=messages,
+        model="gpt-3.5-turbo",
+        max_tokens=256,
+    )
+
+
+def bench_format_function_specs_as_typescript_ns(benchmark):
+    functions = actions.get_base_actions()
+    benchmark(utils.format_function_specs_as_typescript_ns, functions)
+
+
+def bench_create_chat_completion_context(benchmark, character, session, user):
+    benchmark(
+        utils.create_chat_completion_context,
+        character=character,
+        session=session,
+        user=user,
+        user_name="Sam",
+    )
+
+
+def bench_create_chat_completion_context_cold(benchmark, character, session, user):
+    benchmark.pedantic(
+        utils.create_chat_completion_context,
+        kwargs=dict(character=character, session=session, user=user),
+        setup=utils._character_context_cache.clear,
+        rounds=200,
+    )
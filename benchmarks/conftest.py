@@ -0,0 +1,83 @@
+import os
+import random
+import sys
+from pathlib import Path
+
+# The app reads its configuration from the working directory and needs these to
+# be set at import time. Nothing here talks to MongoDB or the Celery broker, the
+# clients are lazy.
+ROOT = Path(__file__).resolve().parent.parent
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("MONGODB_URI", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("MONGODB_DB_NAME", "optitalk-benchmarks")
+os.environ.setdefault("CELERY_BROKER_URI", "memory://")
+os.environ.setdefault("CELERY_BACKEND_URI", "cache+memory://")
+
+import pytest
+
+WORDS = (
+    "the quiet harbor glowed under a copper sky while gulls circled above old "
+    "fishing boats and she laughed softly telling stories of storms, lost maps "
+    "and a lighthouse keeper who never slept because the sea kept whispering"
+).split()
+
+SESSION_SIZES = [10, 100, 1000]
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_reply(rng: random.Random, words: int) -> str:
+    """
+    A reply formatted the way the character prompts ask the model to reply.
+    """
+
+    return (
+        f"Comments: {make_text(rng, 12)}\n"
+        f"Contradictions: None\n"
+        f"Response: {make_text(rng, words)}"
+    )
+
+
+def make_messages(size: int, seed: int = 0) -> list[dict[str, str]]:
+    """
+    A chat completion context followed by `size` user and assistant messages.
+    """
+
+    rng = random.Random(seed)
+    messages = [
+        {"role": "system", "content": make_text(rng, 400)},
+        {"role": "user", "content": make_text(rng, 300)},
+    ]
+    for i in range(size):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": make_text(rng, 25)})
+        else:
+            messages.append({"role": "assistant", "content": make_reply(rng, 60)})
+
+    return messages
+
+
+@pytest.fixture(scope="session")
+def app():
+    from flask import Flask
+
+    return Flask(__name__)
+
+
+@pytest.fixture
+def request_context(app):
+    with app.test_request_context("/api/chat"):
+        yield
+
+
+@pytest.fixture(scope="session")
+def long_reply() -> str:
+    """
+    A reply of roughly 4k tokens.
+    """
+
+    return make_reply(random.Random(1), 3000)
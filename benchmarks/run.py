@@ -0,0 +1,68 @@
+"""
+Run the micro-benchmarks of the chat hot path. They need the development
+requirements (`pip install -r requirements-dev.txt`).
+
+```
+python benchmarks/run.py                  # Compare against the saved baseline
+python benchmarks/run.py --save-baseline  # Record a new baseline
+python benchmarks/run.py -k tokens        # Extra arguments are passed to pytest
+```
+
+A comparison run fails when the mean of any benchmark regressed by more than
+`--threshold` percent. Baselines are stored per machine in
+`benchmarks/.benchmarks`, so commit the one of the machine the comparisons run on.
+Without a baseline for the current machine, the benchmarks run without comparing.
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from pytest_benchmark.utils import get_machine_id
+
+BENCHMARKS_PATH = Path(__file__).resolve().parent
+STORAGE_PATH = BENCHMARKS_PATH / ".benchmarks"
+BASELINE_NAME = "baseline"
+
+
+def has_baseline() -> bool:
+    return any((STORAGE_PATH / get_machine_id()).glob(f"*_{BASELINE_NAME}.json"))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline instead of comparing.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="Maximum allowed regression of the mean, in percent.",
+    )
+    args, pytest_args = parser.parse_known_args()
+
+    os.chdir(BENCHMARKS_PATH.parent)
+    options = [str(BENCHMARKS_PATH), "-c", str(BENCHMARKS_PATH / "pytest.ini")]
+    if args.save_baseline:
+        options.append(f"--benchmark-save={BASELINE_NAME}")
+    elif not has_baseline():
+        print(
+            f"No baseline for '{get_machine_id()}' in {STORAGE_PATH}, skipping the"
+            " comparison. Record one with `python benchmarks/run.py --save-baseline`."
+        )
+    else:
+        options += [
+            f"--benchmark-compare={BASELINE_NAME}",
+            f"--benchmark-compare-fail=mean:{args.threshold}%",
+        ]
+
+    return pytest.main(options + pytest_args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
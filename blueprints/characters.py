@@ -2,9 +2,11 @@ import logging
 import re
 import time
 from typing import TYPE_CHECKING, Generator, Optional
+from urllib.parse import urlencode
 
 from flask import Blueprint, redirect, request
-from library import responses, schemas, tasks, utils
+from library import counters, responses, schemas, tasks, utils
+from library.cache import response_cache
 from library.configlib import config
 from library.security import route_security
 from models.character import Character, CharacterParameters, FavoriteCharacter
@@ -26,9 +28,13 @@ def setup(server: "App") -> Blueprint:
 
     route_security.patch(app, authentication_methods=["session", "api", "rapid-api"])
 
+    def is_authenticated() -> bool:
+        return utils.get_user_id_from_request() is not None
+
     @app.get("/tags")
     @server.limiter.exempt
     @route_security.exclude
+    @response_cache.cached("characters", ttl=300)
     def get_tags():
         data = []
         tags: Generator[Tag, None, None] = Tag.find_classes({})
@@ -54,6 +60,7 @@ def setup(server: "App") -> Blueprint:
     @server.limiter.exempt
     @route_security.request_args_schema(schema=schemas.GET_RENDER_CHARACTER_AVATAR)
     @route_security.exclude
+    @response_cache.cached("characters", ttl=300)
     def render_character_avatar():
         character_id = request.args["character_id"]
         character: Optional[Character] = Character.find_class({"id": character_id})
@@ -61,7 +68,11 @@ def setup(server: "App") -> Blueprint:
             return responses.create_response(status_code=responses.CODE_404)
 
         if character.avatar_id:
-            return redirect(f"/api/files/render-avatar?id={character.avatar_id}")
+            params = {"id": character.avatar_id}
+            params.update(
+                (k, v) for k, v in request.args.items() if k in ("size", "format")
+            )
+            return redirect(f"/api/files/render-avatar?{urlencode(params)}")
         elif character.image:
             return redirect(character.image)
 
@@ -70,6 +81,7 @@ def setup(server: "App") -> Blueprint:
     @app.get("/details")
     @route_security.request_args_schema(schema=schemas.GET_CHARACTER_DETAILS)
     @route_security.exclude
+    @response_cache.cached("characters", ttl=60, unless=is_authenticated)
     def get_character_details():
         """
         Get details about a specific character.
@@ -79,6 +91,7 @@ def setup(server: "App") -> Blueprint:
         character_id = request.args["character_id"]
         character = Character.find_class({"id": character_id, "private": False})
         if character is None:
+            response_cache.skip()
             character = Character.find_class(
                 {"id": character_id, "created_by": user_id}
             )
@@ -158,6 +171,7 @@ def setup(server: "App") -> Blueprint:
     @app.get("/")
     @route_security.request_args_schema(schema=schemas.GET_CHARACTERS)
     @route_security.exclude
+    @response_cache.cached("characters", ttl=60, unless=is_authenticated)
     def get_characters():
         """
         Get all of your characters or all publicly available characters.
@@ -257,8 +271,7 @@ def setup(server: "App") -> Blueprint:
         data: dict = request.json
         is_from_rapid_api = utils.is_from_rapid_api()
 
-        user_characters = Character.count_documents({"created_by": user_id})
-        if user_characters >= user.plan.max_characters and not is_from_rapid_api:
+        if user.characters_count >= user.plan.max_characters and not is_from_rapid_api:
             return responses.create_response(
                 status_code=responses.CODE_409,
                 payload={
@@ -294,6 +307,8 @@ def setup(server: "App") -> Blueprint:
 
         character = Character(**kwargs)
         character.save()
+        counters.increment_user(user_id, characters_count=1)
+        response_cache.invalidate("characters")
         logger.info(f"Created new character named '{character.name} ({character.id}).'")
 
         # Start saving the knowledge base
@@ -447,7 +462,10 @@ def setup(server: "App") -> Blueprint:
             if k == "nsfw":
                 setattr(character, "_moderated", True)
 
+        character.version += 1
         character.save()
+        response_cache.invalidate("characters")
+
         return responses.create_response(
             payload=character.to_json(bypass_definition_visibility=True),
             status_code=responses.CODE_200,
@@ -480,6 +498,10 @@ def setup(server: "App") -> Blueprint:
             )
 
         character.delete()
+        counters.increment_user(user_id, characters_count=-1)
+        response_cache.invalidate("characters")
+        tasks.delete_character_data.delay(character.id)
+
         return responses.create_response(status_code=responses.CODE_200)
 
     return app
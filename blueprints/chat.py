@@ -1,10 +1,22 @@
+import contextvars
 import dataclasses
 import logging
+import uuid
 from typing import TYPE_CHECKING, Optional
 
 import openai
-from flask import Blueprint, request
-from library import responses, schemas, tasks, utils
+from database import save_fields
+from flask import Blueprint, copy_current_request_context, request
+from library import (
+    cancellation,
+    counters,
+    responses,
+    schemas,
+    streams,
+    tasks,
+    tracing,
+    utils,
+)
 from library.exceptions import *
 from library.security import route_security
 from library.socketio import socketio
@@ -26,6 +38,81 @@ def setup(server: "App") -> Blueprint:
     app = Blueprint("chat", __name__, url_prefix="/api/chat")
     route_security.patch(app, authentication_methods=["session", "api", "rapid-api"])
 
+    def chat(character: Character, **kwargs):
+        """
+        Call `Character.chat` and turn its result (or error) into a response.
+        """
+
+        try:
+            response = character.chat(**kwargs)
+        except ModelRequestsLimitExceeded as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_403
+            )
+        except MessageIDAlreadyExists as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_409
+            )
+        except ConcurrencyLimitExceeded as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_429
+            )
+        except AdmissionTimeout as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_503
+            )
+        except (openai.APIError, RateLimitError, AuthenticationError):
+            logger.exception("A OpenAI error has occurred.")
+            return responses.create_response(
+                status_code=responses.CODE_500,
+                payload={
+                    "message": "A unknown model error has occurred, please try again."
+                },
+            )
+
+        return responses.create_response(payload=response[-1].to_json())
+
+    def stream_chat(character: Character, user_id: str, id: str, **kwargs):
+        """
+        Chat in a background green thread and stream the response as Server-Sent
+        Events. The events are buffered under the message `id` so the stream can be
+        resumed from `GET /api/chat/stream`.
+        """
+
+        def on_abandoned():
+            cancellation.registry.cancel(
+                user_id,
+                character.id,
+                kwargs.get("session_id", "0"),
+                reason="disconnected",
+            )
+
+        buffer = streams.registry.create(id, user_id, on_abandoned=on_abandoned)
+
+        @copy_current_request_context
+        def generate():
+            trace = tracing.start_trace("chat.post_chat")
+            try:
+                response, status_code = chat(
+                    character, user_id=user_id, id=id, stream_buffer=buffer, **kwargs
+                )
+                event = "message" if status_code < 400 else "error"
+                buffer.push(event, response.get_json())
+            except Exception:
+                logger.exception(f"Streaming the chat '{id}' has failed.")
+                response, _ = responses.create_response(status_code=responses.CODE_500)
+                buffer.push("error", response.get_json())
+            finally:
+                buffer.close()
+
+                if trace.keep:
+                    tasks.log_request_trace.delay(**trace.to_json(), user_id=user_id)
+
+        # A copy of the context keeps the green thread out of the request's trace.
+        socketio.start_background_task(contextvars.copy_context().run, generate)
+
+        return streams.create_sse_response(buffer)
+
     @app.post("/")
     @server.limiter.limit("3/second;25/minute")
     @route_security.request_json_schema(schema=schemas.POST_CHAT)
@@ -33,6 +120,10 @@ def setup(server: "App") -> Blueprint:
     def post_chat():
         """
         Chat with a character. Either chat as the "user" role itself or as the "assistant" role.
+
+        If `stream` is true, the response is streamed as Server-Sent Events: `chunk`
+        events with the tokens as they are generated, then a single `message` (the
+        same payload as the non streamed response) or `error` event.
         """
 
         data: dict = request.json
@@ -52,37 +143,28 @@ def setup(server: "App") -> Blueprint:
                 if tweaks:
                     tweaks = Tweaks(**tweaks)
 
-                try:
-                    response = character.chat(
-                        user_id=user_id,
-                        role=data.get("role", "user"),
-                        content=data["content"],
-                        user_name=data.get("user_name"),
-                        session_id=data.get("session_id", "0"),
-                        story_mode=data.get("story_mode", False),
-                        story=data.get("story"),
-                        tweaks=tweaks,
-                        id=data.get("id"),
-                        api_key=data.get("api_key"),  # TODO Remove
-                    )
-                except ModelRequestsLimitExceeded as e:
-                    return responses.create_response(
-                        exception=e, status_code=responses.CODE_403
-                    )
-                except MessageIDAlreadyExists as e:
-                    return responses.create_response(
-                        exception=e, status_code=responses.CODE_409
-                    )
-                except (openai.APIError, RateLimitError, AuthenticationError):
-                    logger.exception("A OpenAI error has occurred.")
-                    return responses.create_response(
-                        status_code=responses.CODE_500,
-                        payload={
-                            "message": "A unknown model error has occurred, please try again."
-                        },
-                    )
-
-                return responses.create_response(payload=response[-1].to_json())
+                kwargs = dict(
+                    role=data.get("role", "user"),
+                    content=data["content"],
+                    user_name=data.get("user_name"),
+                    session_id=data.get("session_id", "0"),
+                    story_mode=data.get("story_mode", False),
+                    story=data.get("story"),
+                    tweaks=tweaks,
+                    api_key=data.get("api_key"),  # TODO Remove
+                )
+
+                if data.get("stream"):
+                    message_id = data.get("id") or str(uuid.uuid4())
+                    if Message.count_documents({"id": message_id}):
+                        return responses.create_response(
+                            exception=MessageIDAlreadyExists(message_id),
+                            status_code=responses.CODE_409,
+                        )
+
+                    return stream_chat(character, user_id, message_id, **kwargs)
+
+                return chat(character, user_id=user_id, id=data.get("id"), **kwargs)
 
         return responses.create_response(
             status_code=responses.CODE_404,
@@ -91,6 +173,33 @@ def setup(server: "App") -> Blueprint:
             },
         )
 
+    @app.get("/stream")
+    @route_security.request_args_schema(schema=schemas.GET_CHAT_STREAM)
+    @route_security.exclude
+    def get_chat_stream():
+        """
+        Resume the Server-Sent Events of a streamed chat from `offset`, or from the
+        event after the `Last-Event-ID` header. Buffers are kept per process for a
+        few minutes after the chat started.
+        """
+
+        user_id = utils.get_user_id_from_request(anonymous=True)
+        if user_id is None:
+            return responses.create_response(status_code=responses.CODE_400)
+
+        buffer = streams.registry.get(request.args["id"], user_id)
+        if buffer is None:
+            return responses.create_response(status_code=responses.CODE_404)
+
+        offset = 0
+        last_event_id = request.headers.get("Last-Event-ID", "")
+        if request.args.get("offset", "").isdigit():
+            offset = int(request.args["offset"])
+        elif last_event_id.isdigit():
+            offset = int(last_event_id) + 1
+
+        return streams.create_sse_response(buffer, offset)
+
     @app.get("/")
     @route_security.request_args_schema(schema=schemas.GET_CHAT)
     @route_security.exclude
@@ -147,15 +256,17 @@ def setup(server: "App") -> Blueprint:
             )
 
         session_id = request.args.get("session_id", "0")
-        count = Message.count_documents(
+        session: Optional[ChatSession] = ChatSession.find_class(
             {
+                "id": session_id,
                 "character_id": request.args["character_id"],
-                "session_id": session_id,
                 "created_by": user_id,
             }
         )
 
-        return responses.create_response(payload=count)
+        return responses.create_response(
+            payload=session.messages_count if session else 0
+        )
 
     @app.get("/sessions")
     @route_security.request_args_schema(schema=schemas.GET_CHAT_SESSIONS)
@@ -269,6 +380,7 @@ def setup(server: "App") -> Blueprint:
         )
         last_message.delete()
         last_user_message.delete()
+        counters.increment_messages(session_id, character_id, user_id, amount=-2)
 
         try:
             response = character.chat(
@@ -284,6 +396,14 @@ def setup(server: "App") -> Blueprint:
             return responses.create_response(
                 exception=e, status_code=responses.CODE_403
             )
+        except ConcurrencyLimitExceeded as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_429
+            )
+        except AdmissionTimeout as e:
+            return responses.create_response(
+                exception=e, status_code=responses.CODE_503
+            )
         except openai.APIError:
             logger.exception("A OpenAI error has occurred while trying to regenerate.")
             return responses.create_response(status_code=responses.CODE_500)
@@ -339,9 +459,11 @@ def setup(server: "App") -> Blueprint:
             )
         session: ChatSession
 
+        changed = set(request.json)
         for k, v in request.json.items():
             if k == "name":
                 setattr(session, "name_changed", True)
+                changed.add("name_changed")
 
             if k == "tweaks":
                 if v is None:
@@ -361,7 +483,7 @@ def setup(server: "App") -> Blueprint:
             data["last_used"] = session.last_used.isoformat()
 
         socketio.emit("session-settings-updated", data, room=user_id)
-        session.save()
+        save_fields(session, *changed)
 
         return responses.create_response()
 
@@ -423,6 +545,25 @@ def setup(server: "App") -> Blueprint:
             )
 
         message.delete()
+        counters.increment_messages(
+            message.session_id, message.character_id, message.created_by, amount=-1
+        )
+
         return responses.create_response()
 
+    @socketio.on("stop-generation")
+    def on_stop_generation(data):
+        """
+        Stop the generation of a chat session. `data` has the `character_id` and the
+        `session_id` (defaults to "0") of the session.
+        """
+
+        user_id = utils.get_user_id_from_request(anonymous=True)
+        if user_id is None or not isinstance(data, dict) or "character_id" not in data:
+            return False
+
+        return cancellation.registry.cancel(
+            user_id, data["character_id"], data.get("session_id", "0")
+        )
+
     return app
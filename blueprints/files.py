@@ -1,16 +1,26 @@
 import dataclasses
-from typing import TYPE_CHECKING
+import io
+from typing import TYPE_CHECKING, Optional
 
+from cachetools import TTLCache
 from flask import Blueprint, request, send_file
-from library import responses, schemas, utils
+from library import images, responses, schemas, utils
 from library.exceptions import *
 from library.security import route_security
 from models.file import File
-from PIL import Image
 
 if TYPE_CHECKING:
     from ..app import App
 
+# Avatar `File`s looked up by `render_avatar`, avatars never change once uploaded.
+_avatar_files: TTLCache = TTLCache(maxsize=4096, ttl=images.AVATAR_CACHE_TTL)
+
+# Avatars are immutable, a new upload always gets a new ID.
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Used when the requested variant doesn't exist (yet) and something else is served.
+FALLBACK_CACHE_CONTROL = "public, max-age=60"
+
 
 def upload_file(type: str):
     if "file" not in request.files:
@@ -20,23 +30,25 @@ def upload_file(type: str):
     if file.filename == "":
         return responses.create_response(status_code=responses.CODE_400)
 
-    # Verify file is a image
-    try:
-        Image.open(file.stream)
-    except IOError:
-        return responses.create_response(status_code=responses.CODE_400)
-
     user_id = utils.get_user_id_from_request()
     if user_id is None:
         return responses.create_response(status_code=responses.CODE_404)
 
-    f = File.from_file_like_object(
-        file.stream,
-        type=type,
-        filename=file.filename,
-        mimetype=file.mimetype,
-        created_by=user_id,
-    )
+    # Only the header is read here, the image is decoded by the `process_avatar`
+    # task once the raw upload is stored.
+    try:
+        images.validate_image(file.stream, request.content_length)
+        f = File.from_file_like_object(
+            file.stream,
+            type=type,
+            filename=file.filename,
+            mimetype=file.mimetype,
+            created_by=user_id,
+        )
+    except InvalidImage as e:
+        return responses.create_response(
+            status_code=responses.CODE_400, payload={"message": e.reason}
+        )
 
     if not f.uploaded:
         return responses.create_response(status_code=responses.CODE_500)
@@ -60,17 +72,61 @@ def setup(server: "App") -> Blueprint:
     @route_security.request_args_schema(schemas.GET_RENDER_AVATAR)
     @route_security.exclude
     def render_avatar():
+        """
+        Render an avatar. If `size` is provided, the smallest pre-rendered variant
+        that is at least that wide is served instead of the original, as WebP when
+        the client accepts it (or `format` asks for it) and JPEG otherwise.
+        """
+
         id = request.args["id"]
 
-        avatar = File.find_class(
-            {"id": id, "type": "avatar", "uploaded": True, "private": False}
-        )
+        avatar: Optional[File] = _avatar_files.get(id)
         if avatar is None:
+            avatar = File.find_class(
+                {"id": id, "type": "avatar", "uploaded": True, "private": False}
+            )
+            if avatar is None:
+                return responses.create_response(status_code=responses.CODE_404)
+
+            # Unprocessed avatars are looked up again until their variants exist.
+            if avatar.processed:
+                _avatar_files[id] = avatar
+
+        size = request.args.get("size")
+        format = request.args.get("format")
+        if format is None:
+            accept_webp = any(x == "image/webp" for x, _ in request.accept_mimetypes)
+        else:
+            accept_webp = format == "webp"
+
+        variant = images.pick_avatar_variant(
+            avatar.variants, int(size) if size else None, accept_webp
+        )
+        # Fall back to the original and then to the raw upload for avatars that
+        # are still being processed.
+        fallbacks = [variant, None, images.RAW_VARIANT]
+        for i, name in enumerate(dict.fromkeys(fallbacks)):
+            image = images.load_avatar(avatar.id, name, avatar.mimetype)
+            if image is not None:
+                break
+        else:
             return responses.create_response(status_code=responses.CODE_404)
 
-        avatar: File
+        response = send_file(
+            io.BytesIO(image.data),
+            mimetype=image.mimetype,
+            etag=image.etag,
+            last_modified=image.last_modified,
+            conditional=True,
+        )
+        if i == 0:
+            response.headers["Cache-Control"] = AVATAR_CACHE_CONTROL
+        else:
+            response.headers["Cache-Control"] = FALLBACK_CACHE_CONTROL
+        if size and format is None:
+            response.vary.add("Accept")
 
-        return send_file(avatar.get_file(), mimetype=avatar.mimetype)
+        return response
 
     @app.delete("/")
     @route_security.request_args_schema(schemas.DELETE_FILE)
@@ -84,6 +140,7 @@ def setup(server: "App") -> Blueprint:
             return responses.create_response(status_code=responses.CODE_404)
 
         file: File
+        _avatar_files.pop(file.id, None)
         return responses.create_response(payload={"status": file.delete_file()})
 
     return app
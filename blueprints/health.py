@@ -0,0 +1,66 @@
+import logging
+import os
+from typing import TYPE_CHECKING
+
+import redis
+from database import db
+from flask import Blueprint
+from library import admission, ratelimit, responses
+from pymongo.errors import PyMongoError
+
+if TYPE_CHECKING:
+    from ..app import App
+
+
+logger = logging.getLogger(__name__)
+
+
+# pylint: disable=unused-argument
+def setup(server: "App") -> Blueprint:
+    app = Blueprint("health", __name__, url_prefix="/api/health")
+
+    @app.get("/")
+    def get_health():
+        """
+        Liveness of this process, it answers as long as its event loop isn't stuck.
+        """
+
+        return responses.create_response({"pid": os.getpid()})
+
+    @app.get("/ready")
+    def get_ready():
+        """
+        Whether this process can serve requests, that is, MongoDB and Redis (if
+        configured) are reachable. Also reports the completions this process has in
+        flight and queued.
+        """
+
+        checks = {}
+
+        try:
+            db.command("ping")
+            checks["mongodb"] = True
+        except PyMongoError:
+            logger.exception("MongoDB is unreachable.")
+            checks["mongodb"] = False
+
+        if ratelimit.limiter.enabled:
+            try:
+                ratelimit.limiter.client.ping()
+                checks["redis"] = True
+            except redis.RedisError:
+                logger.exception("Redis is unreachable.")
+                checks["redis"] = False
+
+        payload = {
+            "pid": os.getpid(),
+            "checks": checks,
+            "completions": admission.scheduler.stats(),
+        }
+
+        if not all(checks.values()):
+            return responses.create_response(payload, status_code=responses.CODE_503)
+
+        return responses.create_response(payload)
+
+    return app
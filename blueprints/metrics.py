@@ -1,12 +1,11 @@
+import datetime as dt
 import logging
-import statistics
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
-from flask import Blueprint
-from library import responses, utils
-from library.gpt import gpt
+from flask import Blueprint, request
+from library import responses, rollups, schemas, tasks, utils
 from library.security import route_security
-from models.open_ai import ChatCompletion, Completion
+from models.metric import RequestTrace
 from models.user import User
 
 if TYPE_CHECKING:
@@ -22,103 +21,95 @@ def setup(server: "App") -> Blueprint:
 
     route_security.patch(app, authentication_methods=["session", "api"])
 
+    def is_admin() -> bool:
+        user_id = utils.get_user_id_from_request()
+        user: Optional[User] = User.find_class({"id": user_id})
+
+        return user is not None and user.admin
+
     @app.get("/completions")
+    @route_security.request_args_schema(schema=schemas.GET_METRICS_COMPLETIONS)
     def get_tokens_usage():
         """
-        Retrieve all information about OpenAI completions.
-
-        TODO: Majority of how I collect the data in here is terribly un-optimized. So work
-        on a system for collecting these metrics more efficiently. Perhaps a celery beat
-        task that calculates these metrics every X seconds?
+        Retrieve all information about OpenAI completions. The metrics are read from
+        the pre-aggregated rollups maintained by `library.rollups` so the optional
+        `start` and `end` (ISO 8601) query parameters can be any time range.
         """
 
-        user_id = utils.get_user_id_from_request()
-        user = User.find_class({"id": user_id})
-
-        if not user.admin:
+        if not is_admin():
             return "Not Found", 404
 
-        chat_completion_tokens = []
-        text_completion_tokens = []
+        def parse_timestamp(value: Optional[str]) -> Optional[dt.datetime]:
+            if not value:
+                return None
 
-        chat_completion_costs = []
-        text_completion_costs = []
+            timestamp = dt.datetime.fromisoformat(value)
+            if timestamp.tzinfo is not None:
+                # Rollup buckets are naive local times.
+                timestamp = timestamp.astimezone().replace(tzinfo=None)
 
-        chat_response_times = []
-        text_response_times = []
+            return timestamp
 
-        chat_models = []
-        text_models = []
-
-        for chat_completion in ChatCompletion.find_classes({}):
-            chat_completion_tokens.append(chat_completion.total_tokens)
-            chat_completion_costs.append(
-                gpt.calculate_completion_cost(
-                    chat_completion.model, chat_completion.total_tokens
-                )
-            )
-            chat_response_times.append(chat_completion.tt)
-            chat_models.append(chat_completion.model)
-
-        for text_completion in Completion.find_classes({}):
-            text_completion_tokens.append(text_completion.total_tokens)
-            text_completion_costs.append(
-                gpt.calculate_completion_cost(
-                    text_completion.model, text_completion.total_tokens
-                )
+        try:
+            start = parse_timestamp(request.args.get("start"))
+            end = parse_timestamp(request.args.get("end"))
+        except ValueError:
+            return responses.create_response(
+                status_code=responses.CODE_400,
+                payload={"message": "start and end must be ISO 8601 timestamps."},
             )
-            text_response_times.append(text_completion.tt)
-            text_models.append(text_completion.model)
 
         payload = {
-            "chat": {
-                "tokens": {
-                    "average": statistics.mean(chat_completion_tokens),
-                    "minimum": min(chat_completion_tokens),
-                    "maximum": max(chat_completion_tokens),
-                    "total": sum(chat_completion_tokens),
-                },
-                "cost": {
-                    "average": statistics.mean(chat_completion_costs),
-                    "minimum": min(chat_completion_costs),
-                    "maximum": max(chat_completion_costs),
-                    "total": sum(chat_completion_costs),
-                },
-                "response_times": {
-                    "average": statistics.mean(chat_response_times),
-                    "minimum": min(chat_response_times),
-                    "maximum": max(chat_response_times),
-                },
-                "models": {
-                    "least_used": min(chat_models, key=chat_models.count),
-                    "most_used": max(chat_models, key=chat_models.count),
-                },
-            },
-            "text": {
-                "tokens": {
-                    "average": statistics.mean(text_completion_tokens),
-                    "minimum": min(text_completion_tokens),
-                    "maximum": max(text_completion_tokens),
-                    "total": sum(text_completion_tokens),
-                },
-                "cost": {
-                    "average": statistics.mean(text_completion_costs),
-                    "minimum": min(text_completion_costs),
-                    "maximum": max(text_completion_costs),
-                    "total": sum(text_completion_costs),
-                },
-                "response_times": {
-                    "average": statistics.mean(text_response_times),
-                    "minimum": min(text_response_times),
-                    "maximum": max(text_response_times),
-                },
-                "models": {
-                    "least_used": min(text_models, key=chat_models.count),
-                    "most_used": max(text_models, key=chat_models.count),
-                },
-            },
+            "chat": rollups.summarize_rollups(rollups.read_rollups("chat", start, end)),
+            "text": rollups.summarize_rollups(rollups.read_rollups("text", start, end)),
         }
 
         return responses.create_response(payload=payload)
 
+    @app.post("/completions/rebuild")
+    def rebuild_completions_rollups():
+        """
+        Schedule a rebuild of the completion rollups from the raw completions.
+        """
+
+        if not is_admin():
+            return "Not Found", 404
+
+        tasks.rebuild_completion_rollups.delay()
+
+        return responses.create_response(status_code=responses.CODE_202)
+
+    @app.get("/traces")
+    @route_security.request_args_schema(schema=schemas.GET_METRICS_TRACES)
+    def get_traces():
+        """
+        Retrieve the per-stage latency breakdowns of the latest chat turns, newest
+        first. A single trace can be retrieved with the `id` found in the
+        `X-Trace-Id` header of its response.
+        """
+
+        if not is_admin():
+            return "Not Found", 404
+
+        page_size = int(request.args.get("page_size", 25))
+        page = int(request.args.get("page", 1))
+
+        query = {}
+        if request.args.get("id"):
+            query["id"] = request.args["id"]
+        if request.args.get("name"):
+            query["name"] = request.args["name"]
+
+        traces = [
+            x.to_json()
+            for x in utils.paginate_mongoclass_cursor(
+                RequestTrace.find_classes(query), page_size=page_size, page=page
+            ).sort("_id", -1)
+        ]
+        total = RequestTrace.count_documents(query)
+
+        return responses.create_paginated_response(
+            objects=traces, page=page, page_size=page_size, total=total
+        )
+
     return app
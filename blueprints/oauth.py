@@ -5,6 +5,7 @@ from typing import TYPE_CHECKING
 
 import google.auth.transport.requests
 import requests
+from database import save_fields
 from flask import Blueprint, make_response, redirect, request, session
 from google.oauth2 import id_token
 from google_auth_oauthlib.flow import Flow
@@ -124,7 +125,7 @@ def setup(server: "App") -> Blueprint:
             user = User.find_class({"email": id_info["email"]})
 
         user.plan.verified = True
-        user.save()
+        save_fields(user, "plan")
 
         users.authorize_session(user.id)
 
@@ -2,6 +2,7 @@ import logging
 import pprint
 from typing import TYPE_CHECKING, Optional
 
+from database import save_fields
 from flask import Blueprint, request
 from library import responses, schemas, utils
 from library.exceptions import *
@@ -35,7 +36,7 @@ def setup(server: "App") -> Blueprint:
         user = User.find_class({"id": user_id})
         user: User
         user.plan.subscription_id = data["id"]
-        user.save()
+        save_fields(user, "plan")
 
         return responses.create_response()
 
@@ -55,7 +56,7 @@ def setup(server: "App") -> Blueprint:
         paypal.cancel_subscription(id=user.plan.subscription_id, reason=data["reason"])
         user.plan.subscription_id = None
         user.plan.id = "free"
-        user.save()
+        save_fields(user, "plan")
 
         return responses.create_response()
 
@@ -116,7 +117,7 @@ def setup(server: "App") -> Blueprint:
 
             logger.info(f"Subscription plan from '{user}' has been cancelled.")
 
-        user.save()
+        save_fields(user, "plan")
 
         return responses.create_response()
 
@@ -2,12 +2,13 @@ import dataclasses
 from typing import TYPE_CHECKING, Optional
 
 import bcrypt
+from database import save_fields
 from flask import Blueprint, request, session
+from flask_socketio import join_room, leave_room
 from library import responses, schemas, users, utils
 from library.exceptions import *
 from library.security import route_security
-from models.character import Character
-from models.message import Message
+from library.socketio import socketio
 from models.state import UserPlanState
 from models.user import Application, User
 
@@ -42,7 +43,7 @@ def setup(server: "App") -> Blueprint:
 
         data = request.get_json()
         user.description = data["content"]
-        user.save()
+        save_fields(user, "description")
 
         return responses.create_response()
 
@@ -58,7 +59,7 @@ def setup(server: "App") -> Blueprint:
         data = request.get_json()
         user.display_name = data["name"]
         user.display_name_changed = True
-        user.save()
+        save_fields(user, "display_name", "display_name_changed")
 
         return responses.create_response()
 
@@ -146,7 +147,6 @@ def setup(server: "App") -> Blueprint:
 
         user_id = utils.get_user_id_from_request()
         user: User = User.find_class({"id": user_id})
-        user.save()
 
         plan = user.plan
         plan_state: UserPlanState = UserPlanState.find_class({"id": user_id})
@@ -169,7 +169,7 @@ def setup(server: "App") -> Blueprint:
             },
             "characters": {
                 "limit": plan.max_characters,
-                "current": Character.count_documents({"created_by": user_id}),
+                "current": user.characters_count,
             },
         }
 
@@ -177,10 +177,18 @@ def setup(server: "App") -> Blueprint:
             limits["characters"]["limit"] = -1
             limits["messages"]["limit"] = -1
 
-        statistics = {"messages": Message.count_documents({"created_by": user_id})}
+        statistics = {"messages": user.messages_count}
 
         return responses.create_response(
             {"basic": data, "limits": limits, "statistics": statistics}
         )
 
+    @socketio.on("join-room")
+    def on_join_room(id):
+        join_room(id)
+
+    @socketio.on("leave-room")
+    def on_leave_room(id):
+        leave_room(id)
+
     return app
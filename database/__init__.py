@@ -2,8 +2,32 @@ import os
 
 import gridfs
 from mongoclass import MongoClassClient
+from pymongo.collection import Collection
 
 mongoclass = MongoClassClient(os.environ["MONGODB_DB_NAME"], os.environ["MONGODB_URI"])
 
 db = mongoclass[os.environ["MONGODB_DB_NAME"]]
 fs = gridfs.GridFS(db)
+
+
+def get_collection(cls: type) -> Collection:
+    """
+    Return the raw pymongo `Collection` that backs a mongoclass model. Useful for
+    operations mongoclass does not expose such as `update_many` or `bulk_write`.
+
+    This is the collection mongoclass itself reads and writes (`COLLECTION_NAME`,
+    the lowercased class name), not `cls.__name__`.
+    """
+
+    return db[cls.COLLECTION_NAME]
+
+
+def save_fields(document, *fields: str) -> None:
+    """
+    Write only `fields` of a mongoclass document with `$set`. Unlike `save`, which
+    writes back the whole document, this doesn't overwrite the fields that are
+    updated in place (i.e., the counters of `library.counters`) with stale values.
+    """
+
+    data = document.as_json()
+    document.update({"$set": {x: data[x] for x in fields}}, return_new=False)
@@ -0,0 +1,258 @@
+import collections
+import contextlib
+import dataclasses
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Iterator, Optional
+
+import redis
+from models.user import Plan
+from redis.commands.core import Script
+
+from library import ratelimit, tracing
+from library.configlib import config
+from library.exceptions import AdmissionTimeout, ConcurrencyLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Seconds a completion counts against the concurrency of its user in Redis. This
+# bounds how long the slots of a process that crashed stay taken, so it must be
+# longer than any completion (queue wait included).
+LEASE_TTL = 600
+
+# Every completion of a user in flight (or waiting) is a member of a sorted set
+# scored by when its lease expires. Expired leases are pruned before counting and
+# nothing is written when the user is over the limit, so a user retrying against
+# a leaked lease can't keep it alive.
+#
+# KEYS: the sorted set of the user
+# ARGV: the limit, the lease, the lease TTL
+# Returns 1 if the lease was added, 0 if the user is at the limit.
+_RESERVE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+
+redis.call("ZADD", KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+redis.call("EXPIRE", KEYS[1], tonumber(ARGV[3]))
+return 1
+"""
+
+
+@dataclasses.dataclass
+class _Waiter:
+    user_id: str
+    plan_id: str
+    event: threading.Event = dataclasses.field(default_factory=threading.Event)
+    admitted: bool = False
+
+
+class AdmissionScheduler:
+
+    """
+    Decides which chat completions of this process may call the OpenAI API.
+
+    - At most `llm_max_concurrency` (`config/main.json`) completions are in flight
+    across every web process, each process getting an equal share of it
+    (`WEB_WORKERS` processes, see `serve.py`). Set it to roughly
+    `RPM * average completion seconds / 60` of the OpenAI budget.
+    - A user can't have more than `max_concurrent_completions` of their plan in
+    flight or waiting, anything above that is rejected right away. With Redis
+    (`REDIS_URI`) this is counted across every process, otherwise per process.
+    - When every slot is taken, completions wait in a queue per plan. A freed slot
+    goes to the plan that has been served the least relative to its
+    `scheduling_weight` (weighted fair queueing), and a completion that waited more
+    than `max_queue_wait` seconds gives up.
+
+    So a single user flooding the endpoint only ever holds a few slots and a paid
+    plan keeps getting its share of the rest however long the other queues get.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._users: collections.Counter[str] = collections.Counter()
+        self._queues: dict[str, collections.deque[_Waiter]] = {}
+        self._virtual_times: dict[str, float] = {}
+        self._clock = 0.0
+        self._weights: dict[str, int] = {}
+        self._script: Optional[Script] = None
+
+    @property
+    def capacity(self) -> int:
+        processes = int(os.getenv("WEB_WORKERS") or 1)
+        return max(math.ceil(config.main["llm_max_concurrency"] / processes), 1)
+
+    def _reserve_script(self) -> Script:
+        if self._script is None:
+            self._script = ratelimit.limiter.client.register_script(_RESERVE_SCRIPT)
+
+        return self._script
+
+    def _reserve_user(self, user_id: str, plan: Plan) -> Optional[str]:
+        """
+        Count a completion of the user, in Redis (shared by every process) if
+        possible and in this process otherwise.
+
+        Returns
+        -------
+        `Optional[str]` :
+            The lease of the completion in Redis or None if it was counted in this
+            process.
+        """
+
+        limit = plan.max_concurrent_completions
+        if ratelimit.limiter.enabled:
+            lease = uuid.uuid4().hex
+            try:
+                reserved = self._reserve_script()(
+                    keys=[f"admission:{user_id}"], args=[limit, lease, LEASE_TTL]
+                )
+            except redis.RedisError:
+                logger.warning("Shared admission is unavailable.", exc_info=True)
+            else:
+                if not reserved:
+                    raise ConcurrencyLimitExceeded(limit=limit)
+                return lease
+
+        with self._lock:
+            if self._users[user_id] >= limit:
+                raise ConcurrencyLimitExceeded(limit=limit)
+            self._users[user_id] += 1
+
+        return None
+
+    def _release_user(self, user_id: str, lease: Optional[str]) -> None:
+        if lease is None:
+            with self._lock:
+                self._users[user_id] -= 1
+                if not self._users[user_id]:
+                    del self._users[user_id]
+            return
+
+        try:
+            ratelimit.limiter.client.zrem(f"admission:{user_id}", lease)
+        except redis.RedisError:
+            # The lease expires on its own.
+            logger.warning("Shared admission is unavailable.", exc_info=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "in_flight": self._in_flight,
+                "queued": {k: len(v) for k, v in self._queues.items() if v},
+            }
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        plans = [x for x, queue in self._queues.items() if queue]
+        if not plans:
+            return None
+
+        plan_id = min(plans, key=lambda x: self._virtual_times[x])
+        self._clock = self._virtual_times[plan_id]
+        self._virtual_times[plan_id] += 1 / self._weights[plan_id]
+
+        return self._queues[plan_id].popleft()
+
+    def _dispatch(self) -> None:
+        while self._in_flight < self.capacity:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+
+            waiter.admitted = True
+            self._in_flight += 1
+            waiter.event.set()
+
+    def acquire(self, user_id: str, plan: Plan) -> Optional[str]:
+        """
+        Wait for a slot, it must be released with `release` (and the lease this
+        returns) once the completion is done.
+
+        Raises
+        ------
+        `ConcurrencyLimitExceeded` :
+            If the user already has too many completions in flight or waiting.
+        `AdmissionTimeout` :
+            If no slot was free within the `max_queue_wait` of the plan.
+        """
+
+        lease = self._reserve_user(user_id, plan)
+        try:
+            self._acquire(user_id, plan)
+        except Exception:
+            self._release_user(user_id, lease)
+            raise
+
+        return lease
+
+    def _acquire(self, user_id: str, plan: Plan) -> None:
+        st = time.perf_counter()
+        with self._lock:
+            queued = any(self._queues.values())
+            if self._in_flight < self.capacity and not queued:
+                self._in_flight += 1
+                return
+
+            queue = self._queues.setdefault(plan.id, collections.deque())
+            if not queue:
+                # A plan that was idle starts from the current virtual time instead
+                # of catching up on the time it was idle.
+                self._virtual_times[plan.id] = max(
+                    self._virtual_times.get(plan.id, 0.0), self._clock
+                )
+
+            waiter = _Waiter(user_id=user_id, plan_id=plan.id)
+            self._weights[plan.id] = max(plan.scheduling_weight, 1)
+            queue.append(waiter)
+
+        waiter.event.wait(plan.max_queue_wait)
+
+        with self._lock:
+            if not waiter.admitted:
+                self._queues[plan.id].remove(waiter)
+
+                waited = time.perf_counter() - st
+                logger.warning(
+                    f"Completion of '{user_id}' ({plan.id}) was not admitted after {waited:.2f}s."
+                )
+                raise AdmissionTimeout(waited=round(waited, 2))
+
+        tracing.record("queue_wait", st)
+
+    def release(self, user_id: str, lease: Optional[str]) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+        self._release_user(user_id, lease)
+
+    @contextlib.contextmanager
+    def admit(self, user_id: str, plan: Plan) -> Iterator[None]:
+        """
+        Hold a slot for the duration of the block.
+
+        Usage:
+        ```
+        with admission.scheduler.admit(user.id, user.plan):
+            completion = gpt.create_chat_completion(...)
+        ```
+        """
+
+        lease = self.acquire(user_id, plan)
+        try:
+            yield
+        finally:
+            self.release(user_id, lease)
+
+
+scheduler = AdmissionScheduler()
@@ -0,0 +1,209 @@
+import dataclasses
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+
+from cachetools import LRUCache
+from database import get_collection
+from flask import Response, g, make_response, request
+from models.cache import CacheGeneration
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# The maximum amount of response body bytes kept in memory per process.
+MAX_SIZE = 64 * 1024 * 1024
+
+# How often (in seconds) the generation of a namespace is re-read from the
+# database. This is how long a process can keep serving a response that another
+# process (or a celery worker) has invalidated.
+GENERATION_POLL_INTERVAL = 2.0
+
+CACHEABLE_STATUS_CODES = (200, 301, 302)
+
+
+@dataclasses.dataclass
+class CachedResponse:
+    body: bytes
+    status: int
+    headers: list[tuple[str, str]]
+    etag: str
+    expires_at: float
+
+
+class ResponseCache:
+
+    """
+    An in-memory cache of full responses for views that serve public data.
+
+    Responses are keyed on the request path, its normalized query parameters and
+    the generation of the namespace they belong to. Calling `invalidate` bumps the
+    generation in the database so every process (including the celery workers)
+    stops serving the old responses within `GENERATION_POLL_INTERVAL` seconds.
+
+    A miss is only computed once per process at a time, concurrent requests for
+    the same key wait for the first one instead of all going to the database.
+    Every cached response carries an ETag, requests with a matching
+    `If-None-Match` header get an empty 304.
+    """
+
+    def __init__(self, maxsize: int = MAX_SIZE) -> None:
+        self._entries: LRUCache = LRUCache(
+            maxsize=maxsize, getsizeof=lambda x: len(x.body) or 1
+        )
+        # A lock lives as long as a request computing or waiting for its key holds
+        # it, so it's never dropped while the value is still being stored.
+        self._locks: weakref.WeakValueDictionary[
+            str, threading.Lock
+        ] = weakref.WeakValueDictionary()
+        self._generations: dict[str, tuple[int, float]] = {}
+
+    def generation(self, namespace: str) -> int:
+        """
+        The current generation of a namespace, re-read from the database at most
+        once every `GENERATION_POLL_INTERVAL` seconds.
+        """
+
+        generation, checked_at = self._generations.get(namespace, (0, 0.0))
+        now = time.monotonic()
+        if now - checked_at < GENERATION_POLL_INTERVAL:
+            return generation
+
+        document = get_collection(CacheGeneration).find_one(
+            {"namespace": namespace}, {"generation": 1}
+        )
+        generation = document["generation"] if document else 0
+        self._generations[namespace] = (generation, now)
+
+        return generation
+
+    def invalidate(self, namespace: str) -> None:
+        """
+        Invalidate every cached response of a namespace in every process.
+        """
+
+        document = get_collection(CacheGeneration).find_one_and_update(
+            {"namespace": namespace},
+            {"$inc": {"generation": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._generations[namespace] = (document["generation"], time.monotonic())
+        logger.debug(f"Invalidated the '{namespace}' response cache.")
+
+    def skip(self) -> None:
+        """
+        Mark the response of the current request as uncacheable. Use this when a
+        cached view ends up serving data that is not public.
+        """
+
+        g.response_cache_skip = True
+
+    def _key(self, namespace: str) -> str:
+        args = sorted(
+            (k, v.strip()) for k, v in request.args.items(multi=True) if v.strip()
+        )
+        return f"{namespace}:{self.generation(namespace)}:{request.path}?{args}"
+
+    def _get(self, key: str) -> Optional[CachedResponse]:
+        entry: Optional[CachedResponse] = self._entries.get(key)
+        if entry is None or entry.expires_at < time.monotonic():
+            return None
+
+        return entry
+
+    def _store(self, key: str, response: Response, ttl: float) -> CachedResponse:
+        body = response.get_data()
+
+        # Hash the payload instead of the whole body so the ETag stays the same
+        # across regenerations, the body also contains a timestamp.
+        data = response.get_json(silent=True)
+        if isinstance(data, dict) and "payload" in data:
+            digest = json.dumps(data["payload"], sort_keys=True, default=str).encode()
+        else:
+            digest = body
+
+        entry = CachedResponse(
+            body=body,
+            status=response.status_code,
+            headers=[
+                (k, v)
+                for k, v in response.headers.items()
+                if k.lower() not in ("content-length", "set-cookie")
+            ],
+            etag=hashlib.sha1(digest).hexdigest(),
+            expires_at=time.monotonic() + ttl,
+        )
+        try:
+            self._entries[key] = entry
+        except ValueError:
+            # The response is larger than the whole cache.
+            pass
+
+        return entry
+
+    def _respond(self, entry: CachedResponse) -> Response:
+        response = Response(entry.body, status=entry.status, headers=entry.headers)
+        response.set_etag(entry.etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.update(("Cookie", "Authorization"))
+
+        return response.make_conditional(request)
+
+    def cached(
+        self, namespace: str, ttl: float, unless: Optional[Callable[[], bool]] = None
+    ) -> Callable:
+        """
+        Cache the responses of a view.
+
+        Parameters
+        ----------
+        `namespace` : str
+            The namespace the responses belong to, used by `invalidate`.
+        `ttl` : float
+            How many seconds a response is served from memory.
+        `unless` : Optional[Callable[[], bool]]
+            When this returns True, the view is called without going through the
+            cache (i.e., for authenticated users).
+        """
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                if request.method != "GET" or (unless is not None and unless()):
+                    return func(*args, **kwargs)
+
+                key = self._key(namespace)
+                entry = self._get(key)
+                if entry is not None:
+                    return self._respond(entry)
+
+                lock = self._locks.setdefault(key, threading.Lock())
+                with lock:
+                    entry = self._get(key)
+                    if entry is None:
+                        g.response_cache_skip = False
+                        response = make_response(func(*args, **kwargs))
+                        if (
+                            g.response_cache_skip
+                            or response.status_code not in CACHEABLE_STATUS_CODES
+                            or response.is_streamed
+                        ):
+                            return response
+
+                        entry = self._store(key, response, ttl)
+
+                return self._respond(entry)
+
+            return inner
+
+        return decorator
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,86 @@
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken:
+
+    """
+    A flag checked by a completion between two chunks of its stream. Once it is
+    cancelled, the completion stops reading and closes the upstream connection.
+    """
+
+    def __init__(self, key: tuple[str, str, str]) -> None:
+        self.key = key
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "stopped") -> None:
+        if self.reason is None:
+            self.reason = reason
+
+
+class CancellationRegistry:
+
+    """
+    The in-flight completions of this process keyed on the user and the chat
+    session (a session ID is only unique per character) they are generated for.
+    """
+
+    def __init__(self) -> None:
+        self._tokens: dict[tuple[str, str, str], CancellationToken] = {}
+        self._lock = threading.Lock()
+
+    def register(
+        self, user_id: str, character_id: str, session_id: str
+    ) -> CancellationToken:
+        """
+        Register a completion, it must be released with `release` once it's done.
+        """
+
+        token = CancellationToken((user_id, character_id, session_id))
+        with self._lock:
+            self._tokens[token.key] = token
+
+        return token
+
+    def release(self, token: CancellationToken) -> None:
+        with self._lock:
+            if self._tokens.get(token.key) is token:
+                del self._tokens[token.key]
+
+    def cancel(
+        self,
+        user_id: str,
+        character_id: str,
+        session_id: str,
+        reason: str = "stopped",
+    ) -> bool:
+        """
+        Cancel the in-flight completion of a session.
+
+        Returns
+        -------
+        `bool` :
+            False if there is no completion to cancel.
+        """
+
+        with self._lock:
+            token = self._tokens.get((user_id, character_id, session_id))
+
+        if token is None:
+            return False
+
+        token.cancel(reason)
+        logger.info(
+            f"Cancelled the completion of session '{session_id}' of '{user_id}' ({reason})."
+        )
+        return True
+
+
+registry = CancellationRegistry()
@@ -0,0 +1,168 @@
+import logging
+import time
+from typing import Optional
+
+from database import get_collection
+from models.message import Message
+from models.session import ChatSession
+from models.summary import ConversationSummary
+
+from library.configlib import config
+
+logger = logging.getLogger(__name__)
+
+# A cascade is an ordered list of (model, query) steps. Dependents always come
+# before the documents they depend on so an interrupted cascade can simply be
+# run again.
+Cascade = list[tuple[type, dict]]
+
+
+def delete_in_batches(
+    model: type,
+    query: dict,
+    batch_size: Optional[int] = None,
+    throttle: Optional[float] = None,
+) -> int:
+    """
+    Delete every document of a model that matches the query using `delete_many` on
+    bounded batches of `_id`s.
+
+    Parameters
+    ----------
+    `model` : type
+        The mongoclass model to delete documents from.
+    `query` : dict
+        The query the documents have to match.
+    `batch_size` : Optional[int]
+        The maximum amount of documents deleted per round trip. Defaults to the
+        `cascade_batch_size` in `config/main.json`.
+    `throttle` : Optional[float]
+        How many seconds to sleep in between batches so large cascades don't
+        saturate the database. Defaults to the `cascade_throttle` in
+        `config/main.json`.
+
+    Returns
+    -------
+    `int` :
+        The amount of documents deleted.
+    """
+
+    batch_size = batch_size or config.main["cascade_batch_size"]
+    if throttle is None:
+        throttle = config.main["cascade_throttle"]
+
+    collection = get_collection(model)
+    deleted = 0
+    while True:
+        ids = [x["_id"] for x in collection.find(query, {"_id": 1}).limit(batch_size)]
+        if not ids:
+            break
+
+        deleted += collection.delete_many({"_id": {"$in": ids}}).deleted_count
+        if len(ids) < batch_size:
+            break
+
+        if throttle:
+            time.sleep(throttle)
+
+    return deleted
+
+
+def run_cascade(
+    cascade: Cascade,
+    batch_size: Optional[int] = None,
+    throttle: Optional[float] = None,
+) -> dict[str, int]:
+    """
+    Run every step of a cascade.
+
+    Returns
+    -------
+    `dict[str, int]` :
+        The amount of documents deleted per model name.
+    """
+
+    counts: dict[str, int] = {}
+    for model, query in cascade:
+        deleted = delete_in_batches(
+            model, query, batch_size=batch_size, throttle=throttle
+        )
+        counts[model.__name__] = counts.get(model.__name__, 0) + deleted
+
+    return counts
+
+
+def chat_session_cascade(query: dict) -> Cascade:
+    """
+    The cascade of a single chat session. The `query` is the same query used to
+    find the `ChatSession` (`id`, `character_id` and `created_by`).
+    """
+
+    dependents_query = {
+        "session_id": query["id"],
+        "character_id": query["character_id"],
+        "created_by": query["created_by"],
+    }
+
+    return [
+        (Message, dependents_query),
+        (ConversationSummary, dependents_query),
+        (ChatSession, query),
+    ]
+
+
+def character_cascade(character_id: str) -> Cascade:
+    """
+    The cascade of a character, including every session, message, memory,
+    knowledge and favorite of it from every user.
+    """
+
+    from models.character import Character, FavoriteCharacter
+    from models.knowledge import Knowledge
+
+    query = {"character_id": character_id}
+
+    return [
+        (Message, query),
+        (ConversationSummary, query),
+        (ChatSession, query),
+        (Knowledge, query),
+        (FavoriteCharacter, query),
+        (Character, {"id": character_id}),
+    ]
+
+
+def user_cascade(user_id: str) -> Cascade:
+    """
+    The cascade of a user account. This includes the cascade of every character
+    the user created as well as everything the user created on other characters.
+    """
+
+    from models.character import Character, FavoriteCharacter
+    from models.knowledge import Knowledge
+    from models.state import UserPlanState
+    from models.user import Application, User
+
+    character_ids = [
+        x["id"]
+        for x in get_collection(Character).find({"created_by": user_id}, {"id": 1})
+    ]
+    characters_query = {"character_id": {"$in": character_ids}}
+    query = {"created_by": user_id}
+
+    return [
+        (Message, characters_query),
+        (ConversationSummary, characters_query),
+        (ChatSession, characters_query),
+        (Knowledge, characters_query),
+        (FavoriteCharacter, characters_query),
+        (Message, query),
+        (ConversationSummary, query),
+        (ChatSession, query),
+        (Knowledge, query),
+        (FavoriteCharacter, {"user_id": user_id}),
+        (Application, {"user_id": user_id}),
+        (UserPlanState, {"id": user_id}),
+        (Character, query),
+        (User, {"id": user_id}),
+    ]
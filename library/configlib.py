@@ -1,11 +1,112 @@
 import json
+import logging
 import os
+import threading
 import time
 from pathlib import Path
-from typing import Optional
+from types import MappingProxyType
+from typing import Any, Callable, Optional
 
 CONFIG_PATH = os.path.join(os.getcwd(), "config")
 
+# How often (in seconds) watched directories are checked for modified files.
+WATCH_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def freeze(value: Any) -> Any:
+    """
+    Recursively convert a parsed JSON value into an immutable one. Dicts become
+    read-only `MappingProxyType`s and lists become tuples.
+    """
+
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+
+    if isinstance(value, list):
+        return tuple(freeze(x) for x in value)
+
+    return value
+
+
+class DirectoryWatcher:
+
+    """
+    Watches the files of a directory by polling their modification times from a
+    background thread (a green thread when eventlet is monkey patched) and calls
+    `on_change` with the paths of the files that changed, got created or deleted.
+
+    The thread is only started once `start()` is called and is restarted
+    automatically in forked processes, such as the celery prefork workers.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        suffix: str,
+        on_change: Callable[[set[str]], None],
+        interval: float = WATCH_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.suffix = suffix
+        self.on_change = on_change
+        self.interval = interval
+
+        self._mtimes = self.scan()
+        self._started = False
+
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._started = False
+
+    def scan(self) -> dict[str, int]:
+        """
+        Return the modification times of every watched file keyed by its path.
+        """
+
+        try:
+            with os.scandir(self.path) as entries:
+                return {
+                    entry.path: entry.stat().st_mtime_ns
+                    for entry in entries
+                    if entry.name.endswith(self.suffix)
+                }
+        except FileNotFoundError:
+            return {}
+
+    def poll(self) -> None:
+        mtimes = self.scan()
+        changed = {
+            path
+            for path in mtimes.keys() | self._mtimes.keys()
+            if mtimes.get(path) != self._mtimes.get(path)
+        }
+        self._mtimes = mtimes
+
+        if changed:
+            logger.info(f"Detected changes in {sorted(changed)}.")
+            self.on_change(changed)
+
+    def start(self) -> None:
+        if self._started:
+            return
+
+        self._started = True
+        threading.Thread(
+            target=self._run, name=f"watcher:{self.path}", daemon=True
+        ).start()
+
+    def _run(self) -> None:
+        while self._started:
+            time.sleep(self.interval)
+
+            try:
+                self.poll()
+            except Exception:
+                logger.exception(f"Error while watching '{self.path}'.")
+
 
 class ConfigManager:
 
@@ -18,28 +119,57 @@ class ConfigManager:
     ```py
     user_data = config.user_data["id"] # Accesses the "id" key in `config/user_data.json`.
     ```
+
+    Every configuration file is parsed ahead of time into an immutable snapshot, so
+    reading a configuration is a plain dict lookup. A `DirectoryWatcher` swaps the
+    snapshot whenever a file changes and increments `version` so caches that
+    depend on the configuration can tell when to invalidate themselves.
     """
 
     def __init__(self, base_path: str = CONFIG_PATH) -> None:
         self.base_path = base_path
+        self.version = 0
 
-        self._cache = {}
+        self._snapshot = MappingProxyType({})
+        self._watcher = DirectoryWatcher(base_path, ".json", self._reload)
+        self._reload()
+
+    def _load(self, path: str) -> Any:
+        with open(path, encoding="utf-8", mode="r") as f:
+            return json.load(f)
+
+    def _reload(self, changed: Optional[set[str]] = None) -> None:
+        snapshot = {}
+        for path in self._watcher.scan():
+            name = Path(path).stem
+            try:
+                snapshot[name] = freeze(self._load(path))
+            except (OSError, ValueError):
+                # Most likely the file is still being written to, keep the
+                # previous value until the next change is detected.
+                logger.exception(f"Error while loading '{path}'.")
+                if name in self._snapshot:
+                    snapshot[name] = self._snapshot[name]
+
+        self._snapshot = MappingProxyType(snapshot)
+        self.version += 1
 
     def _get_config(self, name: str, base_path: Optional[str] = None) -> dict:
-        path = os.path.join(base_path or self.base_path, name + ".json")
+        if base_path is not None and base_path != self.base_path:
+            path = os.path.join(base_path, name + ".json")
+            if not Path(path).exists():
+                raise AttributeError(f"Cannot find '{path}'.")
 
-        if not Path(path).exists():
-            raise AttributeError(f"Cannot find '{path}'.")
+            return freeze(self._load(path))
 
-        cache_details = self._cache.get(path)
-        if cache_details:
-            if time.time() - cache_details["timestamp"] < 1:
-                return cache_details["cache"]
+        self._watcher.start()
 
-        with open(path, encoding="utf-8", mode="r") as f:
-            data = json.load(f)
-            self._cache[path] = {"timestamp": time.time(), "cache": data}
-            return data
+        try:
+            return self._snapshot[name]
+        except KeyError:
+            raise AttributeError(
+                f"Cannot find '{os.path.join(self.base_path, name + '.json')}'."
+            ) from None
 
     def _set_config(
         self, name: str, value: dict, base_path: Optional[str] = None
@@ -52,6 +182,17 @@ class ConfigManager:
         with open(path, encoding="utf-8", mode="w") as f:
             json.dump(value, f, indent=2)
 
+        if path.startswith(self.base_path):
+            self._reload()
+
+    @property
+    def snapshot(self) -> MappingProxyType:
+        """
+        The current immutable snapshot of every configuration file.
+        """
+
+        return self._snapshot
+
     def __getattribute__(self, name: str) -> dict:
         """
         Return a configuration file as a `dict` given its name.
@@ -77,7 +218,7 @@ class ConfigManager:
             If the provided name is not a valid configuration file.
         """
 
-        if name in ("base_path", "_cache"):
+        if name in ("base_path", "version", "_snapshot", "_watcher"):
             object.__setattr__(self, name, value)
         else:
             self._set_config(name, value)
@@ -0,0 +1,188 @@
+import logging
+from typing import Iterable
+
+from database import get_collection
+from models.message import Message
+from models.session import ChatSession
+from models.user import User
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# The denormalized counters on `ChatSession` (`messages_count`) and `User`
+# (`messages_count`, `characters_count`) are incremented in place whenever
+# messages or characters are created or deleted. `repair_counters` recomputes
+# them from scratch in case they ever drift.
+
+REPAIR_BATCH_SIZE = 1000
+
+
+def _increment(amounts: dict[str, int]) -> list[dict]:
+    """
+    An update pipeline that adds `amounts` to counters without taking them below 0.
+    A counter that doesn't exist yet counts as 0.
+    """
+
+    return [
+        {
+            "$set": {
+                k: {"$max": [0, {"$add": [{"$ifNull": [f"${k}", 0]}, v]}]}
+                for k, v in amounts.items()
+            }
+        }
+    ]
+
+
+def increment_messages(
+    session_id: str, character_id: str, created_by: str, amount: int = 1
+) -> None:
+    """
+    Increment the messages counter of a chat session and of the user that owns it.
+    Use a negative `amount` when messages are deleted.
+    """
+
+    if not amount:
+        return
+
+    get_collection(ChatSession).update_one(
+        {"id": session_id, "character_id": character_id, "created_by": created_by},
+        _increment({"messages_count": amount}),
+    )
+    increment_user(created_by, messages_count=amount)
+
+
+def increment_user(user_id: str, **amounts: int) -> None:
+    """
+    Increment the counters of a user (i.e., `messages_count=1`).
+    """
+
+    amounts = {k: v for k, v in amounts.items() if v}
+    if not amounts:
+        return
+
+    get_collection(User).update_one({"id": user_id}, _increment(amounts))
+
+
+def release_messages(query: dict) -> None:
+    """
+    Decrement the user messages counters by the amount of messages matching the
+    query. Call this before the messages are deleted by a cascade that spans many
+    users, the session counters don't matter since the sessions are deleted too.
+    """
+
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": "$created_by", "count": {"$sum": 1}}},
+    ]
+    operations = [
+        UpdateOne({"id": x["_id"]}, _increment({"messages_count": -x["count"]}))
+        for x in get_collection(Message).aggregate(pipeline, allowDiskUse=True)
+    ]
+    _bulk_write(User, operations)
+
+
+def recount_user_messages(*user_ids: str) -> None:
+    """
+    Set the messages counter of users to the amount of messages they have. Unlike
+    `increment_user` this is idempotent, so it's safe to call from a task that may
+    be retried. An increment racing it can be lost, `repair_counters` fixes that.
+    """
+
+    collection = get_collection(Message)
+    operations = [
+        UpdateOne(
+            {"id": x},
+            {"$set": {"messages_count": collection.count_documents({"created_by": x})}},
+        )
+        for x in user_ids
+    ]
+    _bulk_write(User, operations)
+
+
+def _bulk_write(model: type, operations: Iterable[UpdateOne]) -> int:
+    collection = get_collection(model)
+    written = 0
+    batch = []
+    for operation in operations:
+        batch.append(operation)
+        if len(batch) >= REPAIR_BATCH_SIZE:
+            written += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+
+    if batch:
+        written += collection.bulk_write(batch, ordered=False).modified_count
+
+    return written
+
+
+def _repair(
+    model: type,
+    key_fields: tuple[str, ...],
+    counts: dict[tuple, int],
+    counter: str,
+) -> int:
+    """
+    Set `counter` of every document of `model` to its value in `counts` (or 0 if
+    it is missing), only writing the documents whose counter is wrong.
+    """
+
+    projection = {x: 1 for x in key_fields}
+    projection[counter] = 1
+    projection["_id"] = 1
+
+    def operations():
+        for document in get_collection(model).find({}, projection):
+            key = tuple(document.get(x) for x in key_fields)
+            count = counts.get(key, 0)
+            if document.get(counter) != count:
+                yield UpdateOne({"_id": document["_id"]}, {"$set": {counter: count}})
+
+    return _bulk_write(model, operations())
+
+
+def repair_counters() -> dict[str, int]:
+    """
+    Recompute every denormalized counter from the source collections.
+
+    Returns
+    -------
+    `dict[str, int]` :
+        The amount of documents that were fixed per counter.
+    """
+
+    from models.character import Character
+
+    def group(model: type, fields: tuple[str, ...]) -> dict[tuple, int]:
+        pipeline = [
+            {
+                "$group": {
+                    "_id": {x: f"${x}" for x in fields},
+                    "count": {"$sum": 1},
+                }
+            }
+        ]
+        return {
+            tuple(x["_id"].get(f) for f in fields): x["count"]
+            for x in get_collection(model).aggregate(pipeline, allowDiskUse=True)
+        }
+
+    session_fields = ("session_id", "character_id", "created_by")
+    session_counts = group(Message, session_fields)
+    user_messages = group(Message, ("created_by",))
+    user_characters = group(Character, ("created_by",))
+
+    fixed = {
+        "sessions.messages_count": _repair(
+            ChatSession,
+            ("id", "character_id", "created_by"),
+            session_counts,
+            "messages_count",
+        ),
+        "users.messages_count": _repair(User, ("id",), user_messages, "messages_count"),
+        "users.characters_count": _repair(
+            User, ("id",), user_characters, "characters_count"
+        ),
+    }
+
+    logger.info(f"Repaired counters: {fixed}")
+    return fixed
@@ -38,3 +38,35 @@ class MessageIDAlreadyExists(OptitalkException):
 
     def __init__(self, id: str, *args, **kwargs) -> None:
         self.id = id
+
+
+class InvalidImage(OptitalkException):
+    """
+    Raised when an uploaded file is not an image or is too large to be processed.
+    """
+
+    def __init__(self, reason: str, *args, **kwargs) -> None:
+        self.reason = reason
+        super().__init__(reason, *args, **kwargs)
+
+
+class ConcurrencyLimitExceeded(OptitalkException):
+    """
+    Raised when a user already has as many completions in flight as their plan
+    allows.
+    """
+
+    def __init__(self, limit: int, *args, **kwargs) -> None:
+        self.limit = limit
+        super().__init__(*args, **kwargs)
+
+
+class AdmissionTimeout(OptitalkException):
+    """
+    Raised when a completion has waited longer than its plan allows for a free
+    slot.
+    """
+
+    def __init__(self, waited: float, *args, **kwargs) -> None:
+        self.waited = waited
+        super().__init__(*args, **kwargs)
@@ -6,24 +6,18 @@ import random
 import time
 from typing import Optional
 
-import openai
-import tiktoken
 from flask import has_request_context
 from models.open_ai import ChatCompletion, Completion
 from models.user import User
-from openai.util import convert_to_dict
 
-from library import actions, tasks, utils
-from library.security import route_security
+from library import actions, llm, tasks, tracing, utils
+from library.cancellation import CancellationToken
 from library.socketio import socketio
+from library.streams import StreamBuffer
 from library.types import OpenAIFunctionSpec
 
 from .configlib import config
 
-# Set OpenAI API Credentials
-openai.api_key = config.credentials["openai_api_key"]
-
-
 logger = logging.getLogger(__name__)
 
 
@@ -69,21 +63,22 @@ class GPT:
         logger.info("Creating OpenAI text completion...")
 
         st = time.perf_counter()
-        response = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=top_p,
-            frequency_penalty=frequency_penalty,
-            presence_penalty=presence_penalty,
-            **kwargs,
-        )
+        with tracing.span("llm_total", model=model):
+            response = llm.client.completion(
+                model=model,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                **kwargs,
+            )
         et = round((time.perf_counter() - st) * 1000, 2)
 
         completion_data = dict(
             id=response["id"],
-            choices=convert_to_dict(response["choices"]),
+            choices=response["choices"],
             created=datetime.datetime.fromtimestamp(response["created"]),
             model=model,
             object=response["object"],
@@ -129,6 +124,8 @@ class GPT:
         allow_incomplete: bool = True,
         functions: Optional[list[OpenAIFunctionSpec]] = None,
         character_id: Optional[str] = None,
+        stream_buffer: Optional[StreamBuffer] = None,
+        cancel_token: Optional[CancellationToken] = None,
         _previous_completions: Optional[list[ChatCompletion]] = None,
         api_key: Optional[str] = None,  # TODO Remove
         **kwargs,
@@ -141,6 +138,12 @@ class GPT:
         This returns a list because if the completion is cut off due to the token limit,
         it will automatically create a new completion that completes
 
+        When a `stream_buffer` is provided, the tokens are pushed to it as `chunk`
+        events instead of being emitted to the user's Socket.IO room.
+
+        Once `cancel_token` is cancelled, the stream is closed and the completion is
+        returned as is with a "cancelled" `finish_reason`.
+
         Notes
         -----
         - This method does not take into account the amount of tokens in the provided
@@ -155,37 +158,35 @@ class GPT:
         # TODO Uncomment this to get base actions back
         # functions.extend(actions.get_base_actions())
 
-        limit_chat_st = time.perf_counter()
-        old_max_tokens = max_tokens
-        messages_combined, max_tokens = utils.limit_chat_completion_tokens(
-            messages=messages_combined,
-            model=model,
-            max_tokens=max_tokens,
-            functions=functions,
-        )
-        limit_chat_et = time.perf_counter() - limit_chat_st
+        with tracing.span("token_trim", old_max_tokens=max_tokens) as span:
+            messages_combined, max_tokens = utils.limit_chat_completion_tokens(
+                messages=messages_combined,
+                model=model,
+                max_tokens=max_tokens,
+                functions=functions,
+            )
+            if span is not None:
+                span.attributes["new_max_tokens"] = max_tokens
 
         is_request = has_request_context()
         user_id = None
-        ip_address = None
         user: Optional[User] = None
         if is_request:
-            ip_address = route_security.get_client_ip()
             user_id = utils.get_user_id_from_request(anonymous=True)
-            user = User.find_class({"id": user_id})
-
-        tasks.log_time_took_metric.delay(
-            name="limit_chat_completion_tokens",
-            user_id=user_id,
-            duration=limit_chat_et,
-            character_id=character_id,
-            ip_address=ip_address,
-            metadata={"old_max_tokens": old_max_tokens, "new_max_tokens": max_tokens},
+            with tracing.span("identity"):
+                user = User.find_class({"id": user_id})
+
+        prompt_tokens = utils.get_total_tokens_from_messages(
+            messages_combined, functions=functions
+        )
+        function_tokens = utils.count_tokens(
+            utils.format_function_specs_as_typescript_ns(functions)
         )
 
         # Make the request and time it
         st = time.perf_counter()
-        response = openai.ChatCompletion.create(
+        stream = llm.client.stream_chat_completion(
+            tokens=prompt_tokens + function_tokens + max_tokens,
             model=model,
             messages=messages_combined,
             temperature=temperature,
@@ -193,7 +194,6 @@ class GPT:
             top_p=top_p,
             frequency_penalty=frequency_penalty,
             presence_penalty=presence_penalty,
-            stream=True,
             # functions=[x.schema for x in functions],
             api_key=api_key,  # TODO Remove
             **kwargs,
@@ -211,68 +211,77 @@ class GPT:
             if user.plan.id == "basic":
                 fast_response = True
 
-        for chunk in response:
-            completion_id = chunk["id"]
-            finish_reason = chunk["choices"][0]["finish_reason"]
-            created = chunk["created"]
-            delta = chunk["choices"][0]["delta"]
-
-            if "function_call" in delta:
-                if "name" in delta["function_call"]:
-                    function_call["name"] = delta["function_call"]["name"]
-
-                if "arguments" in delta["function_call"]:
-                    function_call["arguments"] += delta["function_call"]["arguments"]
-
-            if finish_reason == "function_call":
-                try:
-                    function_call["arguments"] = ast.literal_eval(
-                        function_call["arguments"]
+        # Leaving the block closes the upstream stream, even on a function call.
+        with stream:
+            for chunk in stream:
+                if cancel_token is not None and cancel_token.cancelled:
+                    finish_reason = "cancelled"
+                    break
+
+                completion_id = chunk["id"]
+                finish_reason = chunk["choices"][0]["finish_reason"]
+                created = chunk["created"]
+                delta = chunk["choices"][0]["delta"]
+
+                if "function_call" in delta:
+                    if "name" in delta["function_call"]:
+                        function_call["name"] = delta["function_call"]["name"]
+
+                    if "arguments" in delta["function_call"]:
+                        function_call["arguments"] += delta["function_call"][
+                            "arguments"
+                        ]
+
+                if finish_reason == "function_call":
+                    try:
+                        function_call["arguments"] = ast.literal_eval(
+                            function_call["arguments"]
+                        )
+                    except Exception:
+                        function_call["arguments"] = {"_ERROR_PARSING": True}
+                    break
+
+                if delta.get("content") is None:
+                    continue
+
+                content = delta.get("content", "")
+                chunks.append(content)
+
+                if stream_buffer is not None:
+                    stream_buffer.push("chunk", {"delta": content})
+                    continue
+
+                if user_id is None:
+                    continue
+
+                # Constantly emit the full output to the frontend
+                with tracing.span("parse"):
+                    comments, contradictions, response = utils.parse_character_response(
+                        "".join(chunks), use_backups=False
                     )
-                except Exception:
-                    function_call["arguments"] = {"_ERROR_PARSING": True}
-                break
-
-            if delta.get("content") is None:
-                continue
-
-            content = delta.get("content", "")
-            chunks.append(content)
-
-            if user_id is None:
-                continue
-
-            # Constantly emit the full output to the frontend
-            comments, contradictions, response = utils.parse_character_response(
-                "".join(chunks), use_backups=False
-            )
-            socketio.emit(
-                "realtime-response",
-                {
-                    "response": response,
-                    "comments": comments,
-                    "contradictions": contradictions,
-                },
-                room=user_id,
-            )
-            # if not fast_response:
-            #     time.sleep(random.uniform(0.05, 0.2))
+                with tracing.span("emit"):
+                    socketio.emit(
+                        "realtime-response",
+                        {
+                            "response": response,
+                            "comments": comments,
+                            "contradictions": contradictions,
+                        },
+                        room=user_id,
+                    )
+                # if not fast_response:
+                #     time.sleep(random.uniform(0.05, 0.2))
 
         result = "".join(chunks)
+        tracing.record("llm_total", st, model=model)
+        if stream.first_token_at is not None:
+            tracing.record("llm_ttft", stream.started_at, stream.first_token_at)
         et = round((time.perf_counter() - st) * 1000, 2)
 
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-
         # Calculate tokens
         completion_tokens = utils.get_total_tokens_from_messages(
             [{"role": "assistant", "content": result}]
         )
-        prompt_tokens = utils.get_total_tokens_from_messages(
-            messages_combined, functions=functions
-        )
-        function_tokens = len(
-            encoding.encode(utils.format_function_specs_as_typescript_ns(functions))
-        )
         total_tokens = completion_tokens + prompt_tokens + function_tokens
 
         completion_data = dict(
@@ -293,7 +302,12 @@ class GPT:
             presence_penalty=presence_penalty,
             messages=messages_combined,
             function_tokens=function_tokens,
-            function_call=function_call if function_call["name"] else None,
+            function_call=(
+                function_call
+                if function_call["name"] and finish_reason != "cancelled"
+                else None
+            ),
+            **stream.timings(completion_tokens),
         )
         completion_object = ChatCompletion(**completion_data)
 
@@ -307,6 +321,9 @@ class GPT:
         logger.debug(
             f"Total Tokens: {completion_object.total_tokens} | Prompt Tokens:{completion_object.prompt_tokens} | Function Tokens: {completion_object.function_tokens} | Completion Tokens: {completion_object.completion_tokens}"
         )
+        logger.debug(
+            f"TTFT: {completion_object.ttft}ms | Tokens/s: {completion_object.tokens_per_second} | Upstream Wait: {completion_object.upstream_wait}ms | Chunk Processing: {completion_object.chunk_processing_time}ms"
+        )
 
         # Save the completion object in the database
         tasks.log_chat_completion.delay(**completion_data)
@@ -333,6 +350,8 @@ class GPT:
                 top_p=top_p,
                 frequency_penalty=frequency_penalty,
                 presence_penalty=presence_penalty,
+                stream_buffer=stream_buffer,
+                cancel_token=cancel_token,
                 _previous_completions=return_value,
                 **kwargs,
             )
@@ -0,0 +1,309 @@
+import dataclasses
+import datetime as dt
+import hashlib
+import io
+import logging
+from typing import IO, Iterator, Optional
+
+from cachetools import TTLCache
+from database import fs
+from gridfs import GridOut
+from PIL import Image, ImageOps
+
+from library.exceptions import InvalidImage
+
+logger = logging.getLogger(__name__)
+
+# The maximum size (in bytes) of an uploaded image.
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+# The maximum amount of pixels of an uploaded image. Pillow refuses to open
+# anything twice as large with a `DecompressionBombError` so a crafted upload can
+# never be decoded.
+MAX_IMAGE_PIXELS = 40_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# The size (in bytes) of the chunks uploads are streamed to GridFS with.
+CHUNK_SIZE = 255 * 1024
+
+# The largest side (in pixels) of a processed avatar original.
+AVATAR_MAX_SIDE = 1024
+
+# The variant the unprocessed upload is stored under until `process_avatar` is
+# done with it.
+RAW_VARIANT = "raw"
+
+# The widths (in pixels) avatars are pre-rendered at. Avatars are squared so this
+# is also their height.
+AVATAR_SIZES = (64, 128, 256, 512)
+
+# The formats avatars are pre-rendered in along with their mimetype.
+AVATAR_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+AVATAR_QUALITY = 82
+
+# The maximum amount of image bytes kept in memory per process. Files are never
+# modified once uploaded so entries only expire to forget deleted files.
+AVATAR_CACHE_SIZE = 32 * 1024 * 1024
+AVATAR_CACHE_TTL = 60 * 60
+
+
+@dataclasses.dataclass
+class CachedImage:
+    data: bytes
+    mimetype: str
+    etag: str
+    last_modified: dt.datetime
+
+
+_avatar_cache: TTLCache = TTLCache(
+    maxsize=AVATAR_CACHE_SIZE, ttl=AVATAR_CACHE_TTL, getsizeof=lambda x: len(x.data)
+)
+
+
+def variant_name(size: int, format: str) -> str:
+    """
+    The name a pre-rendered variant is stored under (i.e., `128.webp`).
+    """
+
+    return f"{size}.{format}"
+
+
+def render_avatar_variants(image: Image.Image) -> Iterator[tuple[str, bytes]]:
+    """
+    Render every avatar variant of an image.
+
+    Parameters
+    ----------
+    `image` : Image.Image
+        The avatar, as returned by `open_bounded`.
+
+    Yields
+    ------
+    `tuple[str, bytes]` :
+        The variant name and the encoded image.
+    """
+
+    # Center crop to a square so every size of a variant looks the same.
+    side = min(image.size)
+    image = ImageOps.fit(image, (side, side), method=Image.Resampling.BICUBIC)
+
+    for size in AVATAR_SIZES:
+        resized = image
+        if side > size:
+            resized = image.resize((size, size), Image.Resampling.LANCZOS)
+
+        for format in AVATAR_FORMATS:
+            output = io.BytesIO()
+            if format == "jpeg":
+                resized.convert("RGB").save(
+                    output,
+                    format="JPEG",
+                    quality=AVATAR_QUALITY,
+                    optimize=True,
+                    progressive=True,
+                )
+            else:
+                resized.save(output, format="WEBP", quality=AVATAR_QUALITY, method=4)
+
+            yield variant_name(size, format), output.getvalue()
+
+
+def validate_image(f: IO, content_length: Optional[int] = None) -> None:
+    """
+    Check that an upload is an image that is small enough to be processed. Only the
+    header of the image is read, nothing is decoded.
+
+    Raises
+    ------
+    `InvalidImage` :
+        If the upload is not an image or is too large.
+    """
+
+    if content_length is not None and content_length > MAX_UPLOAD_SIZE:
+        raise InvalidImage("The image is too large.")
+
+    try:
+        with Image.open(f) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise InvalidImage("The image has too many pixels.") from None
+    except (OSError, SyntaxError, ValueError):
+        raise InvalidImage("The file is not a valid image.") from None
+    finally:
+        f.seek(0)
+
+    if width * height > MAX_IMAGE_PIXELS:
+        raise InvalidImage("The image has too many pixels.")
+
+
+def put_stream(f: IO, max_size: Optional[int] = None, **metadata) -> int:
+    """
+    Stream a file-like object to GridFS in `CHUNK_SIZE` chunks so it never has to
+    be held in memory as a whole.
+
+    Raises
+    ------
+    `InvalidImage` :
+        If more than `max_size` bytes are read, the partial file is removed.
+
+    Returns
+    -------
+    `int` :
+        The amount of bytes written.
+    """
+
+    written = 0
+    with fs.new_file(**metadata) as grid_in:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            written += len(chunk)
+            if max_size is not None and written > max_size:
+                grid_in.abort()
+                raise InvalidImage("The image is too large.")
+
+            grid_in.write(chunk)
+
+    return written
+
+
+def open_bounded(f: IO, max_side: int = AVATAR_MAX_SIDE) -> Image.Image:
+    """
+    Decode an image so its largest side is at most `max_side` pixels while keeping
+    the memory used low. JPEGs are decoded straight at a reduced scale with
+    `Image.draft`, other formats are shrunk by an integer factor with
+    `Image.reduce` before the final resampling.
+    """
+
+    with Image.open(f) as image:
+        image.draft("RGB", (max_side, max_side))
+
+        source = image
+        if source.mode in ("1", "P"):
+            # `reduce` doesn't support palette or bilevel images.
+            has_alpha = "transparency" in source.info
+            source = source.convert("RGBA" if has_alpha else "RGB")
+
+        factor = max(source.size) // max_side
+        if factor >= 2:
+            reduced = source.reduce(factor)
+        else:
+            reduced = source.copy()
+
+    reduced.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    reduced = ImageOps.exif_transpose(reduced)
+    if reduced.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in reduced.mode or "transparency" in reduced.info
+        reduced = reduced.convert("RGBA" if has_alpha else "RGB")
+
+    return reduced
+
+
+def process_avatar(file_id: str) -> Optional[list[str]]:
+    """
+    Turn the raw upload of an avatar into its processed original and every variant
+    of it, then remove the raw upload.
+
+    Returns
+    -------
+    `Optional[list[str]]` :
+        The names of the stored variants or None if there is no raw upload.
+    """
+
+    raw: Optional[GridOut] = fs.find_one({"id": file_id, "variant": RAW_VARIANT})
+    if raw is None:
+        return None
+
+    image = open_bounded(raw)
+
+    # Remove what an interrupted run might have left behind.
+    for x in fs.find({"id": file_id, "variant": {"$ne": RAW_VARIANT}}):
+        fs.delete(x._id)
+
+    original = io.BytesIO()
+    image.convert("RGB").save(
+        original, format="JPEG", quality=AVATAR_QUALITY, optimize=True
+    )
+    original.seek(0)
+    put_stream(original, id=file_id, contentType="image/jpeg")
+
+    variants = []
+    for name, data in render_avatar_variants(image):
+        put_stream(
+            io.BytesIO(data),
+            id=file_id,
+            variant=name,
+            contentType=AVATAR_FORMATS[name.split(".")[1]],
+        )
+        variants.append(name)
+
+    fs.delete(raw._id)
+    forget_avatar(file_id)
+
+    return variants
+
+
+def pick_avatar_variant(
+    variants: list[str], size: Optional[int], accept_webp: bool
+) -> Optional[str]:
+    """
+    Pick the smallest stored variant that is at least `size` pixels wide, or the
+    largest one if none are. Returns None if the original should be served.
+    """
+
+    if size is None or not variants:
+        return None
+
+    format = "webp" if accept_webp else "jpeg"
+    sizes = sorted(int(x.split(".")[0]) for x in variants if x.endswith(f".{format}"))
+    if not sizes:
+        return None
+
+    chosen = next((x for x in sizes if x >= size), sizes[-1])
+    return variant_name(chosen, format)
+
+
+def load_avatar(
+    file_id: str, variant: Optional[str], mimetype: Optional[str]
+) -> Optional[CachedImage]:
+    """
+    Load an avatar (or one of its variants) from the in-process cache or GridFS.
+    """
+
+    key = (file_id, variant)
+    image = _avatar_cache.get(key)
+    if image is not None:
+        return image
+
+    grid_out = fs.find_one({"id": file_id, "variant": variant})
+    if grid_out is None:
+        return None
+
+    data = grid_out.read()
+    image = CachedImage(
+        data=data,
+        mimetype=getattr(grid_out, "contentType", None)
+        or mimetype
+        or "application/octet-stream",
+        etag=hashlib.sha1(data).hexdigest(),
+        last_modified=grid_out.upload_date,
+    )
+    try:
+        _avatar_cache[key] = image
+    except ValueError:
+        # Larger than the whole cache.
+        pass
+
+    return image
+
+
+def forget_avatar(file_id: str) -> None:
+    """
+    Drop every cached variant of an avatar from this process.
+    """
+
+    for key in [x for x in _avatar_cache.keys() if x[0] == file_id]:
+        _avatar_cache.pop(key, None)
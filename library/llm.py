@@ -0,0 +1,422 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Iterator, Optional, Union
+
+import requests
+from flask import has_request_context
+from openai import error
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from library import ratelimit
+from library.configlib import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+class CompletionStream:
+
+    """
+    An iterator over the chunks of a streamed completion. Server-sent events are
+    parsed as they arrive, so every read is bounded by the read timeout of the
+    client and the whole stream by `deadline`.
+
+    Closing the stream (or leaving its `with` block) releases the connection back
+    to the pool, even when the upstream is still generating.
+
+    The time spent waiting on the upstream (inside `__next__`) is tracked apart
+    from the time spent by the caller between two chunks, see `timings`.
+    """
+
+    def __init__(
+        self,
+        response: requests.Response,
+        deadline: float,
+        started_at: Optional[float] = None,
+    ) -> None:
+        self.response = response
+        self.deadline = deadline
+        self.headers = response.headers
+
+        # `text/event-stream` has no charset so requests would assume latin-1.
+        response.encoding = "utf-8"
+        self._lines = response.iter_lines(decode_unicode=True)
+        self._closed = False
+
+        # All of these are `time.perf_counter` values or durations in seconds.
+        now = time.perf_counter()
+        self.started_at = started_at or now
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.upstream_wait = now - self.started_at
+        self.processing_time = 0.0
+        self.max_gap = 0.0
+        self._gaps_total = 0.0
+        self._gaps = 0
+        self._returned_at: Optional[float] = None
+
+    def __iter__(self) -> Iterator[dict]:
+        return self
+
+    def __next__(self) -> dict:
+        entered_at = time.perf_counter()
+        if self._returned_at is not None:
+            self.processing_time += entered_at - self._returned_at
+            self._returned_at = None
+
+        try:
+            chunk = self._next_chunk()
+        finally:
+            self.upstream_wait += time.perf_counter() - entered_at
+
+        received_at = time.perf_counter()
+        if _has_content(chunk):
+            if self.last_token_at is None:
+                self.first_token_at = received_at
+            else:
+                gap = received_at - self.last_token_at
+                self.max_gap = max(self.max_gap, gap)
+                self._gaps_total += gap
+                self._gaps += 1
+            self.last_token_at = received_at
+
+        self._returned_at = received_at
+        return chunk
+
+    def _next_chunk(self) -> dict:
+        while not self._closed:
+            if time.monotonic() > self.deadline:
+                self.close()
+                raise error.Timeout("The completion stream exceeded its deadline.")
+
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            except requests.RequestException as e:
+                self.close()
+                raise _connection_error(e) from e
+
+            if not line or not line.startswith("data:"):
+                continue
+
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                break
+
+            chunk = json.loads(data)
+            if "error" in chunk:
+                self.close()
+                raise error.APIError(chunk["error"].get("message"), json_body=chunk)
+
+            return chunk
+
+        self.close()
+        raise StopIteration
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self.response.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def timings(self, completion_tokens: Optional[int] = None) -> dict:
+        """
+        The timings of the stream so far, in milliseconds.
+
+        Returns
+        -------
+        `dict` :
+            - `ttft`: The time from the request to the first token.
+            - `max_chunk_gap` and `mean_chunk_gap`: The gaps between two tokens.
+            - `tokens_per_second`: The rate tokens were received at after the first
+            one, only if `completion_tokens` is provided.
+            - `upstream_wait`: The time spent waiting on the upstream.
+            - `chunk_processing_time`: The time spent by the caller on the chunks.
+        """
+
+        def ms(seconds: Optional[float]) -> Optional[float]:
+            return None if seconds is None else round(seconds * 1000, 2)
+
+        tokens_per_second = None
+        if completion_tokens and self.first_token_at is not None:
+            generation_time = self.last_token_at - self.first_token_at
+            if generation_time > 0:
+                tokens_per_second = round(
+                    max(completion_tokens - 1, 0) / generation_time, 2
+                )
+
+        return {
+            "ttft": ms(
+                self.first_token_at - self.started_at
+                if self.first_token_at is not None
+                else None
+            ),
+            "max_chunk_gap": ms(self.max_gap if self._gaps else None),
+            "mean_chunk_gap": ms(self._gaps_total / self._gaps if self._gaps else None),
+            "tokens_per_second": tokens_per_second,
+            "upstream_wait": ms(self.upstream_wait),
+            "chunk_processing_time": ms(self.processing_time),
+        }
+
+    def __enter__(self) -> "CompletionStream":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def _has_content(chunk: dict) -> bool:
+    choices = chunk.get("choices") or [{}]
+    return bool(choices[0].get("delta", {}).get("content") or choices[0].get("text"))
+
+
+def _connection_error(e: requests.RequestException) -> error.OpenAIError:
+    if isinstance(e, requests.Timeout):
+        return error.Timeout(f"Request to the OpenAI API timed out: {e}")
+
+    return error.APIConnectionError(f"Error communicating with the OpenAI API: {e}")
+
+
+def _response_error(response: requests.Response) -> error.OpenAIError:
+    """
+    Map an error response to the `openai.error` class the legacy client raises, so
+    existing `except` clauses keep working.
+    """
+
+    try:
+        json_body = response.json()
+        message = json_body["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        json_body = None
+        message = response.text
+
+    kwargs = dict(
+        http_body=response.text,
+        http_status=response.status_code,
+        json_body=json_body,
+        headers=response.headers,
+    )
+    status = response.status_code
+    if status == 429:
+        return error.RateLimitError(message, **kwargs)
+    if status == 401:
+        return error.AuthenticationError(message, **kwargs)
+    if status == 403:
+        return error.PermissionError(message, **kwargs)
+    if status in (400, 404, 409, 415):
+        return error.InvalidRequestError(message, None, **kwargs)
+    if status == 503:
+        return error.ServiceUnavailableError(message, **kwargs)
+
+    return error.APIError(message, **kwargs)
+
+
+class LLMClient:
+
+    """
+    A thin client for the OpenAI HTTP API that every completion, moderation and
+    embedding call goes through.
+
+    Requests share a pooled `requests.Session` so connections (and their TLS
+    handshakes) are reused, and every request has explicit connect and read
+    timeouts. Sockets are green when eventlet is monkey patched, so a waiting or
+    streaming request only blocks its own green thread.
+
+    The timeouts and pool size are read from `config/main.json` and the API base
+    can be pointed somewhere else (i.e., a mock server) with `OPENAI_API_BASE`.
+    """
+
+    def __init__(self, api_base: Optional[str] = None) -> None:
+        self.api_base = (
+            api_base or os.getenv("OPENAI_API_BASE") or DEFAULT_API_BASE
+        ).rstrip("/")
+
+        self._session: Optional[requests.Session] = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        # Pooled connections must never be shared with a forked process.
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            # Completions are POSTs that cost money, so they're only retried when
+            # the upstream certainly didn't process them: the connection failed or
+            # it answered 503 (overloaded). A 502 or 504 may come after the
+            # completion was generated and retrying it would pay for it twice.
+            retries = Retry(
+                total=config.main["llm_max_retries"],
+                connect=config.main["llm_max_retries"],
+                read=0,
+                status_forcelist=(503,),
+                allowed_methods=None,
+                backoff_factor=0.5,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=config.main["llm_pool_size"],
+                max_retries=retries,
+            )
+
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+
+        return self._session
+
+    def request(
+        self,
+        path: str,
+        payload: dict,
+        stream: bool = False,
+        api_key: Optional[str] = None,
+        read_timeout: Optional[float] = None,
+        tokens: Optional[int] = None,
+    ) -> requests.Response:
+        """
+        Send a POST request to the API once the rate limiter lets it through.
+        Requests made outside of a flask request (i.e., from celery) have the
+        background priority.
+
+        `tokens` is the estimated tokens of the request, if it's not provided it is
+        approximated from the size of the payload.
+
+        Raises
+        ------
+        `openai.error.OpenAIError` :
+            The same errors the legacy `openai` client raises.
+        """
+
+        api_key = api_key or config.credentials["openai_api_key"]
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+
+        account = hashlib.sha1(api_key.encode()).hexdigest()[:12]
+        model = payload.get("model") or path.strip("/")
+        if tokens is None:
+            # Roughly 4 characters per token.
+            tokens = len(json.dumps(payload)) // 4 + payload.get("max_tokens", 0)
+
+        ratelimit.limiter.acquire(
+            account,
+            model,
+            tokens,
+            priority=(
+                ratelimit.INTERACTIVE if has_request_context() else ratelimit.BACKGROUND
+            ),
+        )
+        timeout = (
+            config.main["llm_connect_timeout"],
+            read_timeout or config.main["llm_read_timeout"],
+        )
+
+        try:
+            response = self.session.post(
+                f"{self.api_base}{path}",
+                json=payload,
+                headers=headers,
+                timeout=timeout,
+                stream=stream,
+            )
+        except requests.RequestException as e:
+            raise _connection_error(e) from e
+
+        if response.status_code == 429:
+            ratelimit.limiter.exhaust(account, model)
+        else:
+            ratelimit.limiter.observe(account, model, response.headers)
+
+        if response.status_code >= 400:
+            try:
+                raise _response_error(response)
+            finally:
+                response.close()
+
+        return response
+
+    def _post(self, path: str, payload: dict, api_key: Optional[str] = None) -> dict:
+        response = self.request(path, payload, api_key=api_key)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise error.APIError(
+                f"Invalid response from the OpenAI API: {response.text}"
+            ) from e
+
+    def _stream(
+        self,
+        path: str,
+        payload: dict,
+        api_key: Optional[str] = None,
+        tokens: Optional[int] = None,
+    ):
+        started_at = time.perf_counter()
+        response = self.request(
+            path,
+            {**payload, "stream": True},
+            stream=True,
+            api_key=api_key,
+            tokens=tokens,
+        )
+        return CompletionStream(
+            response,
+            time.monotonic() + config.main["llm_stream_deadline"],
+            started_at=started_at,
+        )
+
+    def chat_completion(self, api_key: Optional[str] = None, **params: Any) -> dict:
+        return self._post("/chat/completions", params, api_key=api_key)
+
+    def stream_chat_completion(
+        self, api_key: Optional[str] = None, tokens: Optional[int] = None, **params: Any
+    ) -> CompletionStream:
+        return self._stream("/chat/completions", params, api_key=api_key, tokens=tokens)
+
+    def completion(self, api_key: Optional[str] = None, **params: Any) -> dict:
+        return self._post("/completions", params, api_key=api_key)
+
+    def moderation(
+        self, input: Union[str, list[str]], api_key: Optional[str] = None
+    ) -> dict:
+        """
+        Moderate a text or a list of texts, the results are in the same order as the
+        inputs.
+        """
+
+        return self._post("/moderations", {"input": input}, api_key=api_key)
+
+    def embedding(
+        self,
+        text: str,
+        model: str = DEFAULT_EMBEDDING_MODEL,
+        api_key: Optional[str] = None,
+    ) -> list[float]:
+        """
+        Get the embedding of a text, same as `openai.embeddings_utils.get_embedding`.
+        """
+
+        # Newlines can negatively affect performance.
+        text = text.replace("\n", " ")
+        response = self._post(
+            "/embeddings", {"input": [text], "model": model}, api_key=api_key
+        )
+
+        return response["data"][0]["embedding"]
+
+
+client = LLMClient()
@@ -0,0 +1,268 @@
+import logging
+import os
+import threading
+import time
+from typing import Mapping, Optional
+
+import redis
+from openai import error
+
+from library import tracing
+from library.configlib import config
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Buckets are refilled continuously, from empty to full in a minute. Background
+# requests must leave `reserve` (a fraction of the capacity) in the buckets so
+# interactive requests always find some. The costs are clamped to what a request
+# may take from a full bucket (the capacity minus the reserve) so a single large
+# request can't wait forever.
+#
+# KEYS: the requests bucket, the tokens bucket
+# ARGV: requests capacity, tokens capacity, tokens cost, reserve
+# Returns the seconds to wait before trying again or 0 if the request may proceed.
+_ACQUIRE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+local costs = {1, tonumber(ARGV[3])}
+local levels = {}
+local wait = 0
+for i = 1, 2 do
+    local capacity = tonumber(ARGV[i])
+    local cost = math.min(costs[i], capacity * (1 - tonumber(ARGV[4])))
+    local state = redis.call("HMGET", KEYS[i], "level", "updated_at")
+    local level = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+
+    level = math.min(capacity, level + (now - updated_at) * capacity / 60)
+    levels[i] = level - cost
+
+    local missing = cost + capacity * tonumber(ARGV[4]) - level
+    if missing > 0 then
+        wait = math.max(wait, missing * 60 / capacity)
+    end
+end
+
+if wait > 0 then
+    return tostring(wait)
+end
+
+for i = 1, 2 do
+    redis.call("HSET", KEYS[i], "level", levels[i], "updated_at", now)
+    redis.call("EXPIRE", KEYS[i], 120)
+end
+return "0"
+"""
+
+# Lower the buckets to what the upstream says is remaining.
+#
+# KEYS: the requests bucket, the tokens bucket
+# ARGV: requests capacity, tokens capacity, remaining requests, remaining tokens
+_OBSERVE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+for i = 1, 2 do
+    local remaining = tonumber(ARGV[i + 2])
+    if remaining then
+        local capacity = tonumber(ARGV[i])
+        local state = redis.call("HMGET", KEYS[i], "level", "updated_at")
+        local level = tonumber(state[1]) or capacity
+        local updated_at = tonumber(state[2]) or now
+
+        level = math.min(capacity, level + (now - updated_at) * capacity / 60)
+        redis.call("HSET", KEYS[i], "level", math.min(level, remaining), "updated_at", now)
+        redis.call("EXPIRE", KEYS[i], 120)
+    end
+end
+return 0
+"""
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+
+    """
+    A token bucket of the OpenAI requests and tokens per minute of every model,
+    shared by the web and celery processes through Redis (`REDIS_URI`).
+
+    Every call to the API takes one request and its estimated tokens from the
+    buckets of its model first, waiting for them to refill if needed. The buckets
+    are then lowered to the `x-ratelimit-remaining-*` headers of the response, and
+    emptied on a 429 so every process backs off until they refill.
+
+    Limits come from `config/openai_rate_limits.json` until the upstream reports
+    them in the `x-ratelimit-limit-*` headers. Without `REDIS_URI`, nothing is
+    limited.
+    """
+
+    def __init__(self, uri: Optional[str] = None) -> None:
+        self.uri = uri or os.getenv("REDIS_URI")
+
+        self._client: Optional[redis.Redis] = None
+        self._limits: dict[tuple[str, str], tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+        if not self.uri:
+            logger.info("REDIS_URI is not set, OpenAI requests won't be rate limited.")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.uri)
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    client = redis.Redis.from_url(self.uri, socket_timeout=1)
+                    self._acquire = client.register_script(_ACQUIRE_SCRIPT)
+                    self._observe = client.register_script(_OBSERVE_SCRIPT)
+                    self._client = client
+
+        return self._client
+
+    def _keys(self, account: str, model: str) -> list[str]:
+        return [
+            f"ratelimit:{account}:{model}:requests",
+            f"ratelimit:{account}:{model}:tokens",
+        ]
+
+    def limits(self, account: str, model: str) -> tuple[int, int]:
+        """
+        The requests and tokens per minute of a model.
+        """
+
+        if (account, model) in self._limits:
+            return self._limits[(account, model)]
+
+        limits = config.openai_rate_limits.get(
+            model, config.openai_rate_limits["default"]
+        )
+        return limits["requests_per_minute"], limits["tokens_per_minute"]
+
+    def acquire(
+        self, account: str, model: str, tokens: int, priority: str = INTERACTIVE
+    ) -> None:
+        """
+        Wait until a request of `tokens` tokens can be sent to a model. Redis errors
+        are logged and let the request through.
+
+        Parameters
+        ----------
+        `account` : str
+            Identifies the API key, each key has its own limits.
+        `model` : str
+            The model (or the endpoint, i.e., "moderations") of the request.
+        `tokens` : int
+            The estimated tokens of the request, including the `max_tokens` of the
+            completion.
+        `priority` : str
+            Either `INTERACTIVE` or `BACKGROUND`.
+
+        Raises
+        ------
+        `openai.error.RateLimitError` :
+            If the buckets didn't refill within `llm_rate_limit_max_wait` (or
+            `llm_background_rate_limit_max_wait`) seconds.
+        """
+
+        if not self.enabled:
+            return
+
+        if priority == BACKGROUND:
+            reserve = config.main["llm_background_reserve"]
+            max_wait = config.main["llm_background_rate_limit_max_wait"]
+        else:
+            reserve = 0
+            max_wait = config.main["llm_rate_limit_max_wait"]
+
+        st = time.perf_counter()
+        waited = 0.0
+        while True:
+            try:
+                client = self.client
+                wait = float(
+                    self._acquire(
+                        keys=self._keys(account, model),
+                        args=[*self.limits(account, model), tokens, reserve],
+                        client=client,
+                    )
+                )
+            except redis.RedisError:
+                logger.warning("Rate limiting is unavailable.", exc_info=True)
+                return
+
+            if not wait:
+                if waited:
+                    tracing.record("rate_limit_wait", st, model=model)
+                return
+
+            waited = time.perf_counter() - st
+            if waited + wait > max_wait:
+                raise error.RateLimitError(
+                    f"The OpenAI rate limit of '{model}' is exhausted, try again later."
+                )
+
+            logger.debug(f"Waiting {wait:.2f}s for the '{model}' rate limit.")
+            time.sleep(min(wait, 1.0))
+
+    def observe(self, account: str, model: str, headers: Mapping[str, str]) -> None:
+        """
+        Sync the buckets of a model with the rate limit headers of a response.
+        """
+
+        if not self.enabled:
+            return
+
+        limit_requests = _parse_int(headers.get("x-ratelimit-limit-requests"))
+        limit_tokens = _parse_int(headers.get("x-ratelimit-limit-tokens"))
+        if limit_requests and limit_tokens:
+            self._limits[(account, model)] = (limit_requests, limit_tokens)
+
+        remaining = [
+            _parse_int(headers.get("x-ratelimit-remaining-requests")),
+            _parse_int(headers.get("x-ratelimit-remaining-tokens")),
+        ]
+        if remaining == [None, None]:
+            return
+
+        try:
+            client = self.client
+            self._observe(
+                keys=self._keys(account, model),
+                args=[
+                    *self.limits(account, model),
+                    *("" if x is None else x for x in remaining),
+                ],
+                client=client,
+            )
+        except redis.RedisError:
+            logger.warning("Rate limiting is unavailable.", exc_info=True)
+
+    def exhaust(self, account: str, model: str) -> None:
+        """
+        Empty the buckets of a model after a 429.
+        """
+
+        self.observe(
+            account,
+            model,
+            {
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-remaining-tokens": "0",
+            },
+        )
+
+
+limiter = RateLimiter()
@@ -0,0 +1,558 @@
+import datetime as dt
+import logging
+import math
+from typing import Optional
+
+from database import get_collection
+from models.metric import CompletionRollup
+from models.open_ai import ChatCompletion, Completion
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, UpdateOne
+
+from library.configlib import config
+
+logger = logging.getLogger(__name__)
+
+# Relative accuracy of the quantile sketch. Every value is stored in a logarithmic
+# bucket so that any estimated quantile is within 1% of the real value.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_ZERO_KEY = "z"
+
+METRICS = ("tokens", "cost", "latency")
+
+# Only streamed chat completions have these, see `CompletionStream.timings`.
+STREAM_METRICS = (
+    "ttft",
+    "max_chunk_gap",
+    "mean_chunk_gap",
+    "tokens_per_second",
+    "upstream_wait",
+    "chunk_processing_time",
+)
+
+GRANULARITIES = ("hour", "day", "month")
+
+# The amount of rollups `rebuild_rollups` replaces per round trip.
+REBUILD_BATCH_SIZE = 1000
+
+_indexes_created = False
+
+
+def _collection():
+    global _indexes_created
+
+    collection = get_collection(CompletionRollup)
+    if not _indexes_created:
+        collection.create_index(
+            [
+                ("kind", ASCENDING),
+                ("granularity", ASCENDING),
+                ("bucket", ASCENDING),
+                ("model", ASCENDING),
+            ],
+            unique=True,
+        )
+        _indexes_created = True
+
+    return collection
+
+
+def truncate(timestamp: dt.datetime, granularity: str) -> dt.datetime:
+    """
+    Truncate a timestamp to the start of its hour, day or month bucket.
+    """
+
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return day
+
+    return day.replace(day=1)
+
+
+def ceil(timestamp: dt.datetime, granularity: str) -> dt.datetime:
+    """
+    Return the start of the first hour, day or month bucket that starts at or after
+    the timestamp.
+    """
+
+    bucket = truncate(timestamp, granularity)
+    if bucket == timestamp:
+        return bucket
+
+    if granularity == "hour":
+        return bucket + dt.timedelta(hours=1)
+    if granularity == "day":
+        return bucket + dt.timedelta(days=1)
+
+    return (bucket + dt.timedelta(days=32)).replace(day=1)
+
+
+def completion_cost(model: str, tokens: int) -> float:
+    """
+    Same as `GPT.calculate_completion_cost` but returns 0 for models without a
+    configured cost instead of raising since rollups should never fail a task.
+    """
+
+    return (tokens / 1000) * config.openai_model_costs.get(model, 0)
+
+
+def sketch_key(value: float) -> str:
+    """
+    Return the key of the sketch bucket the provided value belongs to.
+    """
+
+    if value <= 0:
+        return SKETCH_ZERO_KEY
+
+    return str(math.ceil(math.log(value) / SKETCH_LOG_GAMMA))
+
+
+def sketch_quantile(sketch: dict[str, int], q: float) -> Optional[float]:
+    """
+    Estimate the `q` quantile (0 to 1) of the values that were added to a sketch.
+    """
+
+    total = sum(sketch.values())
+    if not total:
+        return None
+
+    keys = sorted(
+        sketch.keys(),
+        key=lambda x: -math.inf if x == SKETCH_ZERO_KEY else int(x),
+    )
+    rank = q * (total - 1)
+    seen = 0
+    for key in keys:
+        seen += sketch[key]
+        if seen > rank:
+            break
+
+    if key == SKETCH_ZERO_KEY:
+        return 0.0
+
+    return 2 * SKETCH_GAMMA ** int(key) / (SKETCH_GAMMA + 1)
+
+
+def record_completion(
+    kind: str, model: str, created: dt.datetime, **values: Optional[float]
+) -> None:
+    """
+    Add a single completion to its hourly, daily and monthly rollups. This is a
+    single round trip regardless of how many metrics are provided.
+
+    Parameters
+    ----------
+    `kind` : str
+        Either "chat" or "text".
+    `model` : str
+        The model that generated the completion.
+    `created` : dt.datetime
+        When the completion was created.
+    `**values` : Optional[float]
+        The metrics to record (i.e., `tokens`, `cost`, `latency`). `None` values are
+        ignored.
+    """
+
+    inc = {"count": 1}
+    minimums = {}
+    maximums = {}
+    for metric, value in values.items():
+        if value is None:
+            continue
+
+        inc[f"{metric}.count"] = 1
+        inc[f"{metric}.sum"] = value
+        inc[f"{metric}.sketch.{sketch_key(value)}"] = 1
+        minimums[f"{metric}.min"] = value
+        maximums[f"{metric}.max"] = value
+
+    operations = []
+    for granularity in GRANULARITIES:
+        operations.append(
+            UpdateOne(
+                {
+                    "kind": kind,
+                    "model": model,
+                    "granularity": granularity,
+                    "bucket": truncate(created, granularity),
+                },
+                {"$inc": inc, "$min": minimums, "$max": maximums},
+                upsert=True,
+            )
+        )
+
+    _collection().bulk_write(operations, ordered=False)
+
+
+def merge_stats(a: dict, b: dict) -> dict:
+    """
+    Merge two metric stats (`count`, `sum`, `min`, `max`, `sketch`) together.
+    """
+
+    if not a:
+        return {**b, "sketch": dict(b.get("sketch", {}))}
+    if not b:
+        return a
+
+    sketch = dict(a.get("sketch", {}))
+    for key, count in b.get("sketch", {}).items():
+        sketch[key] = sketch.get(key, 0) + count
+
+    minimums = [x for x in (a.get("min"), b.get("min")) if x is not None]
+    maximums = [x for x in (a.get("max"), b.get("max")) if x is not None]
+
+    return {
+        "count": a.get("count", 0) + b.get("count", 0),
+        "sum": a.get("sum", 0) + b.get("sum", 0),
+        "min": min(minimums) if minimums else None,
+        "max": max(maximums) if maximums else None,
+        "sketch": sketch,
+    }
+
+
+def summarize_stats(stats: dict, include_total: bool = True) -> dict:
+    """
+    Turn merged metric stats into the shape returned by the metrics endpoint.
+    """
+
+    count = stats.get("count", 0)
+    sketch = stats.get("sketch", {})
+    data = {
+        "average": stats["sum"] / count if count else None,
+        "minimum": stats.get("min"),
+        "maximum": stats.get("max"),
+        "p50": sketch_quantile(sketch, 0.5),
+        "p95": sketch_quantile(sketch, 0.95),
+        "p99": sketch_quantile(sketch, 0.99),
+    }
+    if include_total:
+        data["total"] = stats.get("sum", 0)
+
+    return data
+
+
+def _range_query(
+    start: Optional[dt.datetime], end: Optional[dt.datetime]
+) -> list[dict]:
+    """
+    Split a time range into the month buckets it fully covers, the day buckets
+    around them and the hour buckets at its edges. Any range is answered with at
+    most 23 + 30 + 30 + 23 hour and day documents per model on top of one document
+    per month, so the cost only grows with the amount of months in the range.
+    """
+
+    end = end or dt.datetime.now()
+    end_month = truncate(end, "month")
+    end_day = truncate(end, "day")
+
+    if start is None:
+        return [
+            {"granularity": "month", "bucket": {"$lt": end_month}},
+            {"granularity": "day", "bucket": {"$gte": end_month, "$lt": end_day}},
+            {"granularity": "hour", "bucket": {"$gte": end_day, "$lt": end}},
+        ]
+
+    start_hour = truncate(start, "hour")
+    start_day = ceil(start, "day")
+    start_month = ceil(start, "month")
+
+    if start_month < end_month:
+        return [
+            {"granularity": "hour", "bucket": {"$gte": start_hour, "$lt": start_day}},
+            {"granularity": "day", "bucket": {"$gte": start_day, "$lt": start_month}},
+            {
+                "granularity": "month",
+                "bucket": {"$gte": start_month, "$lt": end_month},
+            },
+            {"granularity": "day", "bucket": {"$gte": end_month, "$lt": end_day}},
+            {"granularity": "hour", "bucket": {"$gte": end_day, "$lt": end}},
+        ]
+
+    if start_day < end_day:
+        return [
+            {"granularity": "hour", "bucket": {"$gte": start_hour, "$lt": start_day}},
+            {"granularity": "day", "bucket": {"$gte": start_day, "$lt": end_day}},
+            {"granularity": "hour", "bucket": {"$gte": end_day, "$lt": end}},
+        ]
+
+    return [{"granularity": "hour", "bucket": {"$gte": start_hour, "$lt": end}}]
+
+
+def read_rollups(
+    kind: str,
+    start: Optional[dt.datetime] = None,
+    end: Optional[dt.datetime] = None,
+) -> dict[str, dict]:
+    """
+    Read the merged rollups of every model for the provided time range.
+
+    Returns
+    -------
+    `dict[str, dict]` :
+        A mapping of model names to their merged `count` and metric stats.
+    """
+
+    query = {"kind": kind, "$or": _range_query(start, end)}
+
+    models: dict[str, dict] = {}
+    for rollup in _collection().find(query, {"_id": 0}):
+        merged = models.setdefault(rollup["model"], {"count": 0})
+        merged["count"] += rollup.get("count", 0)
+        for metric, stats in rollup.items():
+            if isinstance(stats, dict):
+                merged[metric] = merge_stats(merged.get(metric, {}), stats)
+
+    return models
+
+
+def summarize_rollups(models: dict[str, dict]) -> dict:
+    """
+    Summarize the rollups returned by `read_rollups` for the metrics endpoint.
+    """
+
+    overall: dict[str, dict] = {}
+    for rollup in models.values():
+        for metric, stats in rollup.items():
+            if isinstance(stats, dict):
+                overall[metric] = merge_stats(overall.get(metric, {}), stats)
+
+    usage = {model: rollup["count"] for model, rollup in models.items()}
+    payload = {
+        "count": sum(usage.values()),
+        "tokens": summarize_stats(overall.get("tokens", {})),
+        "cost": summarize_stats(overall.get("cost", {})),
+        "response_times": summarize_stats(
+            overall.get("latency", {}), include_total=False
+        ),
+        "models": {
+            "least_used": min(usage, key=usage.get) if usage else None,
+            "most_used": max(usage, key=usage.get) if usage else None,
+            "usage": usage,
+        },
+    }
+
+    for metric, stats in overall.items():
+        if metric not in METRICS:
+            payload[metric] = summarize_stats(stats, include_total=False)
+
+    return payload
+
+
+def _sketch_key_expression(field: str) -> dict:
+    # Missing and null values (i.e., the stream metrics of text completions) have
+    # no key, anything that is a number sorts above null.
+    return {
+        "$cond": [
+            {"$gt": [field, None]},
+            {
+                "$cond": [
+                    {"$gt": [field, 0]},
+                    {
+                        "$toString": {
+                            "$toLong": {
+                                "$ceil": {"$divide": [{"$ln": field}, SKETCH_LOG_GAMMA]}
+                            }
+                        }
+                    },
+                    SKETCH_ZERO_KEY,
+                ]
+            },
+            None,
+        ]
+    }
+
+
+def _sketch_expression(keys_field: str) -> dict:
+    return {
+        "$arrayToObject": {
+            "$map": {
+                "input": {"$setDifference": [{"$setUnion": [keys_field, []]}, [None]]},
+                "as": "key",
+                "in": {
+                    "k": "$$key",
+                    "v": {
+                        "$size": {
+                            "$filter": {
+                                "input": keys_field,
+                                "cond": {"$eq": ["$$this", "$$key"]},
+                            }
+                        }
+                    },
+                },
+            }
+        }
+    }
+
+
+def backfill_pipeline() -> list[dict]:
+    """
+    The aggregation pipeline that computes the hourly rollups of every chat and
+    text completion ever created.
+    """
+
+    def project(kind: str) -> dict:
+        return {
+            "$project": {
+                "_id": 0,
+                "kind": {"$literal": kind},
+                "model": 1,
+                "created": 1,
+                "tokens": "$total_tokens",
+                "latency": "$tt",
+                **{metric: 1 for metric in STREAM_METRICS},
+            }
+        }
+
+    costs = config.openai_model_costs
+    cost_per_1k = 0
+    if costs:
+        cost_per_1k = {
+            "$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$model", model]}, "then": cost}
+                    for model, cost in costs.items()
+                ],
+                "default": 0,
+            }
+        }
+
+    group = {
+        "_id": {"kind": "$kind", "model": "$model", "bucket": "$bucket"},
+        "count": {"$sum": 1},
+    }
+    shape = {
+        "_id": 0,
+        "kind": "$_id.kind",
+        "model": "$_id.model",
+        "granularity": {"$literal": "hour"},
+        "bucket": "$_id.bucket",
+        "count": 1,
+    }
+    for metric in METRICS + STREAM_METRICS:
+        group[f"{metric}_count"] = {
+            "$sum": {"$cond": [{"$gt": [f"${metric}", None]}, 1, 0]}
+        }
+        group[f"{metric}_sum"] = {"$sum": f"${metric}"}
+        group[f"{metric}_min"] = {"$min": f"${metric}"}
+        group[f"{metric}_max"] = {"$max": f"${metric}"}
+        group[f"{metric}_keys"] = {"$push": f"${metric}_key"}
+        shape[metric] = {
+            "count": f"${metric}_count",
+            "sum": f"${metric}_sum",
+            "min": f"${metric}_min",
+            "max": f"${metric}_max",
+            "sketch": _sketch_expression(f"${metric}_keys"),
+        }
+
+    return [
+        project("chat"),
+        {
+            "$unionWith": {
+                "coll": Completion.COLLECTION_NAME,
+                "pipeline": [project("text")],
+            }
+        },
+        {
+            "$addFields": {
+                "cost": {"$multiply": [{"$divide": ["$tokens", 1000]}, cost_per_1k]},
+                "bucket": {
+                    "$dateFromParts": {
+                        "year": {"$year": "$created"},
+                        "month": {"$month": "$created"},
+                        "day": {"$dayOfMonth": "$created"},
+                        "hour": {"$hour": "$created"},
+                    }
+                },
+            }
+        },
+        {
+            "$addFields": {
+                f"{metric}_key": _sketch_key_expression(f"${metric}")
+                for metric in METRICS + STREAM_METRICS
+            }
+        },
+        {"$group": group},
+        {"$project": shape},
+    ]
+
+
+def rebuild_rollups() -> int:
+    """
+    Rebuild every rollup from scratch using a single aggregation pipeline over the
+    completion collections. Daily and monthly rollups are merged from the hourly
+    ones.
+
+    Every rebuilt rollup replaces the stored one (or is inserted) and the rollups
+    of buckets without completions are removed afterwards, so the live rollups are
+    never missing and `record_completion` racing the rebuild can't make it fail.
+    A completion recorded in between the aggregation and the replacement of its
+    rollups isn't counted in them though, so only run this as a backfill or repair
+    job.
+
+    Returns
+    -------
+    `int` :
+        The amount of rollup documents written.
+    """
+
+    hourly = list(
+        get_collection(ChatCompletion).aggregate(backfill_pipeline(), allowDiskUse=True)
+    )
+
+    merged: dict[tuple, dict] = {}
+    for rollup in hourly:
+        for granularity in ("day", "month"):
+            bucket = truncate(rollup["bucket"], granularity)
+            key = (rollup["kind"], rollup["model"], granularity, bucket)
+            document = merged.setdefault(
+                key,
+                {
+                    "kind": rollup["kind"],
+                    "model": rollup["model"],
+                    "granularity": granularity,
+                    "bucket": bucket,
+                    "count": 0,
+                },
+            )
+            document["count"] += rollup["count"]
+            for metric in METRICS + STREAM_METRICS:
+                document[metric] = merge_stats(document.get(metric, {}), rollup[metric])
+
+    documents = hourly + list(merged.values())
+    keys = {(x["kind"], x["model"], x["granularity"], x["bucket"]) for x in documents}
+
+    collection = _collection()
+    operations = [
+        ReplaceOne(
+            {
+                "kind": x["kind"],
+                "model": x["model"],
+                "granularity": x["granularity"],
+                "bucket": x["bucket"],
+            },
+            x,
+            upsert=True,
+        )
+        for x in documents
+    ]
+    for i in range(0, len(operations), REBUILD_BATCH_SIZE):
+        collection.bulk_write(operations[i : i + REBUILD_BATCH_SIZE], ordered=False)
+
+    stale = [
+        DeleteOne({"_id": x["_id"]})
+        for x in collection.find(
+            {}, {"kind": 1, "model": 1, "granularity": 1, "bucket": 1}
+        )
+        if (x["kind"], x["model"], x["granularity"], x["bucket"]) not in keys
+    ]
+    if stale:
+        collection.bulk_write(stale, ordered=False)
+
+    logger.info(
+        f"Rebuilt {len(documents)} completion rollup(s), removed {len(stale)} stale one(s)."
+    )
+    return len(documents)
@@ -8,6 +8,10 @@ _CHARACTER_EXCHANGE = {
 _PAGING_SCHEMA = {Optional("page"): str, Optional("page_size"): str}
 _TWEAKS_LENGTH = ["very short", "short", "medium", "long", "very long"]
 _TWEAKS_CREATIVITY = ["predictable", "consistent", "normal", "creative", "extreme"]
+_AVATAR_VARIANT_SCHEMA = {
+    Optional("size"): Any("64", "128", "256", "512"),
+    Optional("format"): Any("webp", "jpeg"),
+}
 POST_USERS_LOGIN = Schema(
     {Required("email"): Email(), Required("password"): All(str, Length(min=8, max=60))}
 )
@@ -136,8 +140,10 @@ POST_CHAT = Schema(
             None,
         ),
         Optional("id"): str,
+        Optional("stream"): bool,
     }
 )
+GET_CHAT_STREAM = Schema({Required("id"): str, Optional("offset"): str})
 GET_CHAT_SESSIONS = Schema({Required("character_id"): str, **_PAGING_SCHEMA})
 GET_CHAT_SESSIONS_COUNT = Schema({Required("character_id"): str})
 GET_CHAT = Schema(
@@ -179,16 +185,14 @@ DELETE_CHAT_SESSIONS = Schema(
     }
 )
 DELETE_CHAT = Schema({Required("id"): str})
-POST_TASKS_SESSION_AUTO_LABELED = Schema(
-    {Required("user_id"): str, Required("new_name"): str, Required("session_id"): str}
-)
-POST_TASKS_USER_DATA_TRANSFERRED = Schema({Required("user_id"): str})
 POST_ADD_SUBSCRIPTION_ID = Schema({Required("id"): str})
 POST_SUBSCRIPTION_CANCEL = Schema({Required("reason"): str})
 POST_CHARACTERS_ADD_TO_FAVORITES = Schema({Required("id"): str})
 DELETE_CHARACTERS_ADD_TO_FAVORITES = Schema({Required("id"): str})
 PATCH_DISPLAY_NAME = Schema({Required("name"): All(str, Length(min=1, max=45))})
-GET_RENDER_CHARACTER_AVATAR = Schema({Required("character_id"): str})
+GET_RENDER_CHARACTER_AVATAR = Schema(
+    {Required("character_id"): str, **_AVATAR_VARIANT_SCHEMA}
+)
 POST_CHAT_REGENERATE = Schema(
     {
         Required("session_id"): str,
@@ -206,6 +210,10 @@ POST_INLINE_FEEDBACK = Schema(
         Optional("message_id"): Any(str, None),
     }
 )
-GET_RENDER_AVATAR = Schema({Required("id"): str})
+GET_RENDER_AVATAR = Schema({Required("id"): str, **_AVATAR_VARIANT_SCHEMA})
 DELETE_FILE = Schema({Required("id"): str})
 PATCH_USER_DESCRIPTION = Schema({Required("content"): All(str, Length(min=0, max=500))})
+GET_METRICS_COMPLETIONS = Schema({Optional("start"): str, Optional("end"): str})
+GET_METRICS_TRACES = Schema(
+    {Optional("id"): str, Optional("name"): str, **_PAGING_SCHEMA}
+)
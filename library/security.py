@@ -6,7 +6,7 @@ from flask import Blueprint, Flask, request, session, url_for
 from models.user import Application, User
 from voluptuous import Invalid, Schema
 
-from library import responses, types, users, utils
+from library import responses, tracing, types, users, utils
 
 logger = logging.getLogger(__name__)
 
@@ -103,7 +103,10 @@ class RouteSecurity:
             client_ip = self.get_client_ip()
 
             for method in authentication_methods:
-                if authentication_methods_mapping[method]():
+                with tracing.span("auth", method=method):
+                    authenticated = authentication_methods_mapping[method]()
+
+                if authenticated:
                     logger.info(
                         f"Request to '{url_for(request.endpoint)}' from '{client_ip}' with authentication method(s) '{', '.join(authentication_methods)}' is authenticated."
                     )
@@ -1,3 +1,36 @@
+import logging
+import os
+from typing import Optional
+
 from flask_socketio import SocketIO
 
-socketio = SocketIO(async_mode="eventlet", cors_allowed_origins="*")
+logger = logging.getLogger(__name__)
+
+# With a message queue, an event emitted by any process (web or celery) reaches
+# the clients of every web process instead of only the ones connected to it.
+# Without Redis, the celery broker (which every process can already reach) is used.
+MESSAGE_QUEUE = os.getenv("REDIS_URI") or os.getenv("CELERY_BROKER_URI") or None
+
+socketio = SocketIO(
+    async_mode="eventlet", cors_allowed_origins="*", message_queue=MESSAGE_QUEUE
+)
+
+_external: Optional[SocketIO] = None
+
+
+def external_emit(event: str, data: Optional[dict] = None, room: Optional[str] = None):
+    """
+    Emit an event from a process that doesn't serve clients (i.e., a celery worker)
+    by publishing it to the message queue.
+    """
+
+    global _external
+
+    if MESSAGE_QUEUE is None:
+        logger.warning(f"No Socket.IO message queue is configured, dropped '{event}'.")
+        return
+
+    if _external is None:
+        _external = SocketIO(message_queue=MESSAGE_QUEUE)
+
+    _external.emit(event, data, room=room)
@@ -0,0 +1,211 @@
+import collections
+import json
+import logging
+import threading
+from typing import Callable, Iterator, Optional
+
+from cachetools import TTLCache
+from flask import Response
+
+from library.configlib import config
+from library.socketio import socketio
+
+logger = logging.getLogger(__name__)
+
+# An event as stored in a buffer: its offset, name and data.
+Event = tuple[int, str, dict]
+
+
+class StreamBuffer:
+
+    """
+    A ring buffer of the events streamed for a single chat turn. Readers are woken
+    up as events are pushed and can start reading from any offset, so a client that
+    lost its connection resumes where it left off instead of starting a new
+    completion.
+
+    Only the last `maxlen` events are kept. The content of the `chunk` events that
+    were dropped is kept as a single string, a reader that asks for a dropped offset
+    gets it as a `snapshot` event first.
+
+    When the last reader disconnects before the buffer is closed and nobody resumes
+    within `chat_stream_resume_grace` seconds, `on_abandoned` is called (i.e., to
+    cancel the completion).
+    """
+
+    def __init__(
+        self,
+        id: str,
+        user_id: str,
+        maxlen: int,
+        on_abandoned: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.id = id
+        self.user_id = user_id
+        self.maxlen = maxlen
+        self.on_abandoned = on_abandoned
+
+        self._events: collections.deque[Event] = collections.deque()
+        self._next_offset = 0
+        self._dropped = ""
+        self._done = False
+        self._readers = 0
+        self._condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def push(self, event: str, data: dict) -> None:
+        with self._condition:
+            self._events.append((self._next_offset, event, data))
+            self._next_offset += 1
+
+            if len(self._events) > self.maxlen:
+                _, dropped_event, dropped_data = self._events.popleft()
+                if dropped_event == "chunk":
+                    self._dropped += dropped_data["delta"]
+
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """
+        Mark the buffer as complete, readers stop once they've read every event.
+        """
+
+        with self._condition:
+            self._done = True
+            self._condition.notify_all()
+
+    def attach(self) -> None:
+        with self._condition:
+            self._readers += 1
+
+    def detach(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            abandoned = not self._readers and not self._done
+
+        if abandoned and self.on_abandoned is not None:
+            socketio.start_background_task(self._check_abandoned)
+
+    def _check_abandoned(self) -> None:
+        socketio.sleep(config.main["chat_stream_resume_grace"])
+        if not self._readers and not self._done:
+            logger.info(f"The stream '{self.id}' was abandoned.")
+            self.on_abandoned()
+
+    def _since(self, offset: int) -> list[Event]:
+        first = self._events[0][0] if self._events else self._next_offset
+
+        events = []
+        if offset < first:
+            events.append((first - 1, "snapshot", {"content": self._dropped}))
+            offset = first
+
+        events.extend(x for x in self._events if x[0] >= offset)
+        return events
+
+    def read(self, offset: int = 0, timeout: float = 15) -> Iterator[Optional[Event]]:
+        """
+        Iterate over the events starting from `offset` until the buffer is closed.
+        None is yielded whenever no event was pushed within `timeout` seconds so the
+        caller can keep its connection alive.
+        """
+
+        while True:
+            with self._condition:
+                events = self._since(offset)
+                if not events and not self._done:
+                    self._condition.wait(timeout)
+                    events = self._since(offset)
+                done = self._done
+
+            if not events:
+                if done:
+                    return
+
+                yield None
+                continue
+
+            for event in events:
+                yield event
+                offset = event[0] + 1
+
+
+class StreamRegistry:
+
+    """
+    The stream buffers of this process keyed on the ID of the message that started
+    the turn. Buffers are forgotten `chat_stream_ttl` seconds after being created.
+    """
+
+    def __init__(self) -> None:
+        self._buffers: TTLCache = TTLCache(
+            maxsize=config.main["chat_stream_max_buffers"],
+            ttl=config.main["chat_stream_ttl"],
+        )
+        self._lock = threading.Lock()
+
+    def create(
+        self,
+        id: str,
+        user_id: str,
+        on_abandoned: Optional[Callable[[], None]] = None,
+    ) -> StreamBuffer:
+        buffer = StreamBuffer(
+            id,
+            user_id,
+            maxlen=config.main["chat_stream_buffer_size"],
+            on_abandoned=on_abandoned,
+        )
+        with self._lock:
+            self._buffers[id] = buffer
+
+        return buffer
+
+    def get(self, id: str, user_id: str) -> Optional[StreamBuffer]:
+        """
+        Get the buffer of a turn, only if it belongs to `user_id`.
+        """
+
+        with self._lock:
+            buffer: Optional[StreamBuffer] = self._buffers.get(id)
+
+        if buffer is None or buffer.user_id != user_id:
+            return None
+
+        return buffer
+
+
+def format_sse(buffer: StreamBuffer, offset: int = 0) -> Iterator[str]:
+    """
+    Format the events of a buffer as Server-Sent Events. The offset of every event
+    is its SSE `id`, so `Last-Event-ID` + 1 is the offset to resume from.
+
+    The server closes the generator once the client is gone, which detaches it
+    from the buffer.
+    """
+
+    buffer.attach()
+    try:
+        for event in buffer.read(offset):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+
+            offset, name, data = event
+            yield f"id: {offset}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+    finally:
+        buffer.detach()
+
+
+def create_sse_response(buffer: StreamBuffer, offset: int = 0) -> Response:
+    return Response(
+        format_sse(buffer, offset),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+registry = StreamRegistry()
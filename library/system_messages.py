@@ -1,8 +1,11 @@
 import logging
 import os
-import time
 from pathlib import Path
 
+from library.configlib import DirectoryWatcher
+
+SYSTEM_MESSAGES_PATH = os.path.join(os.getcwd(), "data", "system_messages")
+
 logger = logging.getLogger(__name__)
 
 
@@ -12,10 +15,21 @@ class SystemMessageHandler:
     This class houses a set of methods that would ease the retrieval of system
     messages. A system message is a message provided to a GPT model that basically
     instructs it how to act and behave.
+
+    System messages are cached until a `DirectoryWatcher` notices their file has
+    changed, at which point `version` is incremented.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, base_path: str = SYSTEM_MESSAGES_PATH) -> None:
+        self.base_path = base_path
+        self.version = 0
+
         self._cached = {}
+        self._watcher = DirectoryWatcher(base_path, ".txt", self._invalidate)
+
+    def _invalidate(self, changed: set[str]) -> None:
+        self._cached = {}
+        self.version += 1
 
     def get_system_message(self, filename: str) -> str:
         """
@@ -32,20 +46,22 @@ class SystemMessageHandler:
             The system message.
         """
 
-        cache_data = self._cached.get(filename)
-        if cache_data and (time.time() - cache_data["timestamp"] < 5):
-            return cache_data["message"]
+        message = self._cached.get(filename)
+        if message is not None:
+            return message
+
+        self._watcher.start()
 
-        path = os.path.join(os.getcwd(), "data", "system_messages", f"{filename}.txt")
+        path = os.path.join(self.base_path, f"{filename}.txt")
         if not Path(path).exists():
             logger.warning(
                 f"System message '{filename}' not found. Defaulting to 'default'."
             )
-            path = os.path.join(os.getcwd(), "data", "system_messages", "default.txt")
+            path = os.path.join(self.base_path, "default.txt")
 
         with open(path, encoding="utf-8") as f:
             message = f.read()
-            self._cached[filename] = {"timestamp": time.time(), "message": message}
+            self._cached[filename] = message
 
             return message
 
@@ -4,36 +4,39 @@ import pprint
 import statistics
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from dotenv import load_dotenv
 
 if not os.getenv("PRODUCTION"):
-    HOST = "127.0.0.1"
-    PORT = 5000
     load_dotenv()
     logging.info("Loaded development .env file.")
-else:
-    HOST = "web"
-    PORT = 80
 
 from typing import Generator, Optional
 
 import openai
+from bson import ObjectId
 from celery import Celery
-from celery.signals import celeryd_after_setup
-from models.lock import CeleryLock, CeleryLockContext
+from celery.signals import worker_ready
+from database import get_collection, save_fields
+from models.checkpoint import TaskCheckpoint
+from models.lock import CeleryLockContext
 from models.message import Message
-from models.metric import TimeTookMetric
+from models.metric import RequestTrace, TimeTookMetric
 from models.open_ai import ChatCompletion, Completion
 from models.session import ChatSession
 from models.state import UserPlanState
 from models.user import Application
 from openai.embeddings_utils import cosine_similarity
 from openai.error import RateLimitError
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
 
+from library import cascade, counters, llm, rollups, turns
+from library.cache import response_cache
 from library.configlib import config
 from library.gpt import gpt
+from library.socketio import external_emit
 
 app = Celery(
     "optitalk.tasks",
@@ -41,26 +44,43 @@ app = Celery(
     backend=os.environ["CELERY_BACKEND_URI"],
 )
 logger = logging.getLogger(__name__)
-openai.api_key = config.credentials["openai_api_key"]
 
-BASE_URL = f"http://{HOST}:{PORT}/api/tasks"
-
-# Used to ensure only the /api/tasks endpoints are locked up.
-# I know it's not the best but it'll do since those endpoints aren't
-# strictly dangerous if the secret token does get leaked.
-SECRET_TOKEN = "387bf3c1-ec5a-4887-a05d-1d134b60f55c"
-
-
-@celeryd_after_setup.connect
-def setup(*args, **kwargs):
-    locks = list(CeleryLock.find_classes({}))
-    for lock in locks:
-        lock.delete()
-
-    CeleryLock("update_characters_embeddings").save()
-    CeleryLock("auto_tag_characters").save()
-
-    logger.info("Cleaned locks")
+# Tasks are split into queues so the ones a user waits on are never stuck behind
+# batch jobs. Each queue has its own worker (see `docker-compose.yml`):
+# - realtime: user visible work, many eventlet greenlets and a small prefetch.
+# - telemetry: logging and metrics, losing some latency here is fine.
+# - batch: long (i.e., throttled cascade deletes) and CPU heavy (i.e., avatar
+# resizing) jobs on a prefork pool, prefetching one at a time.
+# Tasks that aren't listed go to the realtime queue.
+app.conf.update(
+    task_default_queue="realtime",
+    task_routes={
+        **{
+            f"library.tasks.{x}": {"queue": "telemetry"}
+            for x in (
+                "log_chat_completion",
+                "log_text_completion",
+                "log_time_took_metric",
+                "log_request_trace",
+                "error_alert",
+            )
+        },
+        **{
+            f"library.tasks.{x}": {"queue": "batch"}
+            for x in (
+                "process_avatar",
+                "delete_chat_session",
+                "delete_character_data",
+                "delete_user_data",
+                "auto_moderate_characters",
+                "update_characters_embeddings",
+                "auto_tag_characters",
+                "repair_counters",
+                "rebuild_completion_rollups",
+            )
+        },
+    },
+)
 
 
 @app.task
@@ -68,6 +88,21 @@ def log_chat_completion(**attributes):
     completion = ChatCompletion(**attributes)
     completion.save()
 
+    rollups.record_completion(
+        "chat",
+        completion.model,
+        completion.created,
+        tokens=completion.total_tokens,
+        cost=rollups.completion_cost(completion.model, completion.total_tokens),
+        latency=completion.tt,
+        ttft=completion.ttft,
+        max_chunk_gap=completion.max_chunk_gap,
+        mean_chunk_gap=completion.mean_chunk_gap,
+        tokens_per_second=completion.tokens_per_second,
+        upstream_wait=completion.upstream_wait,
+        chunk_processing_time=completion.chunk_processing_time,
+    )
+
     logger.info(f"Logged chat completion: {pprint.pformat(completion)}")
 
 
@@ -76,39 +111,22 @@ def log_text_completion(**attributes):
     completion = Completion(**attributes)
     completion.save()
 
+    rollups.record_completion(
+        "text",
+        completion.model,
+        completion.created,
+        tokens=completion.total_tokens,
+        cost=rollups.completion_cost(completion.model, completion.total_tokens),
+        latency=completion.tt,
+    )
+
     logger.info(f"Logged text completion: {pprint.pformat(completion)}")
 
 
 @app.task
 def insert_message(**attributes):
     message = Message(**attributes)
-    message.save()
-
-    messages_count = Message.count_documents(
-        {
-            "session_id": message.session_id,
-            "created_by": message.created_by,
-            "character_id": message.character_id,
-        }
-    )
-    if messages_count == 2:
-        if not ChatSession.count_documents(
-            {
-                "id": message.session_id,
-                "name_changed": True,
-                "character_id": message.character_id,
-                "created_by": message.created_by,
-            }
-        ):
-            logger.info(
-                "Messages count is 2, auto naming its session since it's not yet manually named."
-            )
-            auto_label_message.delay(
-                session_id=message.session_id,
-                created_by=message.created_by,
-                character_id=message.character_id,
-                api_key=message.api_key,
-            )
+    turns.commit_turn([message])
 
     logger.info(f"Saved message: {pprint.pformat(message)}")
 
@@ -122,18 +140,53 @@ def insert_application(**attributes):
 
 
 @app.task
-def delete_chat_session(query):
-    session: Optional[ChatSession] = ChatSession.find_class(query)
-    if session is None:
+def process_avatar(file_id: str):
+    from models.file import File
+
+    file: Optional[File] = File.find_class({"id": file_id})
+    if file is None or file.processed:
         return
 
-    deleted = 0
-    for message in session.messages():
-        message.delete()
-        deleted += 1
+    try:
+        file.process()
+    except Exception:
+        description = f"Error while processing '{file}'."
+        logger.exception(description)
+        error_alert.delay(
+            "Error from process_avatar",
+            description,
+            trace=traceback.format_exc(),
+            metadata={"file_id": file_id},
+        )
+
+
+@app.task
+def delete_chat_session(query):
+    counts = cascade.run_cascade(cascade.chat_session_cascade(query))
+    counters.increment_user(
+        query["created_by"], messages_count=-counts.get(Message.__name__, 0)
+    )
+    logger.info(f"Deleted session '{query['id']}' and its dependents: {counts}")
 
-    session.delete()
-    logger.info(f"Deleted session '{session.id}' and {deleted} message(s) from it.")
+
+@app.task
+def delete_character_data(character_id: str):
+    counters.release_messages({"character_id": character_id})
+    counts = cascade.run_cascade(cascade.character_cascade(character_id))
+    logger.info(f"Deleted character '{character_id}' and its dependents: {counts}")
+
+
+@app.task
+def delete_user_data(user_id: str):
+    from models.character import Character
+
+    character_ids = [
+        x["id"]
+        for x in get_collection(Character).find({"created_by": user_id}, {"id": 1})
+    ]
+    counters.release_messages({"character_id": {"$in": character_ids}})
+    counts = cascade.run_cascade(cascade.user_cascade(user_id))
+    logger.info(f"Deleted user '{user_id}' and its dependents: {counts}")
 
 
 @app.task
@@ -189,52 +242,68 @@ Casual greetings from deadpool
     )
     label = response[0].result
 
-    session.name_changed = True
-    session.name = label
-    session.save()
+    get_collection(ChatSession).update_one(
+        {"id": session_id, "created_by": created_by, "character_id": character_id},
+        {"$set": {"name_changed": True, "name": label}},
+    )
 
-    requests.post(
-        BASE_URL + "/session-auto-labeled",
-        json={
-            "user_id": created_by,
-            "new_name": label,
-            "session_id": session_id,
-        },
-        headers={"X-Secret-Token": SECRET_TOKEN},
+    external_emit(
+        "session-auto-labeled", {"id": session_id, "new_name": label}, room=created_by
     )
 
 
 @app.task
 def transfer_user_data(old_id: str, new_id: str):
-    sessions_modified = 0
-    for session in ChatSession.find_classes({"created_by": old_id}):
-        session: ChatSession
+    """
+    Move the sessions and messages of an anonymous (IP) user to the account they
+    just logged into. Each collection is moved with a single `update_many` and the
+    completed stages are checkpointed so a retried task skips them. The message
+    counters of both users are recomputed at the end rather than incremented, so a
+    retry never counts the same messages twice.
+    """
+
+    checkpoint = TaskCheckpoint.load("transfer_user_data", f"{old_id}:{new_id}")
+    completed: list[str] = checkpoint.state.setdefault("completed", [])
+
+    stages = [("sessions", ChatSession), ("messages", Message)]
+    if not completed and not any(
+        get_collection(model).find_one({"created_by": old_id}, {"_id": 1})
+        for _, model in stages
+    ):
+        logger.info(f"No data to transfer from '{old_id}' to '{new_id}'.")
+        external_emit("user-data-transferred", room=new_id)
+        return
 
-        session.created_by = new_id
-        session.save()
-        sessions_modified += 1
+    for stage, model in stages:
+        if stage in completed:
+            continue
 
-    logger.info(
-        f"Transferred {sessions_modified} session(s) from '{old_id}' to '{new_id}'."
-    )
+        result = get_collection(model).update_many(
+            {"created_by": old_id}, {"$set": {"created_by": new_id}}
+        )
+        completed.append(stage)
+        checkpoint.state[stage] = result.modified_count
+        checkpoint.commit()
 
-    messages_modified = 0
-    for message in Message.find_classes({"created_by": old_id}):
-        message: Message
+        logger.info(
+            f"Transferred {result.modified_count} {stage} from '{old_id}' to '{new_id}'."
+        )
 
-        message.created_by = new_id
-        message.save()
-        messages_modified += 1
+        external_emit(
+            "user-data-transfer-progress",
+            {
+                "stage": stage,
+                "modified": result.modified_count,
+                "completed": len(completed),
+                "total": len(stages),
+            },
+            room=new_id,
+        )
 
-    logger.info(
-        f"Transferred {messages_modified} message(s) from '{old_id}' to '{new_id}.'"
-    )
+    counters.recount_user_messages(old_id, new_id)
+    checkpoint.delete()
 
-    requests.post(
-        BASE_URL + "/user-data-transferred",
-        json={"user_id": new_id},
-        headers={"X-Secret-Token": SECRET_TOKEN},
-    )
+    external_emit("user-data-transferred", room=new_id)
 
 
 @app.task
@@ -269,6 +338,103 @@ def log_time_took_metric(**params):
     time_took_metric.save()
 
 
+@app.task
+def log_request_trace(**attributes):
+    _ensure_request_trace_ttl()
+    RequestTrace(**attributes).save()
+
+
+_request_trace_ttl: Optional[int] = None
+
+
+def _ensure_request_trace_ttl() -> None:
+    """
+    Expire request traces `request_trace_retention_days` days after they're created.
+    """
+
+    global _request_trace_ttl
+
+    ttl = int(config.main["request_trace_retention_days"] * 86400)
+    if ttl == _request_trace_ttl:
+        return
+
+    collection = get_collection(RequestTrace)
+    try:
+        collection.create_index(
+            [("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=ttl
+        )
+    except OperationFailure:
+        # The index exists with another retention.
+        collection.database.command(
+            "collMod",
+            collection.name,
+            index={"name": "created_at_ttl", "expireAfterSeconds": ttl},
+        )
+
+    _request_trace_ttl = ttl
+
+
+# The checkpoint of the one time counters backfill. Change it to backfill the
+# counters again when the next worker starts.
+COUNTERS_BACKFILL = "backfill-2"
+
+
+@app.task
+def repair_counters():
+    with CeleryLockContext("repair_counters") as lock:
+        if lock is None:
+            logger.info("repair_counters is LOCKED! returning")
+            return
+
+        counters.repair_counters()
+        TaskCheckpoint.load("repair_counters", COUNTERS_BACKFILL).commit()
+
+
+@worker_ready.connect
+def backfill_counters(sender, **kwargs):
+    """
+    Documents created before the counters existed don't have them, so they're
+    computed once by whichever worker starts first.
+    """
+
+    if TaskCheckpoint.find_class({"name": "repair_counters", "key": COUNTERS_BACKFILL}):
+        return
+
+    logger.info("Counters were never computed, backfilling them.")
+    repair_counters.delay()
+
+
+# The checkpoint of the one time rollups backfill, see `COUNTERS_BACKFILL`.
+ROLLUPS_BACKFILL = "month"
+
+
+@app.task
+def rebuild_completion_rollups():
+    with CeleryLockContext("rebuild_completion_rollups") as lock:
+        if lock is None:
+            logger.info("rebuild_completion_rollups is LOCKED! returning")
+            return
+
+        rollups.rebuild_rollups()
+        TaskCheckpoint.load("rebuild_completion_rollups", ROLLUPS_BACKFILL).commit()
+
+
+@worker_ready.connect
+def backfill_rollups(sender, **kwargs):
+    """
+    Completions logged before a granularity existed (i.e., the monthly rollups)
+    aren't in its rollups, so they're rebuilt once by whichever worker starts first.
+    """
+
+    if TaskCheckpoint.find_class(
+        {"name": "rebuild_completion_rollups", "key": ROLLUPS_BACKFILL}
+    ):
+        return
+
+    logger.info("Completion rollups were never rebuilt, backfilling them.")
+    rebuild_completion_rollups.delay()
+
+
 @app.task
 def send_email(to: str, html_template: str, variables: dict[str, str]):
     ...
@@ -292,63 +458,154 @@ def reset_users_state_hourly_cap():
             logger.info(f"Reset hourly cap for user '{state.id}'")
 
 
+def _moderation_input(character: dict) -> str:
+    return f"Name: {character['name']}\nDescription: {character['description']}\n\nPersonalities: {str(character.get('personalities'))}\nResponse Styles: {str(character.get('response_styles'))}\nFavorite Words: {str(character.get('favorite_words'))}"
+
+
+def _moderate_batch(characters: list[dict]) -> Optional[list[dict]]:
+    """
+    Moderate a batch of characters in a single request. Returns the result of each
+    character or None if the request failed.
+    """
+
+    ids = [x["id"] for x in characters]
+    try:
+        response = llm.client.moderation([_moderation_input(x) for x in characters])
+        return response["results"]
+    except RateLimitError:
+        description = f"Rate limit error while auto moderating characters {ids}."
+        title = "Rate limit error from auto_moderate_characters"
+    except openai.OpenAIError:
+        description = (
+            f"Error occurred while attempting to auto moderate characters {ids}."
+        )
+        title = "Unknown error from auto_moderate_characters"
+
+    logger.exception(description)
+    error_alert.delay(
+        title,
+        description,
+        trace=traceback.format_exc(),
+        metadata={"character_ids": ", ".join(ids)},
+    )
+    return None
+
+
 @app.task
 def auto_moderate_characters():
+    """
+    Moderate the characters that weren't moderated yet, `auto_moderation_batch_size`
+    characters per request and `auto_moderation_concurrency` requests at once (the
+    rate limiter spaces them out further if needed). The results of each round are
+    written with a single `bulk_write`.
+
+    Characters are processed in `_id` order and the checkpoint only moves past the
+    batches that succeeded, up to the first one that failed. The run then stops, so
+    the next run resumes at (and retries) the failed batch.
+    """
+
     from models.character import Character
 
-    characters: Generator[Character, None, None] = Character.find_classes(
-        {"$or": [{"_moderated": False}, {"_moderated": {"$exists": False}}]}
-    )
+    with CeleryLockContext("auto_moderate_characters") as lock:
+        if lock is None:
+            logger.info("auto_moderate_characters is LOCKED! returning")
+            return
+
+        collection = get_collection(Character)
+        checkpoint = TaskCheckpoint.load("auto_moderate_characters", "all")
+
+        batch_size = config.main["auto_moderation_batch_size"]
+        concurrency = config.main["auto_moderation_concurrency"]
+        query = {"$or": [{"_moderated": False}, {"_moderated": {"$exists": False}}]}
+        projection = {
+            x: 1
+            for x in (
+                "id",
+                "name",
+                "description",
+                "personalities",
+                "response_styles",
+                "favorite_words",
+            )
+        }
+
+        failed = False
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while lock.held and not failed:
+                after = checkpoint.state.get("after")
+                if after is not None:
+                    query["_id"] = {"$gt": ObjectId(after)}
+
+                characters = list(
+                    collection.find(query, projection)
+                    .sort("_id", 1)
+                    .limit(batch_size * concurrency)
+                )
+                if not characters:
+                    break
+
+                batches = [
+                    characters[i : i + batch_size]
+                    for i in range(0, len(characters), batch_size)
+                ]
 
-    for character in characters:
-        constructed_description = f"Name: {character.name}\nDescription: {character.description}\n\nPersonalities: {str(character.personalities)}\nResponse Styles: {str(character.response_styles)}\nFavorite Words: {str(character.favorite_words)}"
-
-        logger.info(f"Auto moderating character '{character}'.")
-
-        try:
-            response = openai.Moderation.create(input=constructed_description)
-            if response.results:
-                response = response.results[0]
-                categories = response["categories"]
-                character._auto_moderation_results = response
-                character._moderated = True
-
-                if any(
-                    [
-                        categories["sexual"],
-                        categories["sexual/minors"],
-                        categories["violence/graphic"],
-                    ]
+                operations = []
+                flagged = 0
+                succeeded = None
+                for batch, results in zip(
+                    batches, executor.map(_moderate_batch, batches)
                 ):
-                    logger.info(f"Auto marked character '{character}' as NSFW.")
-                    character.nsfw = True
+                    if results is None:
+                        failed = True
+                        continue
+
+                    if not failed:
+                        succeeded = batch[-1]["_id"]
+
+                    for character, result in zip(batch, results):
+                        categories = result["categories"]
+                        update = {
+                            "$set": {
+                                "_moderated": True,
+                                "_auto_moderation_results": result,
+                            }
+                        }
+
+                        if any(
+                            [
+                                categories["sexual"],
+                                categories["sexual/minors"],
+                                categories["violence/graphic"],
+                            ]
+                        ):
+                            logger.info(
+                                f"Auto marked character '{character['id']}' as NSFW."
+                            )
+                            update["$set"]["nsfw"] = True
+                            update["$inc"] = {"version": 1}
+                            flagged += 1
+
+                        operations.append(UpdateOne({"_id": character["_id"]}, update))
+
+                if not lock.verify():
+                    logger.warning("Lost the auto_moderate_characters lock, stopping.")
+                    break
 
-                character.save()
+                if operations:
+                    collection.bulk_write(operations, ordered=False)
+                if flagged:
+                    response_cache.invalidate("characters")
 
-        except RateLimitError:
-            description = (
-                f"Rate limit error while auto moderating character '{character}'."
-            )
-            logger.exception(description)
-            error_alert.delay(
-                "Rate limit error from auto_moderate_characters",
-                description,
-                trace=traceback.format_exc(),
-                metadata={"character_id": character.id},
-            )
-            time.sleep(60)
-        except openai.OpenAIError:
-            description = f"Error occurred while attempting to auto moderate character '{character}'."
-            logger.exception(description)
-            error_alert.delay(
-                "Unknown error from auto_moderate_characters",
-                description,
-                trace=traceback.format_exc(),
-                metadata={"character_id": character.id},
-            )
-            time.sleep(60)
+                logger.info(
+                    f"Auto moderated {len(operations)}/{len(characters)} characters, {flagged} marked as NSFW."
+                )
+
+                if succeeded is not None:
+                    checkpoint.state["after"] = str(succeeded)
+                    checkpoint.commit()
 
-        time.sleep(0.2)
+        if lock.held and not failed:
+            checkpoint.delete()
 
 
 @app.task
@@ -367,14 +624,20 @@ def update_characters_embeddings():
         for character in characters:
             try:
                 character.update_embeddings()
-                character.save()
             except Exception:
-                pass
+                continue
 
-            time.sleep(0.1)
+            if not lock.verify():
+                logger.warning("Lost the update_characters_embeddings lock, stopping.")
+                return
 
-    lock.lock.open = True
-    lock.lock.save()
+            save_fields(
+                character,
+                "embeddings",
+                "embeddings_tokens",
+                "embeddings_price",
+                "embeddings_updated_count",
+            )
 
 
 @app.task
@@ -414,6 +677,7 @@ def auto_tag_characters():
         if not tags:
             return
 
+        tagged = 0
         for character in characters:
             if not character.embeddings:
                 continue
@@ -448,14 +712,19 @@ def auto_tag_characters():
             elif len(character.tags) > 1:
                 character.tags_similarity = statistics.mean(similarity_values)
 
-            character.save()
+            if not lock.verify():
+                logger.warning("Lost the auto_tag_characters lock, stopping.")
+                break
+
+            save_fields(character, "tags", "tags_similarity")
             if character.tags:
                 logger.info(
                     f"Auto tagged '{character}' with tags {character.tags} with a average tags similarity of {character.tags_similarity}"
                 )
+                tagged += 1
 
-    lock.lock.open = True
-    lock.lock.save()
+        if tagged:
+            response_cache.invalidate("characters")
 
 
 @app.on_after_configure.connect
@@ -465,12 +734,15 @@ def setup_periodic_tasks(sender, **kwargs):
         sig=reset_users_state_hourly_cap.s(),
         name="reset users hourly cap",
     )
+    sender.add_periodic_task(
+        schedule=86400.0, sig=repair_counters.s(), name="repair counters"
+    )
 
-    # sender.add_periodic_task(
-    #     schedule=60.0, sig=auto_tag_characters.s(), name="auto tag characters"
-    # )
-    # sender.add_periodic_task(
-    #     schedule=20.0,
-    #     sig=update_characters_embeddings.s(),
-    #     name="update characters embeddings",
-    # )
+    sender.add_periodic_task(
+        schedule=60.0, sig=auto_tag_characters.s(), name="auto tag characters"
+    )
+    sender.add_periodic_task(
+        schedule=20.0,
+        sig=update_characters_embeddings.s(),
+        name="update characters embeddings",
+    )
@@ -0,0 +1,257 @@
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import logging
+import random
+import time
+import uuid
+from typing import Callable, Iterator, Optional
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+# The maximum amount of spans kept per trace. Stages that happen once per token
+# (i.e., `emit`) keep adding to the stage totals past this.
+MAX_SPANS = 256
+
+# The order stages are reported in. Stages that aren't listed come after these.
+STAGES = (
+    "auth",
+    "identity",
+    "session_load",
+    "quota_check",
+    "history_fetch",
+    "prompt_build",
+    "token_trim",
+    "llm_ttft",
+    "llm_total",
+    "parse",
+    "persistence",
+    "emit",
+)
+
+_otel_tracer = otel_trace.get_tracer(__name__) if otel_trace is not None else None
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    start: float
+    end: Optional[float] = None
+    parent: Optional[str] = None
+    attributes: dict = dataclasses.field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """
+        The duration of the span in milliseconds.
+        """
+
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+
+@dataclasses.dataclass
+class Trace:
+
+    """
+    The spans recorded while handling a single request. Every span is also added
+    to the total of its stage, so the same stage can happen more than once (i.e.,
+    a function call makes `Character.chat` run twice).
+    """
+
+    name: str
+    start: float = dataclasses.field(default_factory=time.perf_counter)
+    id: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex)
+    spans: list[Span] = dataclasses.field(default_factory=list)
+    stages: dict[str, dict] = dataclasses.field(default_factory=dict)
+    keep: bool = False
+
+    @property
+    def duration(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def add(self, span: Span) -> None:
+        stage = self.stages.setdefault(span.name, {"count": 0, "duration": 0.0})
+        stage["count"] += 1
+        stage["duration"] += span.duration
+
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(span)
+
+    def ordered_stages(self) -> list[tuple[str, dict]]:
+        return sorted(
+            self.stages.items(),
+            key=lambda x: STAGES.index(x[0]) if x[0] in STAGES else len(STAGES),
+        )
+
+    def server_timing(self) -> str:
+        """
+        The stages formatted as a `Server-Timing` header value.
+        """
+
+        timings = [
+            f"{name};dur={stage['duration']:.2f}"
+            for name, stage in self.ordered_stages()
+        ]
+        timings.append(f"total;dur={self.duration:.2f}")
+
+        return ", ".join(timings)
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "duration": round(self.duration, 2),
+            "stages": {
+                name: {"count": x["count"], "duration": round(x["duration"], 2)}
+                for name, x in self.ordered_stages()
+            },
+            "spans": [
+                {
+                    "name": x.name,
+                    "parent": x.parent,
+                    "offset": round((x.start - self.start) * 1000, 2),
+                    "duration": round(x.duration, 2),
+                    "attributes": x.attributes,
+                }
+                for x in self.spans
+            ],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def start_trace(name: str) -> Trace:
+    """
+    Start a trace in the current context, replacing any previous one.
+    """
+
+    trace = Trace(name=name)
+    _current_trace.set(trace)
+    _current_span.set(None)
+
+    return trace
+
+
+def end_trace() -> Optional[Trace]:
+    """
+    End the trace of the current context and return it.
+    """
+
+    trace = _current_trace.get()
+    _current_trace.set(None)
+    _current_span.set(None)
+
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def keep(sample_rate: float = 1.0) -> None:
+    """
+    Mark the current trace to be stored once it ends, so it can be retrieved from
+    the `/api/metrics/traces` endpoint. Only a `sample_rate` fraction of the traces
+    this is called for are kept.
+    """
+
+    trace = _current_trace.get()
+    if trace is not None and random.random() < sample_rate:
+        trace.keep = True
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Record a span of the current trace. When OpenTelemetry is installed, the span
+    is also started as an OpenTelemetry span so an SDK configured by the
+    environment can export it.
+
+    Outside of a trace this only records the OpenTelemetry span, if any.
+
+    Usage:
+    ```
+    with tracing.span("history_fetch"):
+        messages = list(Message.find_classes(query))
+    ```
+    """
+
+    otel_context = contextlib.nullcontext()
+    if _otel_tracer is not None:
+        otel_context = _otel_tracer.start_as_current_span(name, attributes=attributes)
+
+    with otel_context:
+        trace = _current_trace.get()
+        if trace is None:
+            yield None
+            return
+
+        parent = _current_span.get()
+        current = Span(
+            name=name,
+            start=time.perf_counter(),
+            parent=parent.name if parent else None,
+            attributes=attributes,
+        )
+        token = _current_span.set(current)
+        try:
+            yield current
+        finally:
+            current.end = time.perf_counter()
+            _current_span.reset(token)
+            trace.add(current)
+
+
+def record(name: str, start: float, end: Optional[float] = None, **attributes) -> None:
+    """
+    Record a span that already happened, for durations that don't map to a block of
+    code (i.e., the time to the first token of a stream).
+
+    `start` and `end` are `time.perf_counter` values, `end` defaults to now.
+    """
+
+    trace = _current_trace.get()
+    if trace is None:
+        return
+
+    parent = _current_span.get()
+    trace.add(
+        Span(
+            name=name,
+            start=start,
+            end=end or time.perf_counter(),
+            parent=parent.name if parent else None,
+            attributes=attributes,
+        )
+    )
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """
+    A decorator that records every call of a function as a span, named after the
+    function unless `name` is provided.
+    """
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return inner
+
+    return decorator
@@ -0,0 +1,57 @@
+import dataclasses
+import logging
+
+from database import get_collection
+from models.message import Message
+from models.session import ChatSession
+
+from library import counters
+
+logger = logging.getLogger(__name__)
+
+
+def commit_turn(messages: list[Message], increment_uses: bool = False) -> None:
+    """
+    Persist the messages of a chat turn along with every counter it affects. Each
+    collection is written to once: the messages with a single ordered
+    `insert_many`, then one `$inc` on the session, the character and the user.
+
+    Parameters
+    ----------
+    `messages` : list[Message]
+        The messages of the turn in the order they happened. They must all belong
+        to the same session.
+    `increment_uses` : bool
+        Whether to increment the `uses` of the character. Defaults to False.
+    """
+
+    if not messages:
+        return
+
+    first = messages[0]
+    amount = len(messages)
+
+    get_collection(Message).insert_many(
+        [dataclasses.asdict(x) for x in messages], ordered=True
+    )
+    get_collection(ChatSession).update_one(
+        {
+            "id": first.session_id,
+            "character_id": first.character_id,
+            "created_by": first.created_by,
+        },
+        {"$inc": {"messages_count": amount}},
+    )
+
+    if increment_uses:
+        from models.character import Character
+
+        get_collection(Character).update_one(
+            {"id": first.character_id}, {"$inc": {"uses": 1}}
+        )
+
+    counters.increment_user(first.created_by, messages_count=amount)
+
+    logger.info(
+        f"Committed {amount} message(s) to session '{first.session_id}' of '{first.created_by}'."
+    )
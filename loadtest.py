@@ -0,0 +1,382 @@
+"""
+An end-to-end load test of the Flask app. Virtual users replay a mix of chat,
+regenerate, catalogue browse and avatar requests and the latency, throughput and
+time to first token (measured from the `realtime-response` Socket.IO events) of
+every endpoint is reported once the run is over.
+
+Run it against a local mongod and the mock OpenAI server:
+```
+python mock_openai.py
+OPENAI_API_BASE=http://127.0.0.1:8900/v1 DISABLE_RATE_LIMITS=1 python app.py
+python loadtest.py --users 20 --duration 60
+```
+
+Every virtual user is its own account, so use a plan without hourly caps (or a
+large `--duration` will mostly measure 403s).
+"""
+
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse
+import collections
+import io
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from typing import Optional
+
+import coloredlogs
+import requests
+import socketio
+from PIL import Image
+
+coloredlogs.install(level="INFO")
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIX = "chat=50,regenerate=10,browse=30,avatar=10"
+
+# The POST /api/chat schema still requires an API key, the mock server ignores it.
+API_KEY = "sk-load-test-0000000000"
+
+MESSAGES = [
+    "Hey! How was your day?",
+    "Tell me a story about the sea.",
+    "What do you think about rainy mornings?",
+    "Can you describe your favorite place in detail?",
+    "Why?",
+    "That's interesting, go on.",
+]
+
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    """
+    The nearest-rank percentile of a list of values.
+    """
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+        self.ttft: dict[str, list[float]] = collections.defaultdict(list)
+        self.errors: collections.Counter = collections.Counter()
+        self.statuses: dict[str, collections.Counter] = collections.defaultdict(
+            collections.Counter
+        )
+
+    def record(
+        self,
+        endpoint: str,
+        latency: float,
+        status: int,
+        ttft: Optional[float] = None,
+    ) -> None:
+        self.latencies[endpoint].append(latency)
+        self.statuses[endpoint][status] += 1
+        if status >= 400:
+            self.errors[endpoint] += 1
+        if ttft is not None:
+            self.ttft[endpoint].append(ttft)
+
+    def report(self, duration: float) -> str:
+        def ms(value: Optional[float]) -> str:
+            return "-" if value is None else f"{value * 1000:.0f}"
+
+        header = (
+            f"{'endpoint':<12}{'requests':>9}{'errors':>8}{'req/s':>8}"
+            f"{'p50':>8}{'p95':>8}{'p99':>8}"
+            f"{'ttft50':>8}{'ttft95':>8}{'ttft99':>8}"
+        )
+        lines = [header, "-" * len(header)]
+        for endpoint in sorted(self.latencies):
+            latencies = self.latencies[endpoint]
+            ttft = self.ttft.get(endpoint, [])
+            lines.append(
+                f"{endpoint:<12}{len(latencies):>9}{self.errors[endpoint]:>8}"
+                f"{len(latencies) / duration:>8.2f}"
+                f"{ms(percentile(latencies, 50)):>8}"
+                f"{ms(percentile(latencies, 95)):>8}"
+                f"{ms(percentile(latencies, 99)):>8}"
+                f"{ms(percentile(ttft, 50)):>8}"
+                f"{ms(percentile(ttft, 95)):>8}"
+                f"{ms(percentile(ttft, 99)):>8}"
+            )
+
+        total = sum(len(x) for x in self.latencies.values())
+        lines.append("-" * len(header))
+        lines.append(
+            f"{total} requests in {duration:.1f}s ({total / duration:.2f} req/s), "
+            "latencies in ms."
+        )
+        for endpoint, statuses in sorted(self.statuses.items()):
+            lines.append(f"{endpoint}: {dict(statuses)}")
+
+        return "\n".join(lines)
+
+
+class VirtualUser:
+    def __init__(self, base_url: str, email: str, stats: Stats) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.email = email
+        self.password = "load-test-password"
+        self.stats = stats
+
+        self.id: Optional[str] = None
+        self.session_id = str(uuid.uuid4())
+        self.chatted = False
+
+        self.http = requests.Session()
+        self.anonymous = requests.Session()
+        self.socket = socketio.Client(reconnection=False)
+        self.socket.on("realtime-response", self._on_realtime_response)
+        self._first_token_at: Optional[float] = None
+
+    def _on_realtime_response(self, data) -> None:
+        if self._first_token_at is None:
+            self._first_token_at = time.perf_counter()
+
+    def setup(self) -> None:
+        credentials = {"email": self.email, "password": self.password}
+        response = self.http.post(f"{self.base_url}/api/users", json=credentials)
+        response.raise_for_status()
+        self.id = response.json()["payload"]["id"]
+
+        response = self.http.post(f"{self.base_url}/api/users/login", json=credentials)
+        response.raise_for_status()
+
+        cookies = "; ".join(f"{k}={v}" for k, v in self.http.cookies.items())
+        self.socket.connect(self.base_url, headers={"Cookie": cookies})
+        self.socket.emit("join-room", self.id)
+
+    def close(self) -> None:
+        if self.socket.connected:
+            self.socket.disconnect()
+
+    def timed(
+        self,
+        endpoint: str,
+        method: str,
+        path: str,
+        http: Optional[requests.Session] = None,
+        measure_ttft: bool = False,
+        **kwargs,
+    ) -> Optional[requests.Response]:
+        self._first_token_at = None
+        st = time.perf_counter()
+        try:
+            response = (http or self.http).request(
+                method, f"{self.base_url}{path}", timeout=120, **kwargs
+            )
+            status = response.status_code
+        except requests.RequestException:
+            logger.exception(f"{endpoint} request failed.")
+            response = None
+            status = 599
+        latency = time.perf_counter() - st
+
+        ttft = None
+        if measure_ttft and self._first_token_at is not None:
+            ttft = self._first_token_at - st
+
+        self.stats.record(endpoint, latency, status, ttft=ttft)
+        return response
+
+    def chat(self, character_id: str, rng: random.Random) -> None:
+        response = self.timed(
+            "chat",
+            "POST",
+            "/api/chat",
+            measure_ttft=True,
+            json={
+                "character_id": character_id,
+                "content": rng.choice(MESSAGES),
+                "session_id": self.session_id,
+                "api_key": API_KEY,
+            },
+        )
+        if response is not None and response.ok:
+            self.chatted = True
+
+    def regenerate(self, character_id: str, rng: random.Random) -> None:
+        if not self.chatted:
+            return self.chat(character_id, rng)
+
+        self.timed(
+            "regenerate",
+            "POST",
+            "/api/chat/regenerate",
+            measure_ttft=True,
+            json={
+                "character_id": character_id,
+                "session_id": self.session_id,
+                "api_key": API_KEY,
+            },
+        )
+
+    def browse(self, rng: random.Random) -> None:
+        params = {
+            "page": rng.choice([1, 1, 1, 2, 3]),
+            "sort": rng.choice(["latest", "uses"]),
+        }
+        self.timed(
+            "browse", "GET", "/api/characters", http=self.anonymous, params=params
+        )
+
+    def avatar(self, avatar_id: Optional[str], rng: random.Random) -> None:
+        if avatar_id is None:
+            return
+
+        self.timed(
+            "avatar",
+            "GET",
+            "/api/files/render-avatar",
+            http=self.anonymous,
+            params={"id": avatar_id, "size": rng.choice(["64", "128", "256"])},
+        )
+
+
+def create_fixture(user: VirtualUser) -> tuple[str, Optional[str]]:
+    """
+    Create the character every virtual user chats with, along with its avatar.
+    """
+
+    image = Image.new("RGB", (800, 800), (120, 80, 200))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    buffer.seek(0)
+
+    avatar_id = None
+    response = user.http.post(
+        f"{user.base_url}/api/files/upload-avatar",
+        files={"file": ("avatar.png", buffer, "image/png")},
+    )
+    if response.ok:
+        avatar_id = response.json()["payload"]["id"]
+    else:
+        logger.warning(f"Couldn't upload the avatar ({response.status_code}).")
+
+    response = user.http.post(
+        f"{user.base_url}/api/characters",
+        json={
+            "name": "Load Test",
+            "public_description": "A character used by the load test.",
+            "description": "A friendly and talkative character.",
+            "avatar_id": avatar_id,
+        },
+    )
+    response.raise_for_status()
+
+    return response.json()["payload"]["id"], avatar_id
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+
+    return weights
+
+
+def run_user(
+    user: VirtualUser,
+    character_id: str,
+    avatar_id: Optional[str],
+    mix: dict[str, float],
+    deadline: float,
+    think_time: float,
+    seed: int,
+) -> None:
+    rng = random.Random(seed)
+    actions = list(mix)
+    weights = [mix[x] for x in actions]
+
+    while time.monotonic() < deadline:
+        action = rng.choices(actions, weights)[0]
+        if action == "chat":
+            user.chat(character_id, rng)
+        elif action == "regenerate":
+            user.regenerate(character_id, rng)
+        elif action == "browse":
+            user.browse(rng)
+        elif action == "avatar":
+            user.avatar(avatar_id, rng)
+
+        if think_time:
+            time.sleep(rng.expovariate(1 / think_time))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="In seconds.")
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=1.0,
+        help="Mean seconds a virtual user waits in between requests.",
+    )
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help=f"Request weights (default: {DEFAULT_MIX})."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    run_id = uuid.uuid4().hex[:8]
+    stats = Stats()
+    users = [
+        VirtualUser(args.base_url, f"load-test-{run_id}-{i}@example.com", stats)
+        for i in range(args.users)
+    ]
+
+    logger.info(f"Setting up {len(users)} virtual users...")
+    pool = eventlet.GreenPool(len(users))
+    for _ in pool.imap(VirtualUser.setup, users):
+        pass
+
+    character_id, avatar_id = create_fixture(users[0])
+    logger.info(f"Chatting with character '{character_id}' for {args.duration}s...")
+
+    st = time.monotonic()
+    deadline = st + args.duration
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(
+                user,
+                character_id,
+                avatar_id,
+                mix,
+                deadline,
+                args.think_time,
+                args.seed + i,
+            ),
+        )
+        for i, user in enumerate(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    duration = time.monotonic() - st
+    for user in users:
+        user.close()
+
+    print(stats.report(duration))
+
+
+if __name__ == "__main__":
+    main()
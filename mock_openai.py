@@ -0,0 +1,325 @@
+"""
+A stand-in for the OpenAI API so the chat endpoints can be benchmarked without
+paying for completions or hitting rate limits.
+
+It implements streamed and non streamed chat completions, text completions,
+embeddings and moderation. Outputs are derived from a hash of the request so the
+same request always gets the same response.
+
+Usage:
+```
+python mock_openai.py --port 8900 --latency 0.4 --tokens-per-second 40
+OPENAI_API_BASE=http://127.0.0.1:8900/v1 python app.py
+```
+"""
+
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import time
+import uuid
+
+import coloredlogs
+import eventlet.wsgi
+from flask import Flask, Response, request
+
+coloredlogs.install(level="INFO")
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIMENSIONS = 1536
+MODERATION_CATEGORIES = [
+    "hate",
+    "hate/threatening",
+    "harassment",
+    "harassment/threatening",
+    "self-harm",
+    "self-harm/intent",
+    "self-harm/instructions",
+    "sexual",
+    "sexual/minors",
+    "violence",
+    "violence/graphic",
+]
+# Moderation inputs containing this are flagged as sexual.
+FLAGGED_MARKER = "mock-flagged"
+
+WORDS = (
+    "the a of to and in that it with as for was on are be this have from or by "
+    "one had not but what all were when we there can an your which their said if "
+    "do will each about how up out them then she many some so these would other "
+    "into has more her two like him see time could no make than first been its "
+    "who now people my made over did down only way find use may water long little "
+    "very after words called just where most know"
+).split()
+
+app = Flask(__name__)
+settings = argparse.Namespace(
+    latency=0.3,
+    jitter=0.1,
+    tokens_per_second=40.0,
+    reply_tokens=120,
+    error_rate=0.0,
+    error_status=429,
+    seed=0,
+)
+errors_random = random.Random(0)
+
+
+def seeded_random(*parts) -> random.Random:
+    digest = hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).digest()
+    return random.Random(int.from_bytes(digest[:8], "big") ^ settings.seed)
+
+
+def sleep_latency(rng: random.Random) -> None:
+    time.sleep(max(0.0, settings.latency + rng.uniform(-1, 1) * settings.jitter))
+
+
+def count_tokens(text: str) -> int:
+    return max(1, math.ceil(len(text) / 4))
+
+
+def generate_reply(rng: random.Random, max_tokens: int) -> list[str]:
+    """
+    Generate a reply as a list of tokens, formatted the way the character prompts
+    ask the model to reply.
+    """
+
+    amount = min(settings.reply_tokens, max_tokens or settings.reply_tokens)
+    words = [rng.choice(WORDS) for _ in range(max(1, amount - 6))]
+    words[0] = words[0].title()
+
+    tokens = ["Comments", ": ", "None", "\n", "Response", ": "]
+    tokens.extend(
+        f"{x} " if i < len(words) - 1 else f"{x}." for i, x in enumerate(words)
+    )
+
+    return tokens[: max(1, amount)]
+
+
+def injected_error():
+    if settings.error_rate <= 0 or errors_random.random() >= settings.error_rate:
+        return None
+
+    status = settings.error_status
+    body = {
+        "error": {
+            "message": f"Injected error ({status}) from the mock OpenAI server.",
+            "type": "mock_error",
+            "param": None,
+            "code": None,
+        }
+    }
+    return Response(json.dumps(body), status=status, mimetype="application/json")
+
+
+def usage(prompt: str, completion: str) -> dict:
+    prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(completion)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+@app.post("/v1/chat/completions")
+def chat_completions():
+    error = injected_error()
+    if error is not None:
+        return error
+
+    data = request.get_json()
+    rng = seeded_random("chat", data.get("model"), data.get("messages"))
+    tokens = generate_reply(rng, data.get("max_tokens") or 0)
+    completion_id = f"chatcmpl-{uuid.UUID(int=rng.getrandbits(128)).hex}"
+    created = int(time.time())
+    model = data.get("model", "gpt-3.5-turbo")
+
+    if not data.get("stream"):
+        sleep_latency(rng)
+        time.sleep(len(tokens) / settings.tokens_per_second)
+        content = "".join(tokens)
+        prompt = "".join(x.get("content") or "" for x in data.get("messages", []))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage(prompt, content),
+        }
+
+    def chunk(delta: dict, finish_reason=None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    def generate():
+        sleep_latency(rng)
+        yield chunk({"role": "assistant", "content": ""})
+
+        interval = 1 / settings.tokens_per_second
+        for token in tokens:
+            time.sleep(interval)
+            yield chunk({"content": token})
+
+        yield chunk({}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+@app.post("/v1/completions")
+def completions():
+    error = injected_error()
+    if error is not None:
+        return error
+
+    data = request.get_json()
+    rng = seeded_random("completion", data.get("model"), data.get("prompt"))
+    text = "".join(generate_reply(rng, data.get("max_tokens") or 0))
+
+    sleep_latency(rng)
+    time.sleep(count_tokens(text) / settings.tokens_per_second)
+
+    return {
+        "id": f"cmpl-{uuid.UUID(int=rng.getrandbits(128)).hex}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": data.get("model", "text-davinci-003"),
+        "choices": [
+            {"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}
+        ],
+        "usage": usage(str(data.get("prompt", "")), text),
+    }
+
+
+@app.post("/v1/embeddings")
+def embeddings():
+    error = injected_error()
+    if error is not None:
+        return error
+
+    data = request.get_json()
+    inputs = data.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    vectors = []
+    for text in inputs:
+        rng = seeded_random("embedding", text)
+        vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+        norm = math.sqrt(sum(x * x for x in vector))
+        vectors.append([x / norm for x in vector])
+
+    sleep_latency(random.Random())
+    tokens = sum(count_tokens(x) for x in inputs)
+
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": x}
+            for i, x in enumerate(vectors)
+        ],
+        "model": data.get("model", "text-embedding-ada-002"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.post("/v1/moderations")
+def moderations():
+    error = injected_error()
+    if error is not None:
+        return error
+
+    data = request.get_json()
+    inputs = data.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    results = []
+    for text in inputs:
+        flagged = FLAGGED_MARKER in text
+        categories = {x: flagged and x == "sexual" for x in MODERATION_CATEGORIES}
+        results.append(
+            {
+                "flagged": flagged,
+                "categories": categories,
+                "category_scores": {k: float(v) for k, v in categories.items()},
+            }
+        )
+
+    sleep_latency(random.Random())
+
+    return {
+        "id": f"modr-{uuid.uuid4().hex}",
+        "model": "text-moderation-latest",
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=settings.latency,
+        help="Seconds before the first token (or the whole response).",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=settings.jitter,
+        help="Maximum seconds added to or removed from the latency.",
+    )
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=settings.tokens_per_second
+    )
+    parser.add_argument(
+        "--reply-tokens",
+        type=int,
+        default=settings.reply_tokens,
+        help="Tokens per reply, capped by the max_tokens of the request.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=settings.error_rate,
+        help="Fraction of requests answered with --error-status.",
+    )
+    parser.add_argument("--error-status", type=int, default=settings.error_status)
+    parser.add_argument("--seed", type=int, default=settings.seed)
+
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        setattr(settings, key, value)
+    errors_random.seed(args.seed)
+
+    logger.info(f"Serving the mock OpenAI API on http://{args.host}:{args.port}/v1")
+    eventlet.wsgi.server(eventlet.listen((args.host, args.port)), app, log_output=False)
+
+
+if __name__ == "__main__":
+    main()
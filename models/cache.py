@@ -0,0 +1,10 @@
+import dataclasses
+
+from database import mongoclass
+
+
+@mongoclass.mongoclass()
+@dataclasses.dataclass
+class CacheGeneration:
+    namespace: str
+    generation: int = 0
@@ -11,17 +11,19 @@ from typing import Literal, Optional, Union
 
 import backoff
 import tiktoken
-from database import mongoclass
+from database import get_collection, mongoclass
 from IPy import IP
-from library import actions, users, utils
+from library import (actions, admission, cancellation, llm, tracing, turns,
+                     users, utils)
 from library.configlib import config
 from library.exceptions import *
 from library.gpt import gpt
 from library.security import route_security
 from library.socketio import socketio
-from library.tasks import (error_alert, increase_model_requests_state,
-                           insert_message, log_time_took_metric)
-from openai.embeddings_utils import cosine_similarity, get_embedding
+from library.streams import StreamBuffer
+from library.tasks import (auto_label_message, error_alert,
+                           increase_model_requests_state, log_time_took_metric)
+from openai.embeddings_utils import cosine_similarity
 
 from models.knowledge import Knowledge
 from models.message import Message
@@ -100,6 +102,7 @@ class Character:
     created_at: datetime.datetime = dataclasses.field(
         default_factory=datetime.datetime.now
     )
+    version: int = 0  # Incremented whenever the definition of the character changes
 
     # Embeddings fields
     embeddings: Optional[list[str]] = None
@@ -129,9 +132,7 @@ class Character:
 
         try:
             st = time.perf_counter()
-            self.embeddings = get_embedding(
-                self.embeddings_content, engine="text-embedding-ada-002"
-            )
+            self.embeddings = llm.client.embedding(self.embeddings_content)
             et = time.perf_counter() - st
 
             encoder = tiktoken.get_encoding("cl100k_base")
@@ -217,9 +218,7 @@ class Character:
             return []
 
         rankings = []
-        content_embedding = get_embedding(
-            content, engine="text-embedding-ada-002", api_key=api_key
-        )
+        content_embedding = llm.client.embedding(content, api_key=api_key)
         for knowledge in Knowledge.find_classes({"character_id": self.id}):
             if not knowledge.embeddings:
                 continue
@@ -324,6 +323,7 @@ class Character:
         tweaks: Optional[Tweaks] = None,
         clean_name: bool = True,
         api_key: Optional[str] = None,  # TODO Remove
+        stream_buffer: Optional[StreamBuffer] = None,
         _previous_messages: Optional[list[Message]] = None,
     ) -> list[Message]:
         """
@@ -353,6 +353,9 @@ class Character:
         `id` : Optional[str]
             The ID to give this message. Defaults to None which is to create one
             from scratch.
+        `stream_buffer` : Optional[StreamBuffer]
+            The buffer the tokens of the response are streamed to instead of the
+            user's Socket.IO room. Defaults to None.
 
         Raises
         ------
@@ -360,6 +363,10 @@ class Character:
             Raised if a user cannot be found with the provided `user_id`.
         `ModelRequestsLimitExceeded` :
             When the requests limit has been exceeded.
+        `ConcurrencyLimitExceeded` :
+            When the user already has too many completions in flight.
+        `AdmissionTimeout` :
+            When the completion waited too long for a slot.
 
         Returns
         -------
@@ -369,6 +376,7 @@ class Character:
         """
 
         logger.info(f"Chat as '{role}' with the message '{content}' from '{user_id}'.")
+        tracing.keep(config.main["request_trace_sample_rate"])
 
         # Clean user_name
         if user_name and clean_name:
@@ -394,10 +402,21 @@ class Character:
             )
 
         # Create session if it does not exist
-        session = ChatSession.find_class(
-            {"id": session_id, "character_id": self.id, "created_by": user_id}
-        )
-        if not session:
+        session_query = {
+            "id": session_id,
+            "character_id": self.id,
+            "created_by": user_id,
+        }
+        session_load_st = time.perf_counter()
+        session = ChatSession.find_class(session_query)
+        if session:
+            # Only update the field that changed so the counter caches are never
+            # overwritten with a stale value.
+            session.last_used = datetime.datetime.now()
+            get_collection(ChatSession).update_one(
+                session_query, {"$set": {"last_used": session.last_used}}
+            )
+        else:
             session = ChatSession(
                 id=session_id,
                 name="New Chat",
@@ -410,14 +429,16 @@ class Character:
             logger.info(
                 f"Automatically created session '{session_id}' because it does not exist."
             )
+            session.last_used = datetime.datetime.now()
+            session.save()
+        tracing.record("session_load", session_load_st)
 
-        # Update when the session was last used
-        session.last_used = datetime.datetime.now()
-        session.save()
-        socketio.emit("session-used", {"id": session_id}, room=user_id)
+        with tracing.span("emit"):
+            socketio.emit("session-used", {"id": session_id}, room=user_id)
 
         if role == "assistant":
-            insert_message(**dataclasses.asdict(new_message))
+            with tracing.span("persistence"):
+                turns.commit_turn([new_message])
             return [new_message]
 
         anonymous = True
@@ -426,6 +447,7 @@ class Character:
         except ValueError:
             anonymous = False
 
+        identity_st = time.perf_counter()
         user: Optional[User] = User.find_class({"id": user_id})
         if user is None:
             if not anonymous:
@@ -440,9 +462,11 @@ class Character:
             user.id = user_id
             user.plan = Plan(id="anonymous")
             user.save()
+        tracing.record("identity", identity_st)
 
         is_rapid_api = utils.is_from_rapid_api()
 
+        quota_check_st = time.perf_counter()
         if role != "function":
             # Check if the user has capped their requests limit.
             state: Optional[UserPlanState] = UserPlanState.find_class({"id": user_id})
@@ -461,22 +485,21 @@ class Character:
 
                 if requests_count >= cap and not is_rapid_api:
                     raise ModelRequestsLimitExceeded(model=model_type, limit=cap)
-
-        fetch_messages_st = time.perf_counter()
-        messages = list(
-            Message.find_classes(
-                {
-                    "session_id": session_id,
-                    "character_id": self.id,
-                    "created_by": user_id,
-                }
+        tracing.record("quota_check", quota_check_st)
+
+        with tracing.span("history_fetch"):
+            messages = list(
+                Message.find_classes(
+                    {
+                        "session_id": session_id,
+                        "character_id": self.id,
+                        "created_by": user_id,
+                    }
+                )
+                .sort("_id", -1)
+                .limit(user.plan.max_session_history)
             )
-            .sort("_id", -1)
-            .limit(user.plan.max_session_history)
-        )
-        messages.reverse()
-        fetch_messages_et = time.perf_counter() - fetch_messages_st
-        logger.debug(f"Fetching the messages took {fetch_messages_et}.")
+            messages.reverse()
 
         # Get the knowledge hint
         knowledge_hint = None
@@ -490,6 +513,7 @@ class Character:
             # logger.debug(f"Fetching the knowledge hint took {fetch_knowledge_et}.")
             messages.append(new_message)
 
+        prompt_build_st = time.perf_counter()
         model_parameters = {
             "temperature": self.parameters.temperature,
             "max_tokens": self.parameters.max_tokens,
@@ -573,6 +597,7 @@ class Character:
                 messages=prompt,
                 model=self.parameters.model,
                 api_key=api_key,
+                stream_buffer=stream_buffer,
                 **model_parameters,
             )
 
@@ -595,11 +620,25 @@ class Character:
         if new_message:
             # Remove knowledge hint from the user's message
             new_message.knowledge_hint = None
+        tracing.record("prompt_build", prompt_build_st)
 
         # Generate a response
         processing_st = time.perf_counter()
-        completion: ChatCompletion = completion_function(**completion_parameters)[0]
+        # Lets the generation be stopped from `stop-generation` or a disconnect.
+        cancel_token = cancellation.registry.register(user_id, self.id, session_id)
+        try:
+            if completion_function == gpt.create_chat_completion:
+                completion_parameters["cancel_token"] = cancel_token
+
+            with admission.scheduler.admit(user_id, user.plan):
+                completion: ChatCompletion = completion_function(
+                    **completion_parameters
+                )[0]
+        finally:
+            cancellation.registry.release(cancel_token)
         processing_time = time.perf_counter() - processing_st
+        # Text completions are never streamed so they can't be cancelled.
+        truncated = getattr(completion, "finish_reason", None) == "cancelled"
 
         response = None
         comments = None
@@ -617,7 +656,10 @@ class Character:
 
         else:
             content = completion.result
-            comments, contradictions, response = utils.parse_character_response(content)
+            with tracing.span("parse"):
+                comments, contradictions, response = utils.parse_character_response(
+                    content
+                )
 
         response_message = Message(
             content=response,
@@ -634,20 +676,31 @@ class Character:
             processing_time=processing_time,
             generated=True,
             regenerated=regenerated,
+            truncated=truncated,
             raw_input=content,
             name=name,
             api_key=api_key,
         )
 
+        turn = [response_message]
         if new_message:
-            insert_message(**dataclasses.asdict(new_message))
-
-        insert_message(**dataclasses.asdict(response_message))
+            turn.insert(0, new_message)
+        with tracing.span("persistence"):
+            turns.commit_turn(turn, increment_uses=True)
+
+        # The first completed exchange of a session gets it auto labeled
+        if role == "user" and session.claim_auto_label():
+            logger.info(f"Scheduling auto labeling of session '{session_id}'.")
+            auto_label_message.delay(
+                session_id=session_id,
+                created_by=user_id,
+                character_id=self.id,
+                api_key=api_key,
+            )
         increase_model_requests_state.delay(
             id=user_id, model=self.parameters.model, value=1
         )
         self.uses += 1
-        self.save()
 
         responses = _previous_messages or []
         responses.append(response_message)
@@ -660,6 +713,7 @@ class Character:
                 role="function",
                 clean_name=False,
                 tweaks=tweaks,
+                stream_buffer=stream_buffer,
                 _previous_messages=responses,
             )
 
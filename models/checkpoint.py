@@ -0,0 +1,39 @@
+import dataclasses
+import datetime as dt
+import uuid
+
+from database import mongoclass
+
+
+@mongoclass.mongoclass()
+@dataclasses.dataclass
+class TaskCheckpoint:
+    """
+    Persisted progress of a long running Celery task so it can resume where it
+    stopped if the worker crashes or the task is retried.
+
+    `name` is the name of the task while `key` identifies a specific run of it
+    (i.e., the IDs it was called with).
+    """
+
+    name: str
+    key: str
+    state: dict = dataclasses.field(default_factory=dict)
+    updated_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.now)
+    id: str = dataclasses.field(default_factory=lambda: str(uuid.uuid4()))
+
+    @classmethod
+    def load(cls, name: str, key: str) -> "TaskCheckpoint":
+        """
+        Return the checkpoint of a task run, creating a new one if it does not exist.
+        """
+
+        checkpoint = cls.find_class({"name": name, "key": key})
+        if checkpoint is None:
+            checkpoint = cls(name=name, key=key)
+
+        return checkpoint
+
+    def commit(self) -> None:
+        self.updated_at = dt.datetime.now()
+        self.save()
@@ -5,9 +5,10 @@ import traceback
 import uuid
 from typing import IO, Optional
 
-from database import fs, mongoclass
+from database import fs, get_collection, mongoclass
 from gridfs import GridOut
-from library import tasks, utils
+from library import images, tasks
+from library.exceptions import InvalidImage
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +27,8 @@ class File:
     private: bool = False
     mimetype: Optional[str] = None
     uploaded: bool = False
+    processed: bool = False
+    variants: list[str] = dataclasses.field(default_factory=list)
     id: str = dataclasses.field(default_factory=lambda: str(uuid.uuid4()))
 
     created_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.now)
@@ -36,41 +39,74 @@ class File:
             uploaded_text = "Not Uploaded"
         return f"{self.type} {self.filename} ({self.id}) ({uploaded_text})"
 
-    def get_file(self) -> Optional[GridOut]:
-        file = fs.find_one({"id": self.id})
+    def get_file(self, variant: Optional[str] = None) -> Optional[GridOut]:
+        """
+        Get the original contents of the file, or one of its pre-rendered variants
+        (i.e., `128.webp`).
+        """
+
+        file = fs.find_one({"id": self.id, "variant": variant})
         return file
 
     def delete_file(self) -> bool:
         """
-        Deletes the File object as well as the actual file contents in the database.
-        Returns False if the file contents never got uploaded
+        Deletes the File object as well as the actual file contents (and every
+        variant of it) in the database. Returns False if the file contents never got
+        uploaded
         """
 
         self.delete()
+        images.forget_avatar(self.id)
         if not self.uploaded:
             return False
 
-        file = self.get_file()
-        fs.delete(file._id)
+        for file in fs.find({"id": self.id}):
+            fs.delete(file._id)
         return True
 
+    def process(self) -> None:
+        """
+        Process the raw upload of an avatar into its original and variants. This is
+        slow and is meant to be called from the `process_avatar` task.
+        """
+
+        variants = images.process_avatar(self.id)
+        if variants is None:
+            return
+
+        self.variants = variants
+        self.processed = True
+        get_collection(File).update_one(
+            {"id": self.id}, {"$set": {"variants": variants, "processed": True}}
+        )
+        logger.info(f"Processed '{self}' into {len(variants)} variants.")
+
     @classmethod
     def from_file_like_object(cls, f: IO, **kwargs):
         """
-        Create and upload the provided file.
+        Create and upload the provided file. The contents are streamed to GridFS as
+        they are, avatars are stored as a raw upload that is processed in the
+        background by the `process_avatar` task.
+
+        Raises
+        ------
+        `InvalidImage` :
+            If the file is larger than `images.MAX_UPLOAD_SIZE`.
         """
 
         file = cls(**kwargs)
-        if kwargs["type"] == "avatar":
-            try:
-                f = utils.compress_image(f, 5 * 1024 * 1024)
-            except OSError:
-                f.seek(0)
+        metadata = {"id": file.id}
+        if file.type == "avatar":
+            metadata["variant"] = images.RAW_VARIANT
+        else:
+            file.processed = True
 
         try:
-            fs.put(f, id=file.id)
+            images.put_stream(f, max_size=images.MAX_UPLOAD_SIZE, **metadata)
             file.uploaded = True
             logger.info(f"Successfully uploaded '{file}'.")
+        except InvalidImage:
+            raise
         except Exception:
             logger.exception(f"Error while uploading '{file}'.")
             tasks.error_alert.delay(
@@ -79,6 +115,9 @@ class File:
                 traceback.format_exc(),
                 metadata=dataclasses.asdict(file),
             )
+
         file.save()
+        if file.uploaded and not file.processed:
+            tasks.process_avatar.delay(file.id)
 
         return file
@@ -6,7 +6,7 @@ from typing import Optional
 
 import tiktoken
 from database import mongoclass
-from openai.embeddings_utils import get_embedding
+from library import llm
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +49,7 @@ class Knowledge:
         )
 
         st = time.perf_counter()
-        self.embeddings = get_embedding(self.content, engine="text-embedding-ada-002")
+        self.embeddings = llm.client.embedding(self.content)
         self.et = time.perf_counter() - st
 
         logger.info(
@@ -1,31 +1,176 @@
 import dataclasses
+import datetime as dt
 import logging
-from contextlib import contextmanager
+import os
+import socket
+import threading
+import uuid
+from typing import Optional
 
-from database import mongoclass
+from database import get_collection, mongoclass
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 logger = logging.getLogger(__name__)
 
+_indexes_created = False
+
 
 @mongoclass.mongoclass()
 @dataclasses.dataclass
 class CeleryLock:
+    """
+    A lease on a singleton celery job. It is held by `owner` until `expires_at`,
+    after which anyone can take it over. `expires_at` is always computed by the
+    MongoDB server (`$$NOW`) so the clocks of the workers don't matter.
+
+    `token` is incremented every time the lock is acquired (a fencing token), so a
+    holder whose lease expired can tell it has been taken over since.
+    """
+
     name: str
-    open: bool = True
+    owner: Optional[str] = None
+    token: int = 0
+    expires_at: Optional[dt.datetime] = None
+
+
+def _collection():
+    global _indexes_created
+
+    collection = get_collection(CeleryLock)
+    if not _indexes_created:
+        collection.create_index([("name", ASCENDING)], unique=True)
+        _indexes_created = True
+
+    return collection
 
 
 class CeleryLockContext:
-    def __init__(self, lock: str):
-        self.lock: CeleryLock = CeleryLock.find_class({"name": lock})
 
-    def __enter__(self):
-        if not self.lock.open:
+    """
+    Hold the lock of a singleton job for the duration of the block. The lease is
+    renewed every `ttl / 3` seconds while the block runs and released when it
+    exits, so a worker that crashes only holds it for `ttl` seconds at most.
+
+    Usage:
+    ```
+    with CeleryLockContext("update_characters_embeddings") as lock:
+        if lock is None:
+            return  # Another worker holds it.
+
+        for character in characters:
+            ...
+            if not lock.verify():
+                break
+            character.save()
+    ```
+    """
+
+    def __init__(self, lock: str, ttl: float = 60) -> None:
+        self.name = lock
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.token: Optional[int] = None
+
+        self._lost = False
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @property
+    def held(self) -> bool:
+        """
+        False once a renewal found the lock taken over or released.
+        """
+
+        return self.token is not None and not self._lost
+
+    def _expires_at(self) -> dict:
+        return {"$add": ["$$NOW", int(self.ttl * 1000)]}
+
+    def _acquire(self) -> bool:
+        try:
+            document = _collection().find_one_and_update(
+                {
+                    "name": self.name,
+                    "$expr": {
+                        "$lte": [{"$ifNull": ["$expires_at", None]}, "$$NOW"],
+                    },
+                },
+                [
+                    {
+                        "$set": {
+                            "owner": self.owner,
+                            "expires_at": self._expires_at(),
+                            "token": {"$add": [{"$ifNull": ["$token", 0]}, 1]},
+                        }
+                    },
+                    {"$unset": "open"},
+                ],
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The lock exists and is held, so the upsert tried to insert it again.
+            return False
+
+        self.token = document["token"]
+        return True
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            result = _collection().update_one(
+                {"name": self.name, "owner": self.owner, "token": self.token},
+                [{"$set": {"expires_at": self._expires_at()}}],
+            )
+            if not result.matched_count:
+                logger.warning(
+                    f"Lost the lock '{self.name}' (token {self.token}), it was taken over."
+                )
+                self._lost = True
+                return
+
+    def verify(self) -> bool:
+        """
+        Check with the database that the lease is still ours and hasn't expired.
+        Call this right before every write the lock protects, a holder that was
+        taken over must not write anymore.
+        """
+
+        if not self.held:
+            return False
+
+        held = _collection().count_documents(
+            {
+                "name": self.name,
+                "owner": self.owner,
+                "token": self.token,
+                "$expr": {"$gt": ["$expires_at", "$$NOW"]},
+            },
+            limit=1,
+        )
+        if not held:
+            logger.warning(f"The lock '{self.name}' (token {self.token}) expired.")
+            self._lost = True
+
+        return bool(held)
+
+    def __enter__(self) -> Optional["CeleryLockContext"]:
+        if not self._acquire():
             return None
 
-        self.lock.open = False
-        self.lock.save()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        if self._heartbeat is None:
+            return
+
+        self._stop.set()
+        self._heartbeat.join()
+
+        _collection().update_one(
+            {"name": self.name, "owner": self.owner, "token": self.token},
+            {"$set": {"owner": None, "expires_at": None}},
+        )
@@ -31,6 +31,7 @@ class Message:
     raw_input: Optional[str] = None
     generated: bool = False  # True if this message is generated by a LLM
     regenerated: bool = False  # True if this message was regenerated
+    truncated: bool = False  # True if the generation was stopped before it ended
 
     processing_time: Optional[float] = None
     name: Optional[str] = None
@@ -17,3 +17,49 @@ class TimeTookMetric:
     ip_address: Optional[str] = None
     created_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.now)
     id: str = dataclasses.field(default_factory=lambda: str(uuid.uuid4()))
+
+
+@mongoclass.mongoclass()
+@dataclasses.dataclass
+class RequestTrace:
+    """
+    The per-stage latency breakdown of a request (i.e., a chat turn) as recorded by
+    `library.tracing`. Durations are in milliseconds.
+    """
+
+    name: str
+    duration: float
+    stages: dict
+    spans: list[dict]
+    user_id: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.now)
+    id: str = dataclasses.field(default_factory=lambda: str(uuid.uuid4()))
+
+    def to_json(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+@mongoclass.mongoclass()
+@dataclasses.dataclass
+class CompletionRollup:
+    """
+    Pre-aggregated statistics of OpenAI completions for a single model within a
+    single time bucket. These are maintained incrementally by `library.rollups` so
+    reading usage metrics never has to scan the completion collections.
+
+    Each of the `tokens`, `cost` and `latency` fields is a dict with the keys
+    `count`, `sum`, `min`, `max` and `sketch` (an approximate quantile sketch).
+
+    Chat rollups also have the streaming metrics of `rollups.STREAM_METRICS` (i.e.,
+    `ttft`, `tokens_per_second`) in the same shape.
+    """
+
+    kind: str  # "chat" or "text"
+    model: str
+    granularity: str  # "hour", "day" or "month"
+    bucket: dt.datetime
+    count: int = 0
+    tokens: dict = dataclasses.field(default_factory=dict)
+    cost: dict = dataclasses.field(default_factory=dict)
+    latency: dict = dataclasses.field(default_factory=dict)
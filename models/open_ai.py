@@ -66,3 +66,11 @@ class ChatCompletion:
 
     function_call: Optional[dict] = None
     function_tokens: int = 0
+
+    # Streaming (in milliseconds, see `CompletionStream.timings`)
+    ttft: Optional[float] = None
+    max_chunk_gap: Optional[float] = None
+    mean_chunk_gap: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    upstream_wait: Optional[float] = None
+    chunk_processing_time: Optional[float] = None
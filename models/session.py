@@ -3,7 +3,7 @@ import datetime as dt
 import uuid
 from typing import TYPE_CHECKING, Generator, Optional
 
-from database import mongoclass
+from database import get_collection, mongoclass
 
 from models.message import Message
 from models.tweaks import Tweaks
@@ -22,22 +22,14 @@ class ChatSession:
     story_mode: bool = False
     story: Optional[str] = None
     name_changed: bool = False
+    labeled: bool = False  # True once the session got scheduled for auto labeling
     shared_memory: bool = False
     public_memory: bool = False
+    messages_count: int = 0  # Counter cache, see `library.counters`
     last_used: Optional[dt.datetime] = None
     created_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.now)
     id: str = dataclasses.field(default_factory=lambda: str(uuid.uuid()))
 
-    @property
-    def messages_count(self) -> int:
-        return Message.count_documents(
-            {
-                "session_id": self.id,
-                "character_id": self.character_id,
-                "created_by": self.created_by,
-            }
-        )
-
     @property
     def memories_count(self) -> int:
         from models.summary import ConversationSummary
@@ -81,8 +73,30 @@ class ChatSession:
             }
         )
 
-    def to_json(self) -> dict:
-        data = dataclasses.asdict(self)
-        data["messages_count"] = self.messages_count
+    def claim_auto_label(self) -> bool:
+        """
+        Atomically flag this session as labeled. Only the caller that actually
+        flipped the flag gets `True`, which guarantees the auto labeling job is only
+        scheduled once per session. Sessions that were manually named are skipped.
+        """
+
+        if self.labeled or self.name_changed:
+            return False
 
-        return data
+        document = get_collection(ChatSession).find_one_and_update(
+            {
+                "id": self.id,
+                "character_id": self.character_id,
+                "created_by": self.created_by,
+                "labeled": {"$ne": True},
+                "name_changed": {"$ne": True},
+            },
+            {"$set": {"labeled": True}},
+            projection={"_id": 1},
+        )
+        self.labeled = True
+
+        return document is not None
+
+    def to_json(self) -> dict:
+        return dataclasses.asdict(self)
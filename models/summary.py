@@ -8,9 +8,8 @@ from typing import Optional
 import backoff
 import tiktoken
 from database import mongoclass
-from library import tasks
+from library import llm, tasks
 from library.security import route_security
-from openai.embeddings_utils import get_embedding
 
 logger = logging.getLogger(__name__)
 
@@ -50,9 +49,7 @@ class ConversationSummary:
 
         try:
             st = time.perf_counter()
-            self.embeddings = get_embedding(
-                self.summary, engine="text-embedding-ada-002"
-            )
+            self.embeddings = llm.client.embedding(self.summary)
             et = time.perf_counter() - st
 
             encoder = tiktoken.get_encoding("cl100k_base")
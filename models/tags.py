@@ -9,9 +9,8 @@ from typing import Optional
 import backoff
 import tiktoken
 from database import mongoclass
-from library import tasks, utils
+from library import llm, tasks, utils
 from library.security import route_security
-from openai.embeddings_utils import get_embedding
 
 logger = logging.getLogger(__name__)
 
@@ -60,9 +59,7 @@ class Tag:
 
         try:
             st = time.perf_counter()
-            self.embeddings = get_embedding(
-                self.embeddings_content, engine="text-embedding-ada-002"
-            )
+            self.embeddings = llm.client.embedding(self.embeddings_content)
             et = time.perf_counter() - st
 
             encoder = tiktoken.get_encoding("cl100k_base")
@@ -54,9 +54,30 @@ class Plan:
             config.plans[self.id]["name"],
         )
 
-    def to_json(self, user_id: Optional[str] = None) -> dict:
-        from .character import Character
+    @property
+    def max_concurrent_completions(self) -> int:
+        return self.restrictions.get(
+            "max_concurrent_completions",
+            config.plans[self.id]["max_concurrent_completions"],
+        )
+
+    @property
+    def scheduling_weight(self) -> int:
+        return self.restrictions.get(
+            "scheduling_weight",
+            config.plans[self.id]["scheduling_weight"],
+        )
+
+    @property
+    def max_queue_wait(self) -> float:
+        return self.restrictions.get(
+            "max_queue_wait",
+            config.plans[self.id]["max_queue_wait"],
+        )
 
+    def to_json(
+        self, user_id: Optional[str] = None, characters: Optional[int] = None
+    ) -> dict:
         state = None
         if user_id:
             state: Optional[UserPlanState] = UserPlanState.find_class({"id": user_id})
@@ -71,7 +92,7 @@ class Plan:
         }
         if state is not None:
             data["requests"] = state.basic_model_requests
-            data["characters"] = Character.count_documents({"created_by": user_id})
+            data["characters"] = characters
 
         return data
 
@@ -106,6 +127,10 @@ class User:
     # New Fields
     display_name_changed: bool = False
 
+    # Counter caches, see `library.counters`
+    messages_count: int = 0
+    characters_count: int = 0
+
     def __post_init__(self) -> None:
         if isinstance(self.password, str):
             self.password = bcrypt.hashpw(self.password.encode(), bcrypt.gensalt())
@@ -124,7 +149,7 @@ class User:
         """
 
         data = dataclasses.asdict(self)
-        data["plan"] = self.plan.to_json(self.id)
+        data["plan"] = self.plan.to_json(self.id, characters=self.characters_count)
         data.pop("password")
         data.pop("admin")
         data.pop("account_type")
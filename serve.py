@@ -0,0 +1,170 @@
+"""
+Run the web server as several processes so it uses more than one core, each
+process being a single eventlet loop (`app.py`) listening on its own port.
+
+Socket.IO polling and the chat streams (`/api/chat/stream`) need a client to keep
+hitting the same process, so nginx balances the ports with `ip_hash` (see
+`nginx.conf`) rather than the processes sharing a single port. The list of ports
+nginx balances is written to `--upstream-file` on start, so it always matches the
+amount of processes. Events emitted by any process reach every client through the
+Socket.IO message queue.
+
+A process that exits is restarted, SIGTERM and SIGINT stop every process.
+`--check` exits with 1 unless every process is ready (`/api/health/ready`).
+
+Usage:
+```
+PRODUCTION=1 python serve.py --workers 4 --base-port 8000
+python serve.py --workers 4 --base-port 8000 --check
+```
+"""
+
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Optional
+
+import coloredlogs
+
+coloredlogs.install(level="INFO")
+logger = logging.getLogger(__name__)
+
+# Seconds the processes get to exit on their own when stopping.
+STOP_TIMEOUT = 10
+
+# Seconds to wait before restarting a process that exited.
+RESTART_DELAY = 1
+
+
+def write_upstream(path: str, host: str, ports: list[int]) -> None:
+    """
+    Write the `server` lines of the nginx upstream, see `nginx.conf`.
+    """
+
+    with open(path, "w") as f:
+        for port in ports:
+            f.write(f"server {host}:{port} max_fails=3 fail_timeout=10s;\n")
+
+    logger.info(f"Wrote the upstream of {len(ports)} workers to '{path}'.")
+
+
+def check(ports: list[int]) -> int:
+    """
+    Return 0 if every process is ready, 1 otherwise.
+    """
+
+    status = 0
+    for port in ports:
+        url = f"http://127.0.0.1:{port}/api/health/ready"
+        try:
+            urllib.request.urlopen(url, timeout=2)
+        except (urllib.error.URLError, OSError) as e:
+            logger.error(f"Worker on port {port} isn't ready: {e}")
+            status = 1
+
+    return status
+
+
+class Worker:
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(
+            [sys.executable, "app.py"], env={**os.environ, "PORT": str(self.port)}
+        )
+        logger.info(f"Started worker {self.process.pid} on port {self.port}.")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("WEB_WORKERS") or os.cpu_count() or 1),
+        help="Amount of processes, defaults to `WEB_WORKERS` or the amount of cores.",
+    )
+    parser.add_argument(
+        "--base-port",
+        type=int,
+        default=int(os.getenv("WEB_BASE_PORT", 8000)),
+        help="The first process listens on this port, the next on the one after it.",
+    )
+    parser.add_argument(
+        "--upstream-file",
+        default=os.getenv("NGINX_UPSTREAM_FILE"),
+        help="Where to write the nginx upstream servers, defaults to `NGINX_UPSTREAM_FILE`.",
+    )
+    parser.add_argument(
+        "--upstream-host",
+        default=os.getenv("WEB_HOST", "web"),
+        help="The host nginx reaches the processes on, defaults to `WEB_HOST` or web.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check that every process is ready instead of starting them.",
+    )
+    args = parser.parse_args()
+
+    ports = [args.base_port + i for i in range(args.workers)]
+    if args.check:
+        sys.exit(check(ports))
+
+    # The processes split the `llm_max_concurrency` of `library.admission` by this.
+    os.environ["WEB_WORKERS"] = str(args.workers)
+
+    if args.upstream_file:
+        write_upstream(args.upstream_file, args.upstream_host, ports)
+
+    workers = [Worker(port) for port in ports]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in workers:
+        worker.start()
+
+    while not stopping:
+        time.sleep(RESTART_DELAY)
+
+        for worker in workers:
+            if stopping or worker.alive():
+                continue
+
+            logger.warning(
+                f"Worker on port {worker.port} exited with {worker.process.returncode}, restarting it."
+            )
+            worker.start()
+
+    logger.info("Stopping workers...")
+    for worker in workers:
+        if worker.alive():
+            worker.process.terminate()
+
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for worker in workers:
+        try:
+            worker.process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Worker on port {worker.port} didn't stop, killing it.")
+            worker.process.kill()
+
+
+if __name__ == "__main__":
+    main()
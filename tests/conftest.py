@@ -0,0 +1,46 @@
+import os
+import sys
+from pathlib import Path
+
+# The app reads its configuration from the working directory and needs these to
+# be set at import time. Unlike the benchmarks these tests talk to a real MongoDB
+# (`MONGODB_URI`), a throwaway database is used and dropped before every test.
+ROOT = Path(__file__).resolve().parent.parent
+os.chdir(ROOT)
+sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("MONGODB_URI", "mongodb://127.0.0.1:27017")
+os.environ["MONGODB_DB_NAME"] = "optitalk-tests"
+os.environ.setdefault("CELERY_BROKER_URI", "memory://")
+os.environ.setdefault("CELERY_BACKEND_URI", "cache+memory://")
+
+import pymongo
+import pytest
+from pymongo.errors import PyMongoError
+
+
+def _mongodb_available() -> bool:
+    client = pymongo.MongoClient(
+        os.environ["MONGODB_URI"], serverSelectionTimeoutMS=2000
+    )
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+MONGODB_AVAILABLE = _mongodb_available()
+
+
+@pytest.fixture(autouse=True)
+def database():
+    if not MONGODB_AVAILABLE:
+        pytest.skip("MongoDB isn't reachable at MONGODB_URI.")
+
+    from database import db, mongoclass
+
+    mongoclass.drop_database(db.name)
+    yield db
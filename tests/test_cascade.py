@@ -0,0 +1,93 @@
+from library import cascade
+from models.character import Character, FavoriteCharacter
+from models.knowledge import Knowledge
+from models.message import Message
+from models.session import ChatSession
+from models.summary import ConversationSummary
+from models.user import User
+
+
+def make_session(session_id: str, character_id: str, created_by: str) -> None:
+    ChatSession(
+        created_by=created_by,
+        name="New Chat",
+        character_id=character_id,
+        id=session_id,
+    ).insert()
+
+    for i in range(3):
+        Message(
+            role="user" if i % 2 == 0 else "assistant",
+            session_id=session_id,
+            character_id=character_id,
+            created_by=created_by,
+            content=f"Message {i}",
+        ).insert()
+
+    ConversationSummary(
+        summary="Summary",
+        session_id=session_id,
+        created_by=created_by,
+        character_id=character_id,
+        messages_summarized=3,
+    ).insert()
+
+
+def count(model: type, query: dict) -> int:
+    return model.count_documents(query)
+
+
+def test_chat_session_cascade_only_deletes_the_session():
+    make_session("a", "character", "user")
+    make_session("b", "character", "user")
+
+    query = {"id": "a", "character_id": "character", "created_by": "user"}
+    counts = cascade.run_cascade(cascade.chat_session_cascade(query), throttle=0)
+
+    assert counts == {"Message": 3, "ConversationSummary": 1, "ChatSession": 1}
+    assert count(Message, {"session_id": "a"}) == 0
+    assert count(ConversationSummary, {"session_id": "a"}) == 0
+    assert count(ChatSession, {"id": "a"}) == 0
+
+    assert count(Message, {"session_id": "b"}) == 3
+    assert count(ChatSession, {"id": "b"}) == 1
+
+
+def test_character_cascade_deletes_every_child():
+    Character(created_by="owner", name="A", description="", id="character").insert()
+    make_session("a", "character", "owner")
+    make_session("b", "character", "someone")
+    Knowledge(character_id="character", created_by="owner", content="Fact").insert()
+    FavoriteCharacter(user_id="someone", character_id="character").insert()
+
+    cascade.run_cascade(
+        cascade.character_cascade("character"), batch_size=2, throttle=0
+    )
+
+    query = {"character_id": "character"}
+    for model in (Message, ConversationSummary, ChatSession, Knowledge):
+        assert count(model, query) == 0
+    assert count(FavoriteCharacter, query) == 0
+    assert count(Character, {"id": "character"}) == 0
+
+
+def test_user_cascade_deletes_the_user_and_their_characters():
+    User(
+        email="owner@example.com", display_name="Owner", password="", id="owner"
+    ).insert()
+    Character(created_by="owner", name="A", description="", id="mine").insert()
+    Character(created_by="other", name="B", description="", id="theirs").insert()
+    make_session("a", "mine", "someone")
+    make_session("b", "theirs", "owner")
+    make_session("c", "theirs", "other")
+
+    cascade.run_cascade(cascade.user_cascade("owner"), throttle=0)
+
+    assert count(User, {"id": "owner"}) == 0
+    assert count(Character, {"id": "mine"}) == 0
+    assert count(Message, {"character_id": "mine"}) == 0
+    assert count(Message, {"created_by": "owner"}) == 0
+    assert count(ChatSession, {"id": {"$in": ["a", "b"]}}) == 0
+
+    assert count(Character, {"id": "theirs"}) == 1
+    assert count(Message, {"session_id": "c"}) == 3
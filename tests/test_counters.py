@@ -0,0 +1,56 @@
+from library import counters
+from models.character import Character
+from models.message import Message
+from models.session import ChatSession
+from models.user import User
+
+
+def make_user() -> None:
+    User(email="user@example.com", display_name="User", password="", id="user").insert()
+
+
+def test_increment_user_updates_the_stored_user():
+    make_user()
+
+    counters.increment_user("user", characters_count=1)
+    counters.increment_user("user", characters_count=1)
+    assert User.find_class({"id": "user"}).characters_count == 2
+
+    counters.increment_user("user", characters_count=-5)
+    assert User.find_class({"id": "user"}).characters_count == 0
+
+
+def test_increment_messages_updates_the_session_and_user():
+    make_user()
+    ChatSession(
+        created_by="user", name="New Chat", character_id="character", id="session"
+    ).insert()
+
+    counters.increment_messages("session", "character", "user", amount=3)
+
+    assert ChatSession.find_class({"id": "session"}).messages_count == 3
+    assert User.find_class({"id": "user"}).messages_count == 3
+
+
+def test_repair_counters_recomputes_the_stored_counters():
+    make_user()
+    ChatSession(
+        created_by="user", name="New Chat", character_id="character", id="session"
+    ).insert()
+    for name in ("A", "B"):
+        Character(created_by="user", name=name, description="").insert()
+    for i in range(4):
+        Message(
+            role="user",
+            session_id="session",
+            character_id="character",
+            created_by="user",
+            content=f"Message {i}",
+        ).insert()
+
+    counters.repair_counters()
+
+    user = User.find_class({"id": "user"})
+    assert user.characters_count == 2
+    assert user.messages_count == 4
+    assert ChatSession.find_class({"id": "session"}).messages_count == 4
@@ -0,0 +1,38 @@
+from database import get_collection, save_fields
+from models.message import Message
+from models.session import ChatSession
+
+
+def test_get_collection_is_the_mongoclass_collection():
+    get_collection(Message).insert_one(
+        Message(
+            role="user",
+            session_id="session",
+            character_id="character",
+            created_by="user",
+            content="Hello",
+            id="message",
+        ).as_json()
+    )
+
+    message = Message.find_class({"id": "message"})
+    assert message is not None
+    assert message.content == "Hello"
+
+
+def test_save_fields_only_writes_the_fields():
+    session = ChatSession(
+        created_by="user", name="Old", character_id="character", id="session"
+    )
+    session.insert()
+
+    get_collection(ChatSession).update_one(
+        {"id": "session"}, {"$inc": {"messages_count": 2}}
+    )
+
+    session.name = "New"
+    save_fields(session, "name")
+
+    session = ChatSession.find_class({"id": "session"})
+    assert session.name == "New"
+    assert session.messages_count == 2
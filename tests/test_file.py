@@ -0,0 +1,25 @@
+import io
+
+from library import images
+from models.file import File
+from PIL import Image
+
+
+def test_process_persists_the_variants():
+    raw = io.BytesIO()
+    Image.new("RGB", (300, 200), "red").save(raw, format="PNG")
+    raw.seek(0)
+
+    file = File(type="avatar", filename="avatar.png", created_by="user", uploaded=True)
+    images.put_stream(raw, id=file.id, variant=images.RAW_VARIANT)
+    file.insert()
+
+    file.process()
+
+    stored = File.find_class({"id": file.id})
+    assert stored.processed
+    assert stored.variants == file.variants
+    assert stored.variants
+    for variant in stored.variants:
+        assert stored.get_file(variant) is not None
+    assert stored.get_file(images.RAW_VARIANT) is None
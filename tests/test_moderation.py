@@ -0,0 +1,50 @@
+from library import tasks
+from models.character import Character
+from models.checkpoint import TaskCheckpoint
+
+CLEAN = {
+    "categories": {"sexual": False, "sexual/minors": False, "violence/graphic": False}
+}
+FLAGGED = {
+    "categories": {"sexual": True, "sexual/minors": False, "violence/graphic": False}
+}
+
+
+def make_characters() -> None:
+    Character(created_by="user", name="Clean", description="", id="clean").insert()
+    Character(created_by="user", name="Flagged", description="", id="flagged").insert()
+
+
+def test_moderation_writes_the_results(monkeypatch):
+    make_characters()
+    monkeypatch.setattr(
+        tasks,
+        "_moderate_batch",
+        lambda batch: [FLAGGED if x["id"] == "flagged" else CLEAN for x in batch],
+    )
+
+    tasks.auto_moderate_characters()
+
+    clean = Character.find_class({"id": "clean"})
+    assert clean._moderated and not clean.nsfw
+
+    flagged = Character.find_class({"id": "flagged"})
+    assert flagged._moderated and flagged.nsfw and flagged.version == 1
+
+    assert TaskCheckpoint.count_documents({"name": "auto_moderate_characters"}) == 0
+
+
+def test_failed_batches_are_retried(monkeypatch):
+    make_characters()
+
+    monkeypatch.setattr(tasks, "_moderate_batch", lambda batch: None)
+    tasks.auto_moderate_characters()
+
+    assert Character.count_documents({"_moderated": True}) == 0
+    checkpoint = TaskCheckpoint.find_class({"name": "auto_moderate_characters"})
+    assert checkpoint is None or "after" not in checkpoint.state
+
+    monkeypatch.setattr(tasks, "_moderate_batch", lambda batch: [CLEAN] * len(batch))
+    tasks.auto_moderate_characters()
+
+    assert Character.count_documents({"_moderated": True}) == 2
@@ -0,0 +1,14 @@
+from library import tasks
+from models.metric import RequestTrace
+
+
+def test_request_traces_expire(monkeypatch, database):
+    monkeypatch.setattr(tasks, "_request_trace_ttl", None)
+
+    tasks.log_request_trace(name="chat", duration=1.0, stages={}, spans=[])
+
+    collection = database[RequestTrace.COLLECTION_NAME]
+    assert collection.count_documents({"name": "chat"}) == 1
+
+    index = collection.index_information()["created_at_ttl"]
+    assert index["expireAfterSeconds"] == tasks._request_trace_ttl
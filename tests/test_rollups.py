@@ -0,0 +1,120 @@
+import datetime as dt
+
+from library import rollups
+from models.open_ai import ChatCompletion, Completion
+
+
+def make_chat_completion(created: dt.datetime, id: str) -> ChatCompletion:
+    return ChatCompletion(
+        id=id,
+        result="Hello",
+        finish_reason="stop",
+        created=created,
+        model="gpt-3.5-turbo",
+        object="chat.completion",
+        tt=1.5,
+        completion_tokens=10,
+        prompt_tokens=90,
+        total_tokens=100,
+        temperature=1,
+        max_tokens=200,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        messages=[],
+    )
+
+
+def make_completion(created: dt.datetime, id: str) -> Completion:
+    return Completion(
+        id=id,
+        choices=[{"text": "Hello"}],
+        created=created,
+        model="text-davinci-003",
+        object="text_completion",
+        tt=0.5,
+        completion_tokens=5,
+        prompt_tokens=15,
+        total_tokens=20,
+        temperature=1,
+        max_tokens=50,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        prompt="Hi",
+    )
+
+
+def test_rebuild_reads_the_completion_collections():
+    created = dt.datetime(2023, 5, 10, 12, 30)
+    make_chat_completion(created, "a").insert()
+    make_chat_completion(created, "b").insert()
+    make_completion(created, "c").insert()
+
+    assert rollups.rebuild_rollups() > 0
+
+    chat = rollups.read_rollups("chat")
+    assert chat["gpt-3.5-turbo"]["count"] == 2
+    assert chat["gpt-3.5-turbo"]["tokens"]["sum"] == 200
+
+    text = rollups.read_rollups("text")
+    assert text["text-davinci-003"]["count"] == 1
+
+
+def test_record_and_rebuild_agree():
+    created = dt.datetime(2023, 5, 10, 12, 30)
+    completion = make_chat_completion(created, "a")
+    completion.insert()
+    rollups.record_completion(
+        "chat", completion.model, created, tokens=100, latency=1.5
+    )
+    live = rollups.read_rollups("chat", created - dt.timedelta(days=1))
+
+    rollups.rebuild_rollups()
+    rebuilt = rollups.read_rollups("chat", created - dt.timedelta(days=1))
+
+    assert live["gpt-3.5-turbo"]["count"] == rebuilt["gpt-3.5-turbo"]["count"] == 1
+
+
+def test_ranges_spanning_months_read_monthly_rollups():
+    timestamps = [
+        dt.datetime(2023, 1, 31, 23, 30),
+        dt.datetime(2023, 2, 14, 8, 0),
+        dt.datetime(2023, 3, 1, 0, 15),
+        dt.datetime(2023, 4, 2, 10, 0),
+    ]
+    for timestamp in timestamps:
+        rollups.record_completion("chat", "gpt-4", timestamp, tokens=10)
+
+    def read(start, end) -> int:
+        models = rollups.read_rollups("chat", start, end)
+        return models["gpt-4"]["count"] if models else 0
+
+    end = dt.datetime(2023, 4, 2, 10, 30)
+    assert read(None, end) == 4
+    assert read(dt.datetime(2023, 1, 31, 23), end) == 4
+    assert read(dt.datetime(2023, 2, 1), dt.datetime(2023, 3, 1)) == 1
+    assert read(dt.datetime(2023, 2, 14, 9), dt.datetime(2023, 4, 2)) == 1
+
+    months = [
+        x
+        for x in rollups._range_query(dt.datetime(2022, 1, 15), end)
+        if x["granularity"] == "month"
+    ]
+    assert months[0]["bucket"] == {
+        "$gte": dt.datetime(2022, 2, 1),
+        "$lt": dt.datetime(2023, 4, 1),
+    }
+
+
+def test_rebuild_replaces_live_rollups_and_removes_stale_ones(database):
+    created = dt.datetime(2023, 5, 10, 12, 30)
+    make_chat_completion(created, "a").insert()
+    rollups.record_completion("chat", "gpt-3.5-turbo", created, tokens=100)
+    rollups.record_completion("chat", "gpt-4", created, tokens=100)
+
+    rollups.rebuild_rollups()
+
+    models = rollups.read_rollups("chat")
+    assert models["gpt-3.5-turbo"]["count"] == 1
+    assert "gpt-4" not in models
@@ -0,0 +1,31 @@
+from models.session import ChatSession
+
+
+def make_session(**kwargs) -> ChatSession:
+    session = ChatSession(
+        created_by="user",
+        name="New Chat",
+        character_id="character",
+        id="session",
+        **kwargs,
+    )
+    session.insert()
+    return session
+
+
+def test_claim_auto_label_only_once():
+    make_session()
+
+    first = ChatSession.find_class({"id": "session"})
+    second = ChatSession.find_class({"id": "session"})
+
+    assert first.claim_auto_label()
+    assert not second.claim_auto_label()
+    assert ChatSession.find_class({"id": "session"}).labeled
+
+
+def test_claim_auto_label_skips_renamed_sessions():
+    session = make_session(name_changed=True)
+    session.name_changed = False
+
+    assert not session.claim_auto_label()
@@ -0,0 +1,60 @@
+import pytest
+from library import tasks
+from models.checkpoint import TaskCheckpoint
+from models.message import Message
+from models.session import ChatSession
+from models.user import User
+
+
+@pytest.fixture
+def events(monkeypatch):
+    emitted = []
+    monkeypatch.setattr(
+        tasks, "external_emit", lambda event, *args, **kwargs: emitted.append(event)
+    )
+    return emitted
+
+
+def make_user(user_id: str, messages_count: int = 0) -> None:
+    User(
+        email=f"{user_id}@example.com",
+        display_name=user_id,
+        password="",
+        id=user_id,
+        messages_count=messages_count,
+    ).insert()
+
+
+def test_transfer_moves_sessions_and_messages(events):
+    make_user("old", messages_count=2)
+    make_user("new")
+    ChatSession(
+        created_by="old", name="New Chat", character_id="character", id="session"
+    ).insert()
+    for i in range(2):
+        Message(
+            role="user",
+            session_id="session",
+            character_id="character",
+            created_by="old",
+            content=f"Message {i}",
+        ).insert()
+
+    tasks.transfer_user_data("old", "new")
+    # A retry of the same task must not count the messages twice.
+    tasks.transfer_user_data("old", "new")
+
+    assert ChatSession.find_class({"id": "session"}).created_by == "new"
+    assert Message.count_documents({"created_by": "new"}) == 2
+    assert User.find_class({"id": "new"}).messages_count == 2
+    assert User.find_class({"id": "old"}).messages_count == 0
+    assert events[-1] == "user-data-transferred"
+
+
+def test_transfer_without_data_writes_no_checkpoint(events):
+    make_user("new")
+
+    tasks.transfer_user_data("old", "new")
+
+    assert events == ["user-data-transferred"]
+    assert TaskCheckpoint.count_documents({}) == 0
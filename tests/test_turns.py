@@ -0,0 +1,37 @@
+from library import turns
+from models.character import Character
+from models.message import Message
+from models.session import ChatSession
+from models.user import User
+
+
+def make_message(role: str, content: str) -> Message:
+    return Message(
+        role=role,
+        session_id="session",
+        character_id="character",
+        created_by="user",
+        content=content,
+    )
+
+
+def test_commit_turn_is_read_back_as_chat_history():
+    User(email="user@example.com", display_name="User", password="", id="user").insert()
+    Character(
+        created_by="user", name="Character", description="", id="character"
+    ).insert()
+    session = ChatSession(
+        created_by="user", name="Session", character_id="character", id="session"
+    )
+    session.insert()
+
+    turn = [make_message("user", "Hello"), make_message("assistant", "Hi")]
+    turns.commit_turn(turn, increment_uses=True)
+
+    history = list(session.messages())
+    assert [x.id for x in history] == [x.id for x in turn]
+    assert [x.content for x in history] == ["Hello", "Hi"]
+
+    assert ChatSession.find_class({"id": "session"}).messages_count == 2
+    assert Character.find_class({"id": "character"}).uses == 1
+    assert User.find_class({"id": "user"}).messages_count == 2